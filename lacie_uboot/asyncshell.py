@@ -0,0 +1,977 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+asyncshell is the event driven core of ubootshell, every method talking to
+the device is a coroutine to run on an EventLoop.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import deque
+from math import floor
+import logging
+import os
+import socket
+from struct import pack
+import sys
+sys.dont_write_bytecode = True
+
+from broker import open_netconsole
+from discovery import find_device, query
+from eventloop import DatagramEndpoint, Future, Return
+from leases import LeaseRegistry, allocate_ips
+from metrics import Metrics
+from network import iface_info, find_free_ip, is_valid_mac, \
+    is_valid_ipv4, ip_to_int, list_ifaces
+from pacing import CatchStrategy, Pacer
+from pipeline import join, plan, split
+from protocol import lump_packet, LOOK_PACKET
+from readiness import BootWatcher, IpcommProtocol
+
+PROMPT = "Marvell>> "
+OVERRIDE = "Override Env parameters? (y/n)"
+# How long the output may wait before being written to stdout
+DISPLAY_DELAY = 0.05
+# Give it as the interface to send the LUMP on every interface at once
+AUTO_IFACE = 'auto'
+
+
+def prompt_prefix(data):
+    '''
+    Length of the end of data which may be the beginning of a prompt.
+    '''
+    for size in range(min(len(OVERRIDE) - 1, len(data)), 0, -1):
+        end = data[-size:]
+        if PROMPT.startswith(end) or OVERRIDE.startswith(end):
+            return size
+    return 0
+
+
+class CommandResult(object):
+    '''
+    What the device answered to a command. At most limit bytes of output are
+    kept (all of it when limit is None), truncated tells if some were dropped
+    and size counts every byte.
+    first_byte and elapsed are the seconds from the command to the first
+    datagram of the device and to the prompt.
+    prompt is PROMPT or OVERRIDE, None if the command gives no prompt back
+    (reset, bootm) or if we stopped waiting for it.
+    timed_out tells if the prompt did not come back in time.
+    '''
+
+    def __init__(self, cmd, limit=None):
+        self.cmd = cmd
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+        self.echo = None
+        self.first_byte = None
+        self.elapsed = None
+        self.prompt = None
+        self.timed_out = False
+
+    def add(self, chunk):
+        '''Keep chunk of output, as far as the limit allows.'''
+        kept = self.size
+        self.size += len(chunk)
+        if self.limit is not None and self.size > self.limit:
+            self.truncated = True
+            chunk = chunk[:max(self.limit - kept, 0)]
+        if chunk:
+            self.chunks.append(chunk)
+
+    @property
+    def output(self):
+        return ''.join(self.chunks)
+
+    @property
+    def echo_ok(self):
+        '''True if the device echoed the command as it was sent.'''
+        return self.echo is not None and self.echo.strip() == self.cmd
+
+    def __str__(self):
+        return self.output
+
+
+class OutputStream(object):
+    '''
+    The output of a command, as the device sends it. Every datagram waiting
+    is taken at once and the prompt is looked for in what is new only.
+    read() is a coroutine, its result is the next chunk of output, without the
+    echo of the command, or '' once the prompt came or timeout seconds went
+    by, if given.
+    '''
+
+    def __init__(self, session, cmd, timeout=None):
+        self.session = session
+        self.cmd = cmd
+        self.started = session.loop.time()
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = self.started + timeout
+        self.timed_out = False
+        # Seconds until the device sent anything
+        self.first_byte = None
+        self.echo = []
+        self.echoed = False
+        # The end of the last chunk, it may be the start of the prompt
+        self.pending = ''
+        # PROMPT or OVERRIDE, once it came
+        self.prompt = None
+
+    def read(self):
+        while self.prompt is None and not self.timed_out:
+            wait = 0.5
+            if self.deadline is not None:
+                wait = min(wait, self.deadline - self.session.loop.time())
+                if wait <= 0:
+                    # What looked like the start of a prompt was output
+                    self.timed_out = True
+                    chunk, self.pending = self.pending, ''
+                    raise Return(chunk)
+            data = yield self.session._recv_all(wait)
+            if data is None:
+                continue
+            chunk = self.feed(data)
+            if chunk:
+                raise Return(chunk)
+        raise Return('')
+
+    def feed(self, data):
+        '''
+        Take data from the device, return the output it holds.
+        '''
+        if self.first_byte is None:
+            self.first_byte = self.session.loop.time() - self.started
+        if not self.echoed:
+            # When sending a command U-Boot return the commands
+            # char by char, we do this so we don't display it.
+            end = data.find('\n')
+            if end >= 0:
+                self.echo.append(data[:end + 1])
+                data = data[end + 1:]
+            else:
+                # The end of the echo may be lost, then the prompt comes in
+                # what still looks like the echo.
+                self.echo.append(data)
+                echo = ''.join(self.echo)
+                found = [echo.find(prompt) for prompt in (PROMPT, OVERRIDE)]
+                found = [index for index in found if index >= 0]
+                if not found:
+                    return ''
+                self.echo = [echo[:min(found)]]
+                data = echo[min(found):]
+            self.echoed = True
+
+        data = self.pending + data
+        found = [(data.find(prompt), prompt) for prompt in (PROMPT, OVERRIDE)]
+        found = [(index, prompt) for index, prompt in found if index >= 0]
+        if found:
+            index, self.prompt = min(found)
+            self.pending = ''
+            self.session.pacer.feedback(self.cmd, ''.join(self.echo))
+            if self.prompt == OVERRIDE:
+                return data[:index] + OVERRIDE
+            return data[:index]
+
+        keep = prompt_prefix(data)
+        self.pending = data[len(data) - keep:]
+        return data[:len(data) - keep]
+
+
+class InterfaceListener(object):
+    '''
+    Takes the datagrams sent from one of the IPs offered by the LUMP of a
+    session on several interfaces, and tells the session which one answered.
+    '''
+
+    def __init__(self, session, candidate):
+        self.session = session
+        self.candidate = candidate
+
+    def datagram_received(self, data):
+        self.session.answered = self.candidate
+        self.session.datagram_received(data)
+
+
+class AsyncUbootshell(object):
+    '''
+    An instance of AsyncUbootshell is a session with the netconsole shell.
+    send_lump(), invoke(), run() and ipcomm_info() are coroutines, so one loop
+    can drive the netconsole of many devices.
+    '''
+
+    def __init__(self, loop, endpoint=None):
+        '''Sets some defaults'''
+
+        self.loop = loop
+
+        self.ip_target = None
+        self.iface = None
+        self.host_ip = None
+        self.bcast_addr = None
+        self.mac_target = None
+        # (iface, host_ip, bcast_addr, ip_target) of every interface the
+        # LUMP is sent on, when there are several, and the one which answered
+        self.candidates = []
+        self.answered = None
+        self.send_port = 4446
+        self.receive_port = 4445
+        self.uboot_port = 6666
+        # Local address of our sockets, and where LOOK packets are sent
+        self.bind_addr = ''
+        self.look_addr = '255.255.255.255'
+        # Where Ctrl-C is sent while catching the device, the broadcast
+        # address when None. Send it to the device only when others on the
+        # network are busy and must not be interrupted.
+        self.ctrl_c_addr = None
+        self.lump_timeout = 120
+        # Give up waiting for the prompt after a command after that many
+        # seconds, None to wait for ever
+        self.command_timeout = 600
+        # Give up waiting for the device to boot after that many seconds
+        self.boot_timeout = 600
+        self.script = None
+        self.do_wait = False
+        self.progress = False
+        self.debug = False
+        self.pacer = Pacer()
+        self.catch = CatchStrategy()
+        self.leases = LeaseRegistry()
+        # Timings and counters, labeled with the MAC of the device
+        self.metrics = Metrics()
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        # PcapWriter recording every datagram of our sockets
+        self.capture = None
+        # Replay standing for the network, see capture.Replay
+        self.replay = None
+        # Set if the netconsole socket is shared with other sessions
+        self.endpoint = endpoint
+        self.own_endpoint = False
+        self._inbox = deque()
+        self._waiter = None
+        # Output waiting to be written to stdout
+        self._display = []
+        self._display_timer = None
+        # CommandResult of every command run by the script
+        self.results = []
+        # Longest line when several script commands are sent on one line,
+        # None to send them one by one
+        self.pipeline = None
+        # Bytes of output kept by each CommandResult, None to keep it all
+        self.capture_limit = 1024 * 1024
+        # Stream the output to stdout while running the script
+        self.stream = True
+
+    def load_script(self, path_file):
+        '''
+        If we don't want an interactive shell, but a script to be executed.
+        '''
+        if not os.path.exists(path_file):
+            logging.error("%s does not exists." % path_file)
+        self.script = path_file
+
+    def do_progress(self, new_progress):
+        '''
+        If set to true, we will print a progress bar instead of the output.
+        '''
+        self.progress = new_progress
+
+    # Output example: [=======   ] 75%
+    # width defines bar width
+    # percent defines current percentage
+    def print_progress(self, width, percent):
+        marks = floor(width * (percent / 100.0))
+        spaces = floor(width - marks)
+
+        loader = '[' + ('=' * int(marks)) + (' ' * int(spaces)) + ']'
+
+        sys.stdout.write("%s %d%%\r" % (loader, percent))
+        if percent >= 100:
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    def wait_at_reboot(self, wait):
+        '''
+        Set to true, we will wait for the device to reboot completely
+        '''
+        self.do_wait = wait
+
+    def setup_network(self, net_dict):
+        '''
+        Give a dict with the following values to setup your network :
+        {
+            'iface': 'ethX'  # default : eth0, 'auto' for every interface
+            'bcast_addr' : '255.255.255.0'  # The broadcast address if you need to set it
+            'mac_target' : '00:00:00:00:00:00'  # The mac of your product
+            'ip_target' : '192.168.1.1'  # The ip to assign to the product
+        }
+        With 'auto', a free IP is found on every interface with an IPv4
+        address, or on the subnet of ip_target, and the LUMP is sent on all
+        of them. The session then keeps the interface the device answered on.
+        '''
+
+        if ('mac_target' not in net_dict) or (net_dict['mac_target'] is None):
+            logging.info("WARNING : The first product to reboot will be catched !")
+            logging.info("It may not be yours if multiple product reboot at the "
+                         "same time on your network.")
+            net_dict['mac_target'] = "00:00:00:00:00:00"
+
+        metrics = self.metrics
+        start = metrics.now()
+        if net_dict['iface'] == AUTO_IFACE:
+            if sys.platform == "darwin":
+                logging.error("You need to specify the interface to use.")
+                return 1
+            ifaces = list_ifaces()
+            if net_dict.get('ip_target') is not None:
+                if not is_valid_ipv4(net_dict['ip_target']):
+                    logging.error("Your product IP is not in the proper "
+                                  "format.\'W.X.Y.Z\' format is awaited."
+                                  "You gave %s" % net_dict['ip_target'])
+                    return 1
+                # Only the interfaces on the subnet of the IP given
+                target = ip_to_int(net_dict['ip_target'])
+                ifaces = [info for info in ifaces
+                          if ip_to_int(info[1]) & ip_to_int(info[3]) ==
+                          target & ip_to_int(info[3])]
+            if not ifaces:
+                logging.error("No network interface to send the LUMP on.")
+                return 1
+            logging.debug("Sending the LUMP on %s",
+                          ", ".join(info[0] for info in ifaces))
+        else:
+            try:
+                ifaces = [(net_dict['iface'],) +
+                          iface_info(net_dict['iface'])]
+            except (IOError, TypeError):
+                logging.error("Your network interface is not reachable."
+                              " Is %s correct ?" % net_dict['iface'])
+                return 1
+        metrics.observe('iface_info', start, mac=net_dict['mac_target'])
+
+        candidates = []
+        for iface, ip, mac, netmask, bcast in ifaces:
+            ip_target = net_dict.get('ip_target')
+            # This IP is used afterwards when TFTP'ing files
+            if ip_target is None:
+                if sys.platform == "darwin":
+                    logging.error("You need to specify an IP to assign to the device.")
+                    return 1
+                free_start = metrics.now()
+                if net_dict['mac_target'] == "00:00:00:00:00:00" or \
+                        not is_valid_mac(net_dict['mac_target']):
+                    # Nobody to remember a lease for
+                    ip_target = find_free_ip(iface, ip, mac, netmask,
+                                             metrics=metrics)
+                else:
+                    ip_target = allocate_ips(
+                        self.leases, iface, ip, mac, netmask,
+                        [net_dict['mac_target']],
+                        metrics=metrics).get(net_dict['mac_target'])
+                metrics.observe('free_ip', free_start,
+                                mac=net_dict['mac_target'])
+                if ip_target is None:
+                    continue
+
+            if not is_valid_ipv4(bcast):
+                logging.error("Your Broadcast IP is not in the proper format."
+                              "\'W.X.Y.Z\' format is awaited."
+                              "You gave %s" % bcast)
+                return 1
+            candidates.append((iface, ip, bcast, ip_target))
+        if not candidates:
+            return 1
+
+        # Check MAC and IP value.
+        if not is_valid_mac(net_dict['mac_target']):
+            logging.error("Your MAC address is not in the proper format."
+                          "\'00:00:00:00:00:00\' format is awaited."
+                          "You gave %s" % net_dict['mac_target'])
+            return 1
+        self.mac_target = net_dict['mac_target']
+
+        if not is_valid_ipv4(candidates[0][3]):
+            logging.error("Your product IP is not in the proper format."
+                          "\'W.X.Y.Z\' format is awaited."
+                          "You gave %s" % candidates[0][3])
+            return 1
+        # Until the device answers on one of them
+        self.iface, self.host_ip, self.bcast_addr, self.ip_target = \
+            candidates[0]
+        net_dict['ip_target'] = self.ip_target
+        if len(candidates) > 1:
+            self.candidates = candidates
+        metrics.observe('setup_network', start, mac=self.mac_target)
+
+    def send_lump(self):
+        '''
+        Coroutine, see _send_lump.
+        '''
+        return self._send_lump()
+
+    def invoke(self, cmd, display=True, callback=None):
+        '''
+        Coroutine, see _invoke.
+        '''
+        return self._invoke(cmd, display, callback)
+
+    def run(self):
+        '''
+        Coroutine, see _run.
+        '''
+        return self._run()
+
+    def ipcomm_info(self):
+        '''
+        Coroutine, see _ipcomm_info.
+        '''
+        return self._ipcomm_info()
+
+    def datagram_received(self, data):
+        '''
+        Called by the endpoint for every datagram sent by our device.
+        '''
+        self.packets_received += 1
+        self.bytes_received += len(data)
+        self._inbox.append(data)
+        if self._waiter is not None:
+            self._waiter.set_result(None)
+
+    def _recv(self, timeout):
+        '''
+        Wait at most timeout seconds for a datagram from the device.
+        The result is None if nothing came.
+        '''
+        if not self._inbox:
+            yield self._recv_wait(timeout)
+            if not self._inbox:
+                raise Return(None)
+        raise Return(self._inbox.popleft())
+
+    def _recv_all(self, timeout):
+        '''
+        Wait at most timeout seconds for the device, the result is every
+        datagram received so far, joined, or None if nothing came.
+        '''
+        if not self._inbox:
+            yield self._recv_wait(timeout)
+            if not self._inbox:
+                raise Return(None)
+        data = ''.join(self._inbox)
+        self._inbox.clear()
+        raise Return(data)
+
+    def _recv_wait(self, timeout):
+        '''
+        Wait at most timeout seconds for a datagram to be received.
+        '''
+        # Some may have come before this coroutine started
+        if self._inbox:
+            return
+        self._waiter = Future(self.loop)
+        timer = self.loop.call_later(timeout, self._waiter.set_result, None)
+        yield self._waiter
+        timer.cancel()
+        self._waiter = None
+
+    def _write(self, data):
+        '''
+        Write data to stdout soon, along with what comes in the meantime.
+        '''
+        self._display.append(data)
+        if self._display_timer is None:
+            self._display_timer = self.loop.call_later(DISPLAY_DELAY,
+                                                       self._flush)
+
+    def _flush(self):
+        if self._display_timer is not None:
+            self._display_timer.cancel()
+            self._display_timer = None
+        if self._display:
+            sys.stdout.write(''.join(self._display))
+            sys.stdout.flush()
+            self._display = []
+
+    def _drain(self):
+        '''
+        Forget every datagram already received.
+        '''
+        if self.endpoint is not None:
+            self.endpoint.read_ready()
+        self._inbox.clear()
+
+    def _settle(self):
+        '''
+        Wait until the device stayed quiet for the pacer's quiet period,
+        throwing away what is still coming.
+        The result is the time it took.
+        '''
+        start = self.loop.time()
+        stop = start + self.pacer.max_delay
+        while self.loop.time() < stop:
+            data = yield self._recv_all(min(self.pacer.quiet,
+                                            max(stop - self.loop.time(), 0)))
+            if data is None:
+                break
+        raise Return(self.loop.time() - start)
+
+    def _open(self):
+        '''
+        Make sure we have a netconsole socket, return False if we can't.
+        '''
+        if self.endpoint is None and self.replay is not None:
+            self.endpoint = self.replay.endpoint(self.uboot_port)
+            self.own_endpoint = True
+        elif self.endpoint is None:
+            try:
+                self.endpoint = open_netconsole(self.loop, self.uboot_port,
+                                                self.bind_addr)
+            except socket.error, err:
+                logging.error("Couldn't be a udp server on port %d : %s",
+                              self.uboot_port, err)
+                return False
+            self.own_endpoint = True
+        if self.capture is not None:
+            self.endpoint.capture = self.capture
+        try:
+            self.endpoint.register(self.ip_target, self)
+        except socket.error, err:
+            # The broker gave the IP to another session
+            logging.error("Can't use %s : %s", self.ip_target, err)
+            self.close()
+            return False
+        return True
+
+    def collect_metrics(self):
+        '''
+        Copy the packet and byte counters of the session to its metrics.
+        '''
+        for name in ('packets_sent', 'bytes_sent', 'packets_received',
+                     'bytes_received'):
+            self.metrics.set_count(name, getattr(self, name),
+                                   mac=self.mac_target)
+
+    def close(self):
+        '''
+        Release the netconsole socket, the session is over.
+        '''
+        self.collect_metrics()
+        if self.endpoint is None:
+            return
+        for candidate in self.candidates:
+            self.endpoint.unregister(candidate[3])
+        self.endpoint.unregister(self.ip_target)
+        if self.own_endpoint:
+            self.endpoint.close()
+            self.endpoint = None
+            self.own_endpoint = False
+
+    def _send_lump(self):
+        '''
+        It will ask the users to reboot the target manually and then
+        it will send LUMP packet to a target, as paced by self.catch, during
+        lump_timeout seconds at most.
+        '''
+
+        logging.debug("Sending some LUMP / Ctrl-C, "
+                      "waiting for the NAS to start up")
+        logging.info("Please /!\HARD/!\ reboot the device /!\NOW/!\ ")
+
+        if not self._open():
+            raise Return(None)
+
+        # One LUMP on each interface, with an IP of its subnet
+        lumps = [(lump_packet(self.mac_target, self.ip_target),
+                  self.bcast_addr)]
+        if self.candidates:
+            lumps = [(lump_packet(self.mac_target, ip_target), bcast)
+                     for _, _, bcast, ip_target in self.candidates]
+            self.endpoint.unregister(self.ip_target)
+            try:
+                for candidate in self.candidates:
+                    self.endpoint.register(candidate[3],
+                                           InterfaceListener(self, candidate))
+            except socket.error, err:
+                logging.error("Can't use %s : %s", candidate[3], err)
+                self.close()
+                raise Return(None)
+
+        catch = self.catch
+        catch.start(self.loop.time())
+        # lump_timeout bounds the whole catch, whatever the device sends
+        deadline = catch.started + self.lump_timeout
+        lump_ok = False
+        while not lump_ok and self.loop.time() < deadline:
+            length = catch.round_length(catch.first_byte is None)
+            round_end = min(self.loop.time() + length, deadline)
+            for pkt, bcast in lumps:
+                self.endpoint.sendto(pkt, (bcast, self.send_port))
+                catch.lumps += 1
+            # Wait for the device to process the LUMP
+            yield self.loop.sleep(min(catch.ctrl_c_after(length),
+                                      round_end - self.loop.time()))
+            #Send Ctrl-C (Code ASCII 3 for EXT equivalent of SIGINT for Unix)
+            for _, bcast in lumps:
+                self.endpoint.sendto('\3', (self.ctrl_c_addr or bcast,
+                                            self.uboot_port))
+                catch.ctrl_c += 1
+            while self.loop.time() < round_end:
+                serv_data = yield self._recv(round_end - self.loop.time())
+                if serv_data is None:
+                    break
+                catch.heard(self.loop.time())
+                # check when prompt (Marvell>>) is available,
+                # then out to the next while to input command and send them !
+                if PROMPT == serv_data:
+                    lump_ok = True
+                    break
+
+        catch.done(self.loop.time(), lump_ok)
+        catch.report()
+        self.metrics.add_span('lump', catch.duration, mac=self.mac_target,
+                              caught=lump_ok)
+        self.metrics.count('lump_sent', catch.lumps, mac=self.mac_target)
+        self.metrics.count('ctrl_c_sent', catch.ctrl_c, mac=self.mac_target)
+        if not lump_ok:
+            logging.debug("Sending LUMP for %ds, no response !",
+                          self.lump_timeout)
+
+        if not lump_ok:
+            self.close()
+            raise Return(lump_ok)
+
+        if self.candidates:
+            self._lock(self.answered)
+        if self.own_endpoint:
+            # From now on, only the device may talk to us.
+            self.endpoint.connect(self.ip_target)
+        # Let the prompts of the extra Ctrl-C arrive, then forget them.
+        yield self.loop.sleep(0.2)
+        self._drain()
+        raise Return(lump_ok)
+
+    def _lock(self, candidate):
+        '''
+        Keep the interface of candidate, the one the device answered on, and
+        the IP it took there, for the rest of the session.
+        '''
+        # The IP of candidate stays ours, the broker may not give it back
+        for _, _, _, ip_target in self.candidates:
+            if ip_target != candidate[3]:
+                self.endpoint.unregister(ip_target)
+        self.candidates = []
+        self.iface, self.host_ip, self.bcast_addr, self.ip_target = candidate
+        self.endpoint.register(self.ip_target, self)
+        logging.info("Your product answered on %s, it is at %s", self.iface,
+                     self.ip_target)
+
+    def _invoke(self, cmd, display=True, callback=None):
+        '''
+        send a cmd, the result is a CommandResult of what the device
+        answered. The output is written to stdout if display is set, and
+        given to callback chunk by chunk as it comes if it is set, whatever
+        capture_limit.
+        '''
+
+        result = CommandResult(cmd, self.capture_limit)
+
+        # Empty command, nothing to do here
+        if cmd == "":
+            raise Return(result)
+
+        exit_list = ['exit', 'reset']
+
+        if self.endpoint is None:
+            if not self._open():
+                raise Return(result)
+            if self.own_endpoint:
+                self.endpoint.connect(self.ip_target)
+
+        if cmd in exit_list:
+            cmd = 'reset'
+            cmd = pack('!' + str(len(cmd)) + 's1s', cmd, '\x0A')
+            self.endpoint.sendto(cmd, (self.ip_target, self.uboot_port))
+            self.packets_sent += 1
+            self.bytes_sent += len(cmd)
+            self.close()
+            raise Return(result)
+
+        # Don't try to wait for a prompt with bootm
+        if cmd == 'bootm':
+            self._send_command(cmd)
+            raise Return(result)
+
+        stream = self.invoke_stream(cmd)
+        while True:
+            chunk = yield stream.read()
+            if not chunk:
+                break
+            result.add(chunk)
+            if callback is not None:
+                callback(chunk)
+            if display:
+                self._write(chunk)
+        if display:
+            if stream.prompt == OVERRIDE:
+                self._write('\n')
+            self._flush()
+        result.echo = ''.join(stream.echo)
+        result.first_byte = stream.first_byte
+        result.elapsed = self.loop.time() - stream.started
+        result.prompt = stream.prompt
+        result.timed_out = stream.timed_out
+        if stream.timed_out:
+            logging.error("No prompt %gs after %s", self.command_timeout, cmd)
+            self.metrics.count('command_timeout', mac=self.mac_target)
+        self.metrics.add_span('command', result.elapsed, mac=self.mac_target,
+                              command=cmd.split(None, 1)[0])
+        if not result.echo_ok:
+            self.metrics.count('bad_echo', mac=self.mac_target)
+        raise Return(result)
+
+    def _send_command(self, cmd):
+        # Whatever is still pending belongs to a previous command.
+        self._drain()
+
+        #we want to send a cmd to the nas and get the reply in ans
+        #every command is completed by \n !
+        command = pack('!' + str(len(cmd)) + 's1s', cmd, '\x0A')
+        self.endpoint.sendto(command, (self.ip_target, self.uboot_port))
+        self.packets_sent += 1
+        self.bytes_sent += len(command)
+
+    def invoke_stream(self, cmd):
+        '''
+        Send a cmd and return its OutputStream, to read the output as it
+        comes. The device must be caught, and cmd must give the prompt back
+        (not reset or bootm).
+        '''
+        self._send_command(cmd)
+        return OutputStream(self, cmd, self.command_timeout)
+
+    def _run_script(self):
+        '''
+        Execute every command of the script, the device must be caught.
+        '''
+
+        with open(self.script, 'r+') as script:
+            script_cmd = script.readlines()
+
+        yield self._run_commands(script_cmd)
+
+    def _run_commands(self, script_cmd):
+        '''
+        Execute every line of script_cmd like a script, the device must be
+        caught. Empty lines and comments are skipped.
+        With pipeline set, consecutive commands like setenv share a line,
+        each still gets its own CommandResult.
+        '''
+
+        commands = [cmd.strip() for cmd in script_cmd
+                    if cmd != '\n' and not cmd.startswith('#')]
+        if self.pipeline:
+            groups = plan(commands, self.pipeline)
+        else:
+            groups = [[cmd] for cmd in commands]
+
+        if self.progress:
+            # setup progress_bar
+            p_width = 60
+            p_pas = p_width / max(len(commands), 1)
+            p_percent = 0
+
+        for group in groups:
+
+            if self.progress:
+                # update the bar
+                self.print_progress(p_width, p_percent)
+                p_percent += p_pas * len(group)
+
+            line = join(group)
+
+            # it seems uboot doesn't like being shaked a bit
+            if self.endpoint is not None:
+                delay = yield self._settle()
+                self.pacer.record(line, delay)
+
+            if len(group) == 1:
+                if self.stream and not self.progress:
+                    print line + " => ",
+                result = yield self._invoke(line,
+                                            display=self.stream and
+                                            not self.progress)
+                results = [result]
+            else:
+                result = yield self._invoke(line, display=False)
+                results = self._split_result(result, group)
+                if self.stream and not self.progress:
+                    for part in results:
+                        print part.cmd + " => ",
+                        sys.stdout.write(part.output)
+                    sys.stdout.flush()
+
+            for result in results:
+                self.results.append(result)
+                self.show(result.cmd, result.output)
+
+        if self.progress:
+            self.print_progress(p_width, 100)
+
+        self.close()
+        self.pacer.report()
+
+    def _split_result(self, result, group):
+        '''
+        Give each command of a pipelined group its own CommandResult, out of
+        the result of their line. They share its timings and prompt.
+        '''
+        results = []
+        for cmd, output in zip(group, split(result.output, len(group))):
+            part = CommandResult(cmd, self.capture_limit)
+            part.add(output)
+            part.echo = cmd if result.echo_ok else result.echo
+            part.first_byte = result.first_byte
+            part.elapsed = result.elapsed
+            part.prompt = result.prompt
+            results.append(part)
+        return results
+
+    def show(self, cmd, output):
+        '''
+        Called with the output of each command of the script when it is not
+        streamed to stdout.
+        '''
+        pass
+
+    def _run(self):
+        '''
+        Catch the device and execute the script.
+        Without a script, the device is only caught, send your commands
+        with invoke().
+        '''
+
+        lump_ok = yield self._send_lump()
+        if not lump_ok:
+            logging.debug("LUMP was not sent/receveid by the target")
+            raise Return(1)
+
+        if self.script is None:
+            raise Return(0)
+
+        yield self._run_script()
+
+        # You can't wait if there is no MAC.
+        if self.do_wait and (self.mac_target != "00:00:00:00:00:00"):
+            # Some command output may be stuck in the pipe
+            sys.stdout.flush()
+            # WAIT FOR THE DEVICE TO BOOT
+            logging.info("Waiting for your product to reboot...")
+            watcher = BootWatcher(self.loop, self.mac_target, self.ip_target,
+                                  self.iface, self.uboot_port,
+                                  self.receive_port, self.boot_timeout)
+            start = self.metrics.now()
+            ip = yield watcher.watch()
+            watcher.report()
+            self.metrics.observe('boot', start, mac=self.mac_target,
+                                 online=ip is not None)
+            for phase, seconds in watcher.timings.items():
+                self.metrics.add_span('boot_phase', seconds,
+                                      mac=self.mac_target, phase=phase)
+            if ip is None:
+                logging.info("Timeout : Unable to get your product IP.")
+                raise Return(1)
+            logging.info("Your product is available at %s" % ip)
+        raise Return(0)
+
+    def _ipcomm_info(self):
+        '''
+        Send LOOK packets and wait for the INFO answer of our device,
+        the result is its IP or None.
+        '''
+        start = self.metrics.now()
+        ip = yield self._look()
+        self.metrics.observe('ipcomm', start, mac=self.mac_target,
+                             found=ip is not None)
+        raise Return(ip)
+
+    def _look(self):
+        '''
+        Coroutine of _ipcomm_info.
+        A running discovery daemon already knows, ask it first.
+        '''
+
+        if self.replay is None:
+            try:
+                ip = find_device(self.mac_target, self.ip_target)
+                if ip is not None:
+                    raise Return(ip)
+                query('LOOK')
+                for tryout in range(10):
+                    yield self.loop.sleep(0.05)
+                    ip = find_device(self.mac_target, self.ip_target)
+                    if ip is not None:
+                        break
+                raise Return(ip)
+            except socket.error:
+                pass
+
+        found = Future(self.loop)
+        protocol = IpcommProtocol(found, self.mac_target, self.ip_target)
+        if self.replay is not None:
+            endpoint = self.replay.endpoint(self.receive_port, protocol)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+            # Listen for the answer
+            try:
+                sock.bind((self.bind_addr, self.receive_port))
+            except socket.error, err:
+                logging.error("Couldn't be a udp server on port %d : %s",
+                              self.receive_port, err)
+                sock.close()
+                raise Return(None)
+            endpoint = DatagramEndpoint(self.loop, sock, protocol)
+            endpoint.capture = self.capture
+
+        tryout = 0  # Number of tries, don't want to stay here forever
+        while not found.done() and tryout < 10:
+            endpoint.sendto(LOOK_PACKET, (self.look_addr, self.receive_port))
+            yield self.loop.wait([found], 0.05)
+            tryout += 1
+        endpoint.close()
+        self.metrics.count('look_sent', tryout, mac=self.mac_target)
+
+        if not found.done():
+            raise Return(None)
+        raise Return(found.result())
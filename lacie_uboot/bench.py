@@ -0,0 +1,282 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+bench measures a whole session against the emulator : catching the devices
+with LUMP, running commands on each of them, and finding them with IPCOMM.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import json
+import logging
+import os
+import subprocess
+import sys
+sys.dont_write_bytecode = True
+
+from asyncshell import AsyncUbootshell
+from emulator import device_mac
+from eventloop import EventLoop, Return, monotonic
+from multishell import MultiUbootshell
+
+# Seconds a new process may take before it starts updating a product :
+# start the interpreter and import the updater, without any .pyc
+COLD_START_BUDGET = 0.25
+
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+def device_ip(index):
+    '''
+    IP given to the index-th emulated device.
+    '''
+    return "127.0.%d.%d" % (1 + index // 250, 1 + index % 250)
+
+
+class Bench(object):
+    '''
+    Runs a session against an emulator with a growing number of devices.
+    Every device runs commands like a script does, each result is a dict.
+    A device stops after a command left without a prompt for timeout seconds,
+    which happens when the emulator drops it.
+    '''
+
+    def __init__(self, commands=20, output=256, latency=0.0, loss=0.0,
+                 host='127.0.0.1', segment='127.0.0.2', width=None):
+        self.commands = commands
+        self.output = output
+        self.width = width
+        self.latency = latency
+        self.loss = loss
+        self.host = host
+        self.segment = segment
+        self.timeout = 5.0
+
+    def start_emulator(self, devices):
+        '''
+        Start the emulator in its own process, wait until it listens.
+        '''
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'emulator.py')
+        args = [sys.executable, '-B', path,
+                '-n', str(devices),
+                '-s', self.segment,
+                '-o', str(self.output),
+                '-l', str(self.latency),
+                '-L', str(self.loss),
+                '--seed', '0']
+        if self.width is not None:
+            args += ['-w', str(self.width)]
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        if process.stdout.readline().strip() != "ready":
+            process.wait()
+            raise RuntimeError("The emulator did not start.")
+        return process
+
+    def run(self, devices):
+        '''
+        Measure a session with devices emulated devices.
+        '''
+        process = self.start_emulator(devices)
+        loop = EventLoop()
+        try:
+            return loop.run_until_complete(self._run(loop, devices))
+        finally:
+            process.terminate()
+            process.wait()
+            loop.close()
+
+    def _run(self, loop, devices):
+        session = MultiUbootshell(loop)
+        session.bind_addr = self.host
+        session.bcast_addr = self.segment
+        session.display = False
+        session.lump_timeout = 30
+        for index in range(devices):
+            session.add_target(device_mac(index), device_ip(index))
+
+        start = loop.time()
+        caught = yield session._send_lump()
+        lump_time = loop.time() - start
+
+        rtts = []
+        received = [0]
+        timeouts = [0]
+
+        def commands(target):
+            for index in range(self.commands):
+                yield target._settle()
+                sent = loop.time()
+                task = loop.create_task(
+                    target._invoke("bench %d" % index, False))
+                done = yield loop.wait([task], self.timeout)
+                if not done:
+                    task.cancel()
+                    timeouts[0] += 1
+                    break
+                rtts.append(loop.time() - sent)
+                received[0] += task.result().size
+
+        start = loop.time()
+        yield loop.gather([commands(target) for target in caught])
+        elapsed = loop.time() - start
+
+        # Find the first device again, then let every device go
+        ipcomm_time = None
+        if caught:
+            finder = AsyncUbootshell(loop)
+            finder.mac_target = caught[0].mac_target
+            finder.ip_target = caught[0].ip_target
+            finder.bind_addr = self.host
+            finder.look_addr = self.segment
+            start = loop.time()
+            ip = yield finder._ipcomm_info()
+            if ip is not None:
+                ipcomm_time = loop.time() - start
+        for target in caught:
+            yield target._invoke('reset', False)
+        session.close()
+
+        done = len(rtts)
+        raise Return({'devices': devices,
+                      'caught': len(caught),
+                      'timeouts': timeouts[0],
+                      'lump': lump_time,
+                      'rtt_p50': percentile(rtts, 0.5),
+                      'rtt_p95': percentile(rtts, 0.95),
+                      'rtt_max': max(rtts or [0.0]),
+                      'commands_per_s': done / elapsed if elapsed else 0.0,
+                      'bytes_per_s': received[0] / elapsed if elapsed else 0.0,
+                      'ipcomm': ipcomm_time})
+
+
+def cold_start(module='lacie_uboot.updater', runs=10):
+    '''
+    Return how long each of runs new interpreters took to import module.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    for _ in range(runs):
+        start = monotonic()
+        subprocess.check_call([sys.executable, '-B', '-c',
+                               'import %s' % module], cwd=root)
+        times.append(monotonic() - start)
+    return times
+
+
+def report(results):
+    '''
+    Print the results as a table.
+    '''
+    print "%7s %6s %8s %9s %9s %9s %8s %9s %10s %8s" % (
+        "devices", "caught", "lump(s)", "p50(ms)", "p95(ms)", "max(ms)",
+        "cmd/s", "KiB/s", "ipcomm(ms)", "timeouts")
+    for result in results:
+        ipcomm = "-"
+        if result['ipcomm'] is not None:
+            ipcomm = "%.1f" % (result['ipcomm'] * 1000)
+        print "%7d %6d %8.2f %9.1f %9.1f %9.1f %8.1f %9.1f %10s %8d" % (
+            result['devices'], result['caught'], result['lump'],
+            result['rtt_p50'] * 1000, result['rtt_p95'] * 1000,
+            result['rtt_max'] * 1000, result['commands_per_s'],
+            result['bytes_per_s'] / 1024, ipcomm, result['timeouts'])
+
+
+def main():
+    ''' run the benchmark '''
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--devices", dest="devices", action="store",
+                        default="1,4,16",
+                        help="Comma separated numbers of devices to emulate."
+                        " Default is 1,4,16.")
+    parser.add_argument("-c", "--commands", dest="commands", action="store",
+                        type=int, default=20,
+                        help="Commands run by each device. Default is 20.")
+    parser.add_argument("-o", "--output", dest="output", action="store",
+                        type=int, default=256,
+                        help="Bytes output by each command. Default is 256.")
+    parser.add_argument("-w", "--width", dest="width", action="store",
+                        type=int, default=None,
+                        help="Bytes of output per datagram, 1 like putc().\n"
+                        "Default is one line per datagram.")
+    parser.add_argument("-l", "--latency", dest="latency", action="store",
+                        type=float, default=0.0,
+                        help="Seconds added before each datagram is sent.")
+    parser.add_argument("-L", "--loss", dest="loss", action="store",
+                        type=float, default=0.0,
+                        help="Probability for a datagram to be dropped.")
+    parser.add_argument("-j", "--json", dest="json", action="store",
+                        default=None, metavar="FILE",
+                        help="Also write the results to FILE, one JSON object"
+                        " per line.")
+    parser.add_argument("-s", "--cold-start", dest="cold_start",
+                        action="store", type=int, default=None,
+                        metavar="RUNS",
+                        help="Only time RUNS starts of the updater, and fail"
+                        " if the median is over %dms." %
+                        (COLD_START_BUDGET * 1000))
+    parser.add_argument("-D", "--debug", dest="loglevel", action="store_const",
+                        const=logging.DEBUG, default=logging.WARNING,
+                        help="Output debugging information")
+    options = parser.parse_args()
+    logging.basicConfig(level=options.loglevel, format='%(message)s')
+
+    if options.cold_start is not None:
+        times = cold_start(runs=max(options.cold_start, 1))
+        median = percentile(times, 0.5)
+        print "cold start : %.1fms median, %.1fms max, %.0fms budget" % (
+            median * 1000, max(times) * 1000, COLD_START_BUDGET * 1000)
+        return int(median > COLD_START_BUDGET)
+
+    bench = Bench(options.commands, options.output, options.latency,
+                  options.loss, width=options.width)
+    results = []
+    for devices in [int(count) for count in options.devices.split(',')]:
+        results.append(bench.run(devices))
+    report(results)
+
+    if options.json is not None:
+        with open(options.json, 'a') as output:
+            for result in results:
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+    return 0
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
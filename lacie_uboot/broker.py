@@ -0,0 +1,412 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+broker owns the netconsole port for every process of the host, and gives each
+the datagrams of its own devices on a Unix socket.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+import errno
+import logging
+import os
+import signal
+import socket
+from struct import Struct
+import sys
+sys.dont_write_bytecode = True
+
+from eventloop import DatagramEndpoint, EventLoop
+from netconsole import Netconsole, NetconsoleEndpoint, RECEIVE_BUFFER
+
+BROKER_SOCKET = '/var/run/lacie-uboot/netconsole.sock'
+
+# Every message on the Unix socket starts with its kind, an IP and a port :
+#   R ip        the client talks to the device at ip
+#   U ip        it does not anymore
+#   S ip port   send the rest of the message to (ip, port)
+#   D ip port   the rest is a datagram from (ip, port)
+#   A ip        the client got ip
+#   E ip        ip is already used by another client
+HEADER = Struct('!c4sH')
+MAX_MESSAGE = HEADER.size + 2048
+# Seconds the broker has to answer a registration
+REPLY_TIMEOUT = 2.0
+
+
+def pack_message(kind, ip, port=0, data=''):
+    return HEADER.pack(kind, socket.inet_aton(ip), port) + data
+
+
+def unpack_message(message):
+    '''
+    Return (kind, ip, port, data) of a message, or None if it is too short.
+    '''
+    if len(message) < HEADER.size:
+        return None
+    kind, ip, port = HEADER.unpack_from(message)
+    return kind, socket.inet_ntoa(ip), port, message[HEADER.size:]
+
+
+class BrokerClient(object):
+    '''
+    A process connected to the broker, and the IPs of its devices.
+    '''
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.ips = set()
+        sock.setblocking(0)
+        # The device may send faster than the client reads, like on UDP
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            RECEIVE_BUFFER)
+        except socket.error:
+            pass
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        '''
+        Send a message to the client, it is dropped if the client is not
+        reading fast enough.
+        '''
+        try:
+            self.sock.send(message)
+        except socket.error, err:
+            logging.debug("Can't forward to a client : %s", err)
+
+    def read_ready(self):
+        while self.sock is not None:
+            try:
+                message = self.sock.recv(MAX_MESSAGE)
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                message = ''
+            if not message:
+                self.broker.drop(self)
+                return
+            self.broker.message_received(self, message)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class NetconsoleBroker(object):
+    '''
+    Owns the netconsole port, which the LUMP and Ctrl-C are sent from too,
+    and shares it between the local processes connected on the Unix socket
+    path. Each datagram goes to the client which registered its source IP,
+    the others are dropped.
+    A Ctrl-C sent to an address the client did not register, a broadcast
+    address, would interrupt the devices of the other clients, it is sent to
+    each device of the client instead.
+    '''
+
+    def __init__(self, loop, port=6666, bind_addr='', path=BROKER_SOCKET):
+        self.loop = loop
+        self.port = port
+        self.bind_addr = bind_addr
+        self.path = path
+        self.endpoint = None
+        self.sock = None
+        self.clients = {}  # fd -> BrokerClient
+        self.routes = {}  # ip -> BrokerClient
+
+    def start(self):
+        '''
+        Bind the netconsole port and the Unix socket, raise socket.error if
+        one of them can't be used.
+        '''
+        console = Netconsole(self.port, self.bind_addr)
+        self.endpoint = DatagramEndpoint(self.loop, console.sock, self)
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(self.path)
+        self.sock.listen(16)
+        self.sock.setblocking(0)
+        self.loop.add_reader(self.sock.fileno(), self._accept)
+
+    def _accept(self):
+        try:
+            sock, _ = self.sock.accept()
+        except socket.error, err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.debug("Accept error : %s", err)
+            return
+        client = BrokerClient(self, sock)
+        self.clients[client.fileno()] = client
+        self.loop.add_reader(client.fileno(), client.read_ready)
+        logging.debug("%d clients", len(self.clients))
+
+    def drop(self, client):
+        '''
+        The client is gone, forget its devices.
+        '''
+        for ip in client.ips:
+            del self.routes[ip]
+        self.loop.remove_reader(client.fileno())
+        del self.clients[client.fileno()]
+        client.close()
+        logging.debug("%d clients", len(self.clients))
+
+    def message_received(self, client, message):
+        message = unpack_message(message)
+        if message is None:
+            return
+        kind, ip, port, data = message
+        if kind == 'R':
+            owner = self.routes.get(ip)
+            if owner is not None and owner is not client:
+                logging.info("%s is already used by another client.", ip)
+                client.send(pack_message('E', ip))
+                return
+            self.routes[ip] = client
+            client.ips.add(ip)
+            client.send(pack_message('A', ip))
+        elif kind == 'U':
+            if self.routes.get(ip) is client:
+                del self.routes[ip]
+                client.ips.discard(ip)
+        elif kind == 'S':
+            if data == '\3' and ip not in client.ips and client.ips:
+                for device in client.ips:
+                    self.endpoint.sendto(data, (device, port))
+            else:
+                self.endpoint.sendto(data, (ip, port))
+
+    def datagram_received(self, data, addr):
+        client = self.routes.get(addr[0])
+        if client is not None:
+            client.send(pack_message('D', addr[0], addr[1], data))
+
+    def close(self):
+        for client in self.clients.values():
+            self.loop.remove_reader(client.fileno())
+            client.close()
+        self.clients = {}
+        self.routes = {}
+        if self.endpoint is not None:
+            self.endpoint.close()
+            self.endpoint = None
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class BrokerEndpoint(object):
+    '''
+    The netconsole socket of a broker, seen from an event loop, in place of a
+    NetconsoleEndpoint : each datagram goes to the session of its source IP.
+    Raise socket.error if no broker is listening on path.
+    '''
+
+    def __init__(self, loop, port=6666, path=BROKER_SOCKET):
+        self.loop = loop
+        self.port = port
+        self.sessions = {}  # ip -> session
+        self.capture = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self.sock.connect(path)
+        except socket.error:
+            self.sock.close()
+            raise
+        self.sock.setblocking(0)
+        loop.add_reader(self.sock.fileno(), self.read_ready)
+
+    def _send(self, message):
+        try:
+            self.sock.send(message)
+        except socket.error, err:
+            logging.debug("Can't talk to the broker : %s", err)
+            return False
+        return True
+
+    def _gone(self):
+        logging.error("The netconsole broker went away.")
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+    def _datagram(self, ip, port, data):
+        if self.capture is not None:
+            self.capture.write((ip, port), (self.capture.host, self.port),
+                               data)
+        session = self.sessions.get(ip)
+        if session is not None:
+            session.datagram_received(data)
+
+    def read_ready(self):
+        '''
+        Give every datagram already forwarded to the session of its sender.
+        '''
+        while self.sock is not None:
+            try:
+                message = self.sock.recv(MAX_MESSAGE)
+            except socket.error, err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.debug("Receive error : %s", err)
+                return
+            if not message:
+                self._gone()
+                return
+            message = unpack_message(message)
+            if message is not None and message[0] == 'D':
+                self._datagram(*message[1:])
+
+    def register(self, ip, session):
+        '''
+        Ask the broker for the datagrams of ip, and wait for its answer.
+        Raise socket.error if another process already uses ip.
+        '''
+        if self.sock is None or not self._send(pack_message('R', ip)):
+            raise socket.error("The netconsole broker went away.")
+        self.sock.settimeout(REPLY_TIMEOUT)
+        try:
+            while True:
+                message = self.sock.recv(MAX_MESSAGE)
+                if not message:
+                    self._gone()
+                    raise socket.error("The netconsole broker went away.")
+                message = unpack_message(message)
+                if message is None:
+                    continue
+                kind, answered, port, data = message
+                if kind == 'D':
+                    # Datagrams of our other devices may come first
+                    self._datagram(answered, port, data)
+                elif answered == ip and kind == 'E':
+                    raise socket.error("%s is already used by another "
+                                       "session." % ip)
+                elif answered == ip and kind == 'A':
+                    break
+        finally:
+            if self.sock is not None:
+                self.sock.setblocking(0)
+        self.sessions[ip] = session
+
+    def unregister(self, ip):
+        if self.sessions.pop(ip, None) is not None and self.sock is not None:
+            self._send(pack_message('U', ip))
+
+    def connect(self, ip):
+        '''The broker only gives us what our devices send'''
+        pass
+
+    def sendto(self, data, addr):
+        if self.sock is None or not self._send(pack_message('S', addr[0],
+                                                            addr[1], data)):
+            return
+        if self.capture is not None:
+            self.capture.write((self.capture.host, self.port), addr, data)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        self.sessions = {}
+
+
+def open_netconsole(loop, port=6666, bind_addr='', path=BROKER_SOCKET):
+    '''
+    Return the endpoint of a running broker, or else of our own netconsole
+    socket, see NetconsoleEndpoint.
+    Raise socket.error if there is no broker and the port is taken.
+    '''
+    if os.path.exists(path):
+        try:
+            endpoint = BrokerEndpoint(loop, port, path)
+            logging.debug("Sharing the netconsole of the broker on %s", path)
+            return endpoint
+        except socket.error, err:
+            logging.debug("No netconsole broker : %s", err)
+    return NetconsoleEndpoint(loop, port, bind_addr)
+
+
+def main():
+    ''' run the netconsole broker '''
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket", dest="path", action="store",
+                        default=BROKER_SOCKET,
+                        help="Unix socket the sessions connect to.\n"
+                        "Default is %s." % BROKER_SOCKET)
+    parser.add_argument("-b", "--bind", dest="bind_addr", action="store",
+                        default='',
+                        help="Bind the netconsole port on this address only.")
+    parser.add_argument("-D", "--debug", dest="loglevel", action="store_const",
+                        const=logging.DEBUG, default=logging.INFO,
+                        help="Output debugging information")
+    options = parser.parse_args()
+    logging.basicConfig(level=options.loglevel, format='%(message)s')
+
+    loop = EventLoop()
+    broker = NetconsoleBroker(loop, bind_addr=options.bind_addr,
+                              path=options.path)
+    try:
+        broker.start()
+    except (socket.error, OSError), err:
+        logging.error("Can't start the broker : %s", err)
+        broker.close()
+        return 1
+    logging.info("Sharing the netconsole port %d on %s", broker.port,
+                 options.path)
+    # Remove the Unix socket when we are told to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        loop.run_forever()
+    finally:
+        broker.close()
+        loop.close()
+    return 0
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,219 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+capsule reads LaCie .capsule firmware files : an XML header ended by
+</Capsule>, followed by a tar of the images, read straight from a mmap.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import mmap
+import os
+import shutil
+import sys
+import tarfile
+from xml.etree import ElementTree
+sys.dont_write_bytecode = True
+
+END_TAG = '</Capsule>'
+
+
+class MapFile(object):
+    '''
+    A read-only file object over a part of a mmap, starting at offset,
+    so tarfile can read the archive in place.
+    '''
+
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = offset
+        self.position = 0
+        self.size = len(data) - offset
+
+    def read(self, size=-1):
+        if size < 0 or self.position + size > self.size:
+            size = self.size - self.position
+        start = self.offset + self.position
+        self.position += size
+        return self.data[start:start + size]
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.size
+        self.position = min(max(position, 0), self.size)
+
+    def tell(self):
+        return self.position
+
+
+def parse_header(header):
+    '''
+    Flatten the XML header into a dict : the attributes of <Capsule>, then
+    the text and attributes of every element under it (tag.attribute).
+    '''
+    try:
+        root = ElementTree.fromstring(header[header.find('<Capsule'):])
+    except (ElementTree.ParseError, ValueError), err:
+        logging.error("Can't parse the capsule header : %s", err)
+        return {}
+    metadata = dict(root.attrib)
+    for element in root.iter():
+        if element is root:
+            continue
+        if element.text is not None and element.text.strip():
+            metadata[element.tag] = element.text.strip()
+        for name, value in element.attrib.items():
+            metadata['%s.%s' % (element.tag, name)] = value
+    return metadata
+
+
+class Capsule(object):
+    '''
+    A .capsule firmware file. Its header is parsed as soon as it is opened,
+    so the image can be checked before anything is extracted.
+    When the tar is not compressed, every member is available in place, as
+    a buffer over the mmap of the capsule.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        end = self.data.find(END_TAG)
+        if end < 0:
+            self.close()
+            raise ValueError("%s is not a capsule, no %s found." %
+                             (path, END_TAG))
+        # The tar starts on the line after the end of the header.
+        line_end = self.data.find('\n', end)
+        if line_end < 0:
+            line_end = len(self.data) - 1
+        self.offset = line_end + 1
+        self.header = self.data[:self.offset]
+        self.metadata = parse_header(self.data[:end + len(END_TAG)])
+
+        magic = self.data[self.offset:self.offset + 3]
+        self.compressed = magic[:2] == '\x1f\x8b' or magic == 'BZh'
+
+    def _tar(self):
+        '''Open the tar of the capsule, in one pass if it is compressed.'''
+        if self.compressed:
+            return tarfile.open(fileobj=MapFile(self.data, self.offset),
+                                mode='r|*')
+        return tarfile.open(fileobj=MapFile(self.data, self.offset),
+                            mode='r:')
+
+    def members(self):
+        '''
+        Return the TarInfo of every member of the capsule.
+        '''
+        tar = self._tar()
+        try:
+            return [member for member in tar]
+        finally:
+            tar.close()
+
+    def files(self):
+        '''
+        Yield (name, content) for every regular file of the capsule.
+        Contents are buffers over the mmap when the tar is not compressed,
+        strings read from the stream otherwise.
+        '''
+        tar = self._tar()
+        try:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if self.compressed:
+                    yield member.name, tar.extractfile(member).read()
+                else:
+                    yield member.name, buffer(self.data,
+                                              self.offset + member.offset_data,
+                                              member.size)
+        finally:
+            tar.close()
+
+    def serve(self, server):
+        '''
+        Add every file of the capsule to a TftpServer, under its basename.
+        Return the names served.
+        '''
+        names = []
+        for name, content in self.files():
+            server.add_file(os.path.basename(name), content)
+            names.append(os.path.basename(name))
+        return names
+
+    def extract(self, destination):
+        '''
+        Stream every member of the capsule to destination, without any
+        temporary copy.
+        Return the paths created, to clean them up afterwards.
+        '''
+        created = []
+        tar = self._tar()
+        try:
+            for member in tar:
+                name = os.path.normpath(member.name)
+                if name == '.':
+                    continue
+                if os.path.isabs(name) or name.startswith('..'):
+                    logging.error("Skipping %s, it is outside of the "
+                                  "capsule." % member.name)
+                    continue
+                path = os.path.join(destination, name)
+                if member.isdir():
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                elif member.isfile():
+                    directory = os.path.dirname(path)
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    with open(path, 'wb') as target:
+                        if self.compressed:
+                            shutil.copyfileobj(tar.extractfile(member),
+                                               target, 1024 * 1024)
+                        else:
+                            target.write(buffer(
+                                self.data, self.offset + member.offset_data,
+                                member.size))
+                    os.chmod(path, member.mode & 0777)
+                else:
+                    continue
+                created.append(path)
+        finally:
+            tar.close()
+        return created
+
+    def close(self):
+        self.data.close()
+        self.file.close()
@@ -0,0 +1,318 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+capture records the datagrams of a session to a pcap file and plays them back.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import socket
+from struct import pack, unpack, unpack_from, Struct
+import sys
+from time import time
+sys.dont_write_bytecode = True
+
+from protocol import parse_lump
+
+PCAP_HEADER = Struct('<IHHiIII')
+RECORD = Struct('<IIII')
+IPV4 = Struct('!BBHHHBBH4s4s')
+UDP = Struct('!HHHH')
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+# Bytes before the IP header, for each link type we read
+LINK_HEADERS = {LINKTYPE_ETHERNET: 14, LINKTYPE_RAW: 0,
+                LINKTYPE_LINUX_SLL: 16, LINKTYPE_IPV4: 0}
+
+
+def checksum(header):
+    '''The checksum of an IPv4 header.'''
+    total = sum(unpack('!%dH' % (len(header) / 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+class PcapWriter(object):
+    '''
+    Writes UDP datagrams to a pcap file, as Ethernet frames like the ones of
+    doc/lump.pcap. host is our IP, written instead of 0.0.0.0 when a socket
+    is bound on every address.
+    Give it to an endpoint as its capture to record what it sends and
+    receives.
+    '''
+
+    def __init__(self, path, host='0.0.0.0'):
+        self.host = host
+        self.file = open(path, 'wb')
+        self.file.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535,
+                                         LINKTYPE_ETHERNET))
+        self.ident = 0
+        self.packets = 0
+
+    def _local(self, sock):
+        ip, port = sock.getsockname()
+        if ip == '0.0.0.0':
+            ip = self.host
+        return ip, port
+
+    def sent(self, sock, data, addr):
+        self.write(self._local(sock), addr, data)
+
+    def received(self, sock, data, addr):
+        self.write(addr, self._local(sock), data)
+
+    def write(self, src, dst, data, timestamp=None):
+        '''
+        Write the datagram data sent from src to dst, (ip, port) tuples.
+        '''
+        if timestamp is None:
+            timestamp = time()
+        self.ident = (self.ident + 1) & 0xffff
+        header = IPV4.pack(0x45, 0, IPV4.size + UDP.size + len(data),
+                           self.ident, 0, 64, socket.IPPROTO_UDP, 0,
+                           socket.inet_aton(src[0]), socket.inet_aton(dst[0]))
+        header = header[:10] + pack('!H', checksum(header)) + header[12:]
+        if dst[0] == '255.255.255.255' or dst[0].endswith('.255'):
+            ether = '\xff' * 6
+        else:
+            ether = '\0' * 6
+        frame = ''.join((ether, '\0' * 6, '\x08\x00', header,
+                         UDP.pack(src[1], dst[1], UDP.size + len(data), 0),
+                         data))
+        seconds = int(timestamp)
+        self.file.write(RECORD.pack(seconds,
+                                    int((timestamp - seconds) * 1000000),
+                                    len(frame), len(frame)))
+        self.file.write(frame)
+        self.packets += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_pcap(path):
+    '''
+    Return the UDP datagrams of a pcap file, as a list of
+    (timestamp, (src ip, src port), (dst ip, dst port), data).
+    Anything else, or a link type we don't know, is skipped.
+    '''
+    with open(path, 'rb') as capture:
+        content = capture.read()
+    magic = unpack_from('<I', content)[0]
+    if magic in (0xa1b2c3d4, 0xa1b23c4d):
+        order = '<'
+    elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+        order = '>'
+    else:
+        raise ValueError("%s is not a pcap file." % path)
+    # Nanosecond timestamps
+    fraction = 1e-9 if magic in (0xa1b23c4d, 0x4d3cb2a1) else 1e-6
+    linktype = unpack_from(order + 'I', content, 20)[0]
+    if linktype not in LINK_HEADERS:
+        raise ValueError("Unknown link type %d in %s." % (linktype, path))
+
+    datagrams = []
+    offset = PCAP_HEADER.size
+    while offset + RECORD.size <= len(content):
+        seconds, fractions, size, _ = unpack_from(order + 'IIII', content,
+                                                  offset)
+        offset += RECORD.size
+        frame = content[offset:offset + size]
+        offset += size
+
+        ip = LINK_HEADERS[linktype]
+        if linktype == LINKTYPE_ETHERNET and frame[12:14] != '\x08\x00':
+            continue
+        if linktype == LINKTYPE_LINUX_SLL and frame[14:16] != '\x08\x00':
+            continue
+        if len(frame) < ip + IPV4.size + UDP.size:
+            continue
+        fields = IPV4.unpack_from(frame, ip)
+        if fields[0] >> 4 != 4 or fields[6] != socket.IPPROTO_UDP:
+            continue
+        udp = ip + (fields[0] & 0xf) * 4
+        sport, dport, length, _ = UDP.unpack_from(frame, udp)
+        data = frame[udp + UDP.size:udp + length]
+        datagrams.append((seconds + fractions * fraction,
+                          (socket.inet_ntoa(fields[8]), sport),
+                          (socket.inet_ntoa(fields[9]), dport), data))
+    return datagrams
+
+
+class ReplayEndpoint(object):
+    '''
+    Stands for a socket bound on port during a replay. With a protocol, it
+    is a DatagramEndpoint, else a NetconsoleEndpoint shared by sessions.
+    '''
+
+    def __init__(self, replay, port, protocol=None):
+        self.replay = replay
+        self.port = port
+        self.protocol = protocol
+        self.sessions = {}
+        self.capture = None
+        self.sock = self
+
+    def register(self, ip, session):
+        self.sessions[ip] = session
+
+    def unregister(self, ip):
+        self.sessions.pop(ip, None)
+
+    def connect(self, ip):
+        pass
+
+    def read_ready(self):
+        pass
+
+    def sendto(self, data, addr):
+        self.replay.sent(self, data, addr)
+
+    def datagram_received(self, data, addr):
+        if self.protocol is not None:
+            self.protocol.datagram_received(data, addr)
+            return
+        session = self.sessions.get(addr[0])
+        if session is None and len(self.sessions) == 1:
+            # Replayed with another IP than the one recorded
+            session = self.sessions.values()[0]
+        if session is not None:
+            session.datagram_received(data)
+
+    def close(self):
+        self.replay.endpoints.discard(self)
+        self.sessions = {}
+        self.sock = None
+
+
+class Replay(object):
+    '''
+    Plays a capture back to the sessions of loop, instead of the network.
+    Each datagram a session sends is matched with the next one recorded from
+    the host to the same port, then the datagrams the device sent after it
+    in the capture are given back, with their recorded delays divided by
+    speed (at once if speed is 0).
+    So the device answers as it did, at the pace of the session under test.
+    host is our IP in the capture, guessed from the first LUMP or LOOK.
+    '''
+
+    def __init__(self, loop, path, speed=1.0, host=None):
+        self.loop = loop
+        self.path = path
+        self.speed = speed
+        # Our own broadcasts come back to us, they are not the device's
+        self.datagrams = [datagram for datagram in read_pcap(path)
+                          if datagram[1][0] != datagram[2][0]]
+        self.host = host or self.guess_host()
+        self.cursor = 0
+        self.started = loop.time()
+        self.endpoints = set()
+        self.played = 0
+        self.mismatches = 0
+        self.missing = 0
+
+    def guess_host(self):
+        for _, src, dst, _ in self.datagrams:
+            if dst[1] in (4445, 4446):
+                return src[0]
+        if self.datagrams:
+            return self.datagrams[0][1][0]
+        return None
+
+    def lump(self):
+        '''
+        Return (mac, ip, broadcast address) of the first LUMP recorded, or
+        None.
+        '''
+        for _, src, dst, data in self.datagrams:
+            if src[0] == self.host:
+                lump = parse_lump(data)
+                if lump is not None:
+                    return lump + (dst[0],)
+        return None
+
+    def endpoint(self, port, protocol=None):
+        '''
+        Return the endpoint of a socket bound on port, see ReplayEndpoint.
+        '''
+        endpoint = ReplayEndpoint(self, port, protocol)
+        self.endpoints.add(endpoint)
+        return endpoint
+
+    def sent(self, endpoint, data, addr):
+        found = None
+        for index in range(self.cursor, len(self.datagrams)):
+            _, src, dst, _ = self.datagrams[index]
+            if src[0] == self.host and dst[1] == addr[1]:
+                found = index
+                break
+        if found is None:
+            logging.debug("Replay : nothing recorded for %r to port %d",
+                          data, addr[1])
+            self.missing += 1
+            return
+        sent_at, _, _, recorded = self.datagrams[found]
+        if recorded != data:
+            logging.debug("Replay : sent %r, %r was recorded", data,
+                          recorded)
+            self.mismatches += 1
+
+        index = found + 1
+        while index < len(self.datagrams) and \
+                self.datagrams[index][1][0] != self.host:
+            timestamp = self.datagrams[index][0]
+            delay = (timestamp - sent_at) / self.speed if self.speed else 0
+            self.loop.call_later(max(delay, 0), self.deliver,
+                                 self.datagrams[index])
+            index += 1
+        self.cursor = index
+
+    def deliver(self, datagram):
+        _, src, dst, data = datagram
+        for endpoint in list(self.endpoints):
+            if endpoint.port == dst[1]:
+                self.played += 1
+                endpoint.datagram_received(data, src)
+                return
+
+    def report(self):
+        '''
+        Log how the session went along with the capture.
+        '''
+        logging.info("Replayed %d datagrams of %s in %.3fs, %d sent differ "
+                     "from the capture and %d were not recorded",
+                     self.played, self.path, self.loop.time() - self.started,
+                     self.mismatches, self.missing)
@@ -0,0 +1,364 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+discovery keeps looking for devices with IPCOMM and tells what it found to
+the local processes asking for it on a Unix socket.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+from time import time
+import sys
+sys.dont_write_bytecode = True
+
+from eventloop import DatagramEndpoint, EventLoop
+from network import is_valid_mac
+from protocol import LOOK_PACKET, parse_info
+
+DISCOVERY_SOCKET = '/var/run/lacie-uboot/discovery.sock'
+# Seconds a client has to read its answer
+SEND_TIMEOUT = 1.0
+
+
+class DeviceIndex(object):
+    '''
+    Every device seen, by MAC: its IP, name, the TLV fields of its last INFO
+    and when it was last seen. Devices silent for ttl seconds are forgotten.
+    '''
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.devices = {}
+
+    def update(self, info, addr):
+        mac = info.get('MAC', '').lower()
+        if not is_valid_mac(mac):
+            return None
+        # The fields are bytes from the network, keep them as latin-1 so any
+        # of them can be written as JSON, and read back with encode('latin-1')
+        info = dict((typ.decode('latin-1'), value.decode('latin-1'))
+                    for typ, value in info.items())
+        record = {'mac': mac,
+                  'ip': info.get('ADDR') or addr[0],
+                  'name': info.get('NAME', ''),
+                  'fields': info,
+                  'last_seen': time()}
+        if mac not in self.devices:
+            logging.debug("%s found at %s", mac, record['ip'])
+        self.devices[mac] = record
+        return record
+
+    def expire(self):
+        limit = time() - self.ttl
+        for mac, record in self.devices.items():
+            if record['last_seen'] < limit:
+                del self.devices[mac]
+
+    def lookup(self, mac):
+        return self.devices.get(mac.lower())
+
+    def records(self):
+        return sorted(self.devices.values(), key=lambda record: record['mac'])
+
+
+class InfoProtocol(object):
+    '''
+    Feeds every INFO answer to an index.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+
+    def datagram_received(self, data, addr):
+        info = parse_info(data)
+        if info is not None:
+            self.index.update(info, addr)
+
+
+class QueryServer(object):
+    '''
+    Answers the queries of local processes, one per connection :
+        GET <mac>   the record of a device, or null
+        LIST        every record
+        LOOK        broadcast a LOOK now, answers true
+    Every answer is a line of JSON, sent without blocking the loop : what
+    the client does not take at once is sent again a little later, for
+    SEND_TIMEOUT seconds at most.
+    '''
+
+    def __init__(self, loop, daemon, path=DISCOVERY_SOCKET):
+        self.loop = loop
+        self.daemon = daemon
+        self.path = path
+        self.clients = {}
+        # Clients still being answered, by fd
+        self.pending = {}
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.sock.setblocking(0)
+        loop.add_reader(self.sock.fileno(), self._accept)
+
+    def _accept(self):
+        try:
+            client, _ = self.sock.accept()
+        except socket.error, err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.debug("Accept error : %s", err)
+            return
+        client.setblocking(0)
+        self.clients[client.fileno()] = (client, [])
+        self.loop.add_reader(client.fileno(), self._read, client.fileno())
+
+    def _read(self, fd):
+        client, chunks = self.clients[fd]
+        try:
+            data = client.recv(256)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        chunks.append(data)
+        if data and '\n' not in data:
+            return
+        self.loop.remove_reader(fd)
+        del self.clients[fd]
+        request = ''.join(chunks).split('\n', 1)[0].split()
+        try:
+            answer = json.dumps(self.answer(request)) + '\n'
+        except (TypeError, ValueError), err:
+            logging.debug("Can't answer %s : %s", request, err)
+            answer = json.dumps({'error': str(err)}) + '\n'
+        self.pending[fd] = client
+        self._send(client, answer, self.loop.time() + SEND_TIMEOUT)
+
+    def _send(self, client, data, deadline):
+        '''
+        Send what the client takes of data, try again later with the rest.
+        '''
+        fd = client.fileno()
+        if self.pending.get(fd) is not client:
+            # We were closed meanwhile
+            return
+        try:
+            data = data[client.send(data):]
+        except socket.error, err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.debug("Query error : %s", err)
+                data = ''
+        if data and self.loop.time() < deadline:
+            self.loop.call_later(0.01, self._send, client, data, deadline)
+            return
+        if data:
+            logging.debug("A client did not read its answer, giving up.")
+        del self.pending[fd]
+        client.close()
+
+    def answer(self, request):
+        if request[:1] == ['GET'] and len(request) == 2:
+            return self.daemon.index.lookup(request[1])
+        if request == ['LIST']:
+            return self.daemon.index.records()
+        if request == ['LOOK']:
+            self.daemon.look()
+            return True
+        return {'error': 'unknown request'}
+
+    def close(self):
+        if self.sock is None:
+            return
+        for client, _ in self.clients.values():
+            self.loop.remove_reader(client.fileno())
+            client.close()
+        self.clients = {}
+        for client in self.pending.values():
+            client.close()
+        self.pending = {}
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class DiscoveryDaemon(object):
+    '''
+    Broadcasts a LOOK every interval seconds on the IPCOMM port, indexes
+    every INFO answer and serves the index on a Unix socket, unless path is
+    None.
+    '''
+
+    def __init__(self, loop, receive_port=4445, interval=5.0,
+                 path=DISCOVERY_SOCKET):
+        self.loop = loop
+        self.receive_port = receive_port
+        self.interval = interval
+        self.path = path
+        self.index = DeviceIndex()
+        self.endpoint = None
+        self.server = None
+        self._timer = None
+
+    def start(self):
+        '''
+        Open the sockets and start looking, raise socket.error if a port or
+        the Unix socket can't be used.
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            sock.bind(('', self.receive_port))
+        except socket.error:
+            sock.close()
+            raise
+        self.endpoint = DatagramEndpoint(self.loop, sock,
+                                         InfoProtocol(self.index))
+        if self.path is not None:
+            self.server = QueryServer(self.loop, self, self.path)
+        self._tick()
+
+    def look(self):
+        '''
+        Broadcast a LOOK now.
+        '''
+        if self.endpoint is not None:
+            self.endpoint.sendto(LOOK_PACKET,
+                                 ('255.255.255.255', self.receive_port))
+
+    def _tick(self):
+        self.index.expire()
+        self.look()
+        self._timer = self.loop.call_later(self.interval, self._tick)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        if self.endpoint is not None:
+            self.endpoint.close()
+            self.endpoint = None
+
+
+def query(request, path=DISCOVERY_SOCKET, timeout=1.0):
+    '''
+    Send a request to the discovery daemon and return its answer.
+    Raise socket.error if no daemon is listening on path.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(request + '\n')
+        chunks = []
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    try:
+        return json.loads(''.join(chunks))
+    except ValueError:
+        raise socket.error("Bad answer from the discovery daemon.")
+
+
+def find_device(mac, ip=None, since=0, path=DISCOVERY_SOCKET):
+    '''
+    Return the IP of mac if the discovery daemon saw it after since, and
+    at ip if given, else None.
+    Raise socket.error if the daemon is not running.
+    '''
+    record = query('GET %s' % mac, path)
+    if record is None or record['last_seen'] < since:
+        return None
+    if ip is not None and record['ip'].lower() != ip.lower():
+        return None
+    return str(record['ip'])
+
+
+def main():
+    ''' run the discovery daemon '''
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket", dest="path", action="store",
+                        default=DISCOVERY_SOCKET,
+                        help="Unix socket to answer queries on.\n"
+                        "Default is %s." % DISCOVERY_SOCKET)
+    parser.add_argument("-n", "--interval", dest="interval", action="store",
+                        type=float, default=5.0,
+                        help="Seconds between two LOOK broadcasts.\n"
+                        "Default is 5.")
+    parser.add_argument("-D", "--debug", dest="loglevel", action="store_const",
+                        const=logging.DEBUG, default=logging.INFO,
+                        help="Output debugging information")
+    options = parser.parse_args()
+    logging.basicConfig(level=options.loglevel, format='%(message)s')
+
+    loop = EventLoop()
+    daemon = DiscoveryDaemon(loop, interval=options.interval,
+                             path=options.path)
+    try:
+        daemon.start()
+    except (socket.error, OSError), err:
+        logging.error("Can't start the discovery : %s", err)
+        return 1
+    logging.info("Looking for devices every %.1fs, queries on %s",
+                 options.interval, options.path)
+    # Remove the Unix socket when we are told to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        loop.run_forever()
+    finally:
+        daemon.close()
+        loop.close()
+    return 0
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,591 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+emulator pretends to be the U-Boot netconsole of some LaCie devices, on the
+loopback or in a network namespace, to try and measure lacie-uboot without
+any hardware.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import random
+import signal
+import socket
+from struct import pack, unpack
+import sys
+sys.dont_write_bytecode = True
+
+from eventloop import DatagramEndpoint, EventLoop
+from protocol import info_packet, parse_lump, LOOK_PACKET
+from tftp import DEFAULT_BLKSIZE, MAX_BLKSIZE, OP_ACK, OP_DATA, OP_ERROR, \
+    OP_OACK, OP_RRQ
+
+PROMPT = "Marvell>> "
+
+VERSION = "U-Boot 2009.11-emulator (Dec 26 2012 - 12:00:00)"
+
+
+class Device(object):
+    '''
+    One emulated U-Boot. A LUMP with its MAC gives it an IP, then it listens
+    to its netconsole on that IP until it is reset.
+    '''
+
+    def __init__(self, emulator, mac, name):
+        self.emulator = emulator
+        self.mac = mac
+        self.name = name
+        self.ip = None
+        self.host = None
+        self.endpoint = None
+        self.line = []
+        self.commands = 0
+        self.env = {}
+        self.transfer = None
+        # Built with CONFIG_MCAST_TFTP, asks for the multicast option
+        self.multicast = False
+
+    def lump(self, ip, host):
+        '''
+        Take ip, as asked by a LUMP sent by host.
+        Raise socket.error if ip can't be bound.
+        '''
+        self.host = host
+        if self.endpoint is not None and ip == self.ip:
+            return
+        self.reset()
+        self.endpoint = DatagramEndpoint(
+            self.emulator.loop,
+            self.emulator.bind(ip, self.emulator.uboot_port), self)
+        self.ip = ip
+        logging.debug("%s caught at %s", self.mac, ip)
+
+    def reset(self):
+        if self.transfer is not None:
+            self.transfer.cancel()
+            self.transfer = None
+        if self.endpoint is not None:
+            self.endpoint.close()
+            self.endpoint = None
+        self.ip = None
+        self.line = []
+        self.env = {}
+
+    def send(self, data):
+        if self.host is not None:
+            self.emulator.send(self.endpoint,
+                               data, (self.host, self.emulator.uboot_port))
+
+    def interrupt(self):
+        self.send("<INTERRUPT>\n")
+        self.send(PROMPT)
+
+    def datagram_received(self, data, addr):
+        if self.emulator.lost():
+            return
+        self.host = addr[0]
+        if data == '\3':
+            self.interrupt()
+            return
+        # U-Boot echoes the command one character per datagram
+        for char in data:
+            self.send(char)
+            if char == '\n':
+                self.execute(''.join(self.line).strip())
+                self.line = []
+            else:
+                self.line.append(char)
+
+    def execute(self, line):
+        # Like U-Boot, run every command of the line, ; separated
+        self.run(line.split(';'))
+
+    def run(self, commands):
+        '''
+        Run commands one after the other, then give the prompt. A tftp
+        command runs the rest once its transfer is over.
+        '''
+        while commands:
+            cmd = commands.pop(0).strip()
+            name = cmd.split(None, 1)[0] if cmd else ''
+            if cmd in ('reset', 'bootm'):
+                logging.debug("%s %s", self.mac, cmd)
+                self.reset()
+                return
+            self.commands += 1
+            if cmd == 'version':
+                self.send(VERSION + "\n")
+            elif cmd.startswith('echo '):
+                self.send(cmd[5:] + "\n")
+            elif name == 'setenv':
+                fields = cmd.split(None, 2)
+                if len(fields) == 3:
+                    self.env[fields[1]] = fields[2]
+                elif len(fields) == 2:
+                    self.env.pop(fields[1], None)
+            elif name == 'tftp':
+                self.tftp(cmd.split()[1:], commands)
+                return
+            elif cmd:
+                self.send("%s : done\n" % cmd)
+                for output in self.emulator.output:
+                    self.send(output)
+        self.send(PROMPT)
+
+    def tftp(self, args, commands):
+        '''
+        tftp [addr] file : load file from serverip, then run commands.
+        '''
+        if not args or 'serverip' not in self.env:
+            self.send("*** ERROR: `serverip' not set\n")
+            self.run(commands)
+            return
+        filename = args[-1]
+        self.send("Filename '%s'.\nLoading: " % filename)
+
+        def done(size):
+            self.transfer = None
+            if size is None:
+                self.send("\nRetry count exceeded; giving up\n")
+            else:
+                self.send("#\ndone\nBytes transferred = %d (%x hex)\n" %
+                          (size, size))
+            self.run(commands)
+
+        server = (self.env['serverip'], int(self.env.get('tftpdstp', 69)))
+        self.transfer = TftpClient(self, server, filename, done)
+
+
+class TftpClient(object):
+    '''
+    The TFTP client of an emulated U-Boot. It reads filename from server
+    with the tftpblocksize, tftpwindowsize, tftptimeout (ms) and
+    tftptimeoutcountmax of the environment of device, and throws the data
+    away. done is called with the bytes received, or None if it gave up.
+    A device with multicast asks for the multicast option of RFC 2090 : until
+    it is the master client, it keeps the blocks it hears from the group
+    without acknowledging them.
+    '''
+
+    def __init__(self, device, server, filename, done):
+        self.device = device
+        self.emulator = device.emulator
+        self.loop = device.emulator.loop
+        self.server = server
+        self.tid = None  # The port of the server the transfer goes on with
+        self.done = done
+        env = device.env
+        self.blksize = DEFAULT_BLKSIZE
+        self.windowsize = 1
+        self.timeout = int(env.get('tftptimeout', 5000)) / 1000.0
+        self.max_retries = int(env.get('tftptimeoutcountmax', 10))
+        self.retries = 0
+        self.expected = 1  # Next block awaited
+        self.in_window = 0
+        self.gap = None  # Block awaited when we last asked for it again
+        self.received = 0
+        self.timer = None
+        self.group = None  # The endpoint listening to the multicast group
+        self.have = None  # Blocks received, with multicast
+        self.last_block = None
+        self.master = True
+
+        options = ''
+        if 'tftpblocksize' in env:
+            options += 'blksize\0%s\0' % env['tftpblocksize']
+        if 'tftpwindowsize' in env:
+            options += 'windowsize\0%s\0' % env['tftpwindowsize']
+        if device.multicast:
+            options += 'multicast\0\0'
+        self.request = pack('!H', OP_RRQ) + filename + '\0octet\0' + options
+        self.last = self.request
+        self.endpoint = DatagramEndpoint(
+            self.loop, self.emulator.bind(device.ip, 0), self,
+            recv_size=MAX_BLKSIZE + 4)
+        self.send(self.request)
+
+    def send(self, data):
+        self.last = data
+        self.emulator.send(self.endpoint, data, self.server)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(self.timeout, self.expired)
+
+    def ack(self, block):
+        self.in_window = 0
+        self.send(pack('!HH', OP_ACK, block & 0xFFFF))
+
+    def expired(self):
+        if not self.master:
+            # Others are served meanwhile, wait for our turn
+            self.timer = self.loop.call_later(self.timeout, self.expired)
+            return
+        self.retries += 1
+        if self.retries > self.max_retries:
+            self.finish(None)
+            return
+        self.send(self.last)
+
+    def datagram_received(self, data, addr):
+        if self.done is None or self.emulator.lost() or len(data) < 4:
+            return
+        # The transfer goes on with the port of the server which answered
+        # first, the others answered a request sent again
+        if self.tid is None:
+            self.tid = self.server = addr
+        elif addr != self.tid:
+            return
+        opcode, block = unpack('!HH', data[:4])
+        if opcode == OP_ERROR:
+            self.finish(None)
+            return
+        if opcode == OP_OACK:
+            fields = data[2:].split('\0')
+            options = dict(zip(fields[0::2], fields[1::2]))
+            self.blksize = int(options.get('blksize', self.blksize))
+            self.windowsize = int(options.get('windowsize', 1))
+            if options.get('multicast'):
+                self.multicast_oack(options['multicast'])
+            else:
+                self.ack(0)
+            return
+        if opcode != OP_DATA:
+            return
+        if self.have is not None:
+            self.multicast_block(block, data)
+            return
+        if block != self.expected & 0xFFFF:
+            # Our last ACK was lost and the window comes again, or a block
+            # of the window was lost : ask again after the last block we
+            # have, once per gap
+            if block == (self.expected - 1) & 0xFFFF or \
+                    self.gap != self.expected:
+                self.gap = self.expected
+                self.ack(self.expected - 1)
+            return
+        self.retries = 0
+        self.received += len(data) - 4
+        self.expected += 1
+        self.in_window += 1
+        if len(data) - 4 < self.blksize:
+            self.ack(block)
+            self.finish(self.received)
+        elif self.in_window >= self.windowsize:
+            self.ack(block)
+
+    def multicast_oack(self, value):
+        '''
+        Join the group of the OACK, the first time, then acknowledge the last
+        block we have in sequence if we are the master client.
+        '''
+        group, port, master = value.split(',')
+        if self.group is None:
+            sock = self.emulator.bind(group, int(port))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(group) +
+                            socket.inet_aton(self.device.ip))
+            self.group = DatagramEndpoint(self.loop, sock, self,
+                                          recv_size=MAX_BLKSIZE + 4)
+            self.have = set()
+        self.master = master == '1'
+        if self.master:
+            self.retries = 0
+            self.ack(self.expected - 1)
+            if self.complete():
+                self.finish(self.received)
+
+    def complete(self):
+        return self.last_block is not None and self.expected > self.last_block
+
+    def multicast_block(self, block, data):
+        if block not in self.have:
+            self.have.add(block)
+            self.received += len(data) - 4
+            if len(data) - 4 < self.blksize:
+                self.last_block = block
+        while self.expected in self.have:
+            self.expected += 1
+        if not self.master:
+            return
+        self.retries = 0
+        if self.complete():
+            self.ack(self.expected - 1)
+            self.finish(self.received)
+        elif block > self.expected:
+            # A block was lost, ask again after the last one we have, once
+            if self.gap != self.expected:
+                self.gap = self.expected
+                self.ack(self.expected - 1)
+        else:
+            # Blocks we had as a listener count too, the ACK at the end of
+            # the window skips them
+            self.in_window += 1
+            if self.in_window >= self.windowsize:
+                self.ack(self.expected - 1)
+
+    def cancel(self):
+        '''Stop the transfer and forget it, the device is being reset.'''
+        if self.done is not None:
+            self.done = lambda size: None
+            self.finish(None)
+
+    def finish(self, size):
+        if self.done is None:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        done, self.done = self.done, None
+        # The last ACK is sent after the latency
+        self.loop.call_later(self.emulator.latency, self.endpoint.close)
+        if self.group is not None:
+            self.group.close()
+        done(size)
+
+
+class Emulator(object):
+    '''
+    Some devices behind a fake segment address, it stands for the broadcast
+    address of the network : LUMP, broadcast Ctrl-C and LOOK packets are sent
+    to it. Every command outputs output bytes, width bytes per datagram (one
+    per line when None, like printf()), every datagram sent by a device
+    is delayed by latency seconds, and loss is the probability for any
+    datagram to be dropped. The first multicast devices ask for multicast
+    TFTP.
+    '''
+
+    def __init__(self, loop, devices=1, segment='127.0.0.2', output=256,
+                 latency=0.0, loss=0.0, seed=None, width=None, multicast=0):
+        self.loop = loop
+        self.segment = segment
+        self.send_port = 4446
+        self.receive_port = 4445
+        self.uboot_port = 6666
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.devices = [Device(self, device_mac(index), "emu-%d" % index)
+                        for index in range(devices)]
+        for device in self.devices[:multicast]:
+            device.multicast = True
+        self.output = output_lines(output)
+        if width is not None:
+            text = ''.join(self.output)
+            self.output = [text[offset:offset + width]
+                           for offset in range(0, len(text), width)]
+        self.endpoints = []
+        self.dropped = 0
+
+    def bind(self, ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            sock.bind((ip, port))
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def start(self):
+        '''
+        Bind the ports of the segment, raise socket.error if one is taken.
+        '''
+        for port, callback in ((self.send_port, self.lump_received),
+                               (self.uboot_port, self.console_received),
+                               (self.receive_port, self.look_received)):
+            self.endpoints.append(DatagramEndpoint(
+                self.loop, self.bind(self.segment, port),
+                Handler(callback)))
+
+    def lost(self):
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return True
+        return False
+
+    def send(self, endpoint, data, addr):
+        if self.lost():
+            return
+        if self.latency:
+            self.loop.call_later(self.latency, self._send, endpoint, data, addr)
+        else:
+            self._send(endpoint, data, addr)
+
+    def _send(self, endpoint, data, addr):
+        # The device may have been reset in the meantime
+        if endpoint is not None and endpoint.sock is not None:
+            endpoint.sendto(data, addr)
+
+    def lump_received(self, data, addr):
+        lump = parse_lump(data)
+        if lump is None or self.lost():
+            return
+        mac, ip = lump
+        if mac == "00:00:00:00:00:00":
+            # The first device to reboot is caught
+            idle = [device for device in self.devices if device.ip is None]
+            if not idle:
+                return
+            device = idle[0]
+        else:
+            device = self.find(mac)
+            if device is None:
+                return
+        try:
+            device.lump(ip, addr[0])
+        except socket.error, err:
+            logging.error("%s can't take %s : %s", device.mac, ip, err)
+
+    def console_received(self, data, addr):
+        if data != '\3' or self.lost():
+            return
+        for device in self.devices:
+            if device.ip is not None:
+                device.host = addr[0]
+                device.interrupt()
+
+    def look_received(self, data, addr):
+        if data != LOOK_PACKET or self.lost():
+            return
+        for device in self.devices:
+            if device.ip is None:
+                continue
+            self.send(self.endpoints[2], info_packet([
+                ("MAC ", device.mac),
+                ("ADDR", device.ip),
+                ("NAME", device.name)]), (addr[0], self.receive_port))
+
+    def find(self, mac):
+        for device in self.devices:
+            if device.mac == mac.lower():
+                return device
+        return None
+
+    def close(self):
+        for device in self.devices:
+            device.reset()
+        for endpoint in self.endpoints:
+            endpoint.close()
+        self.endpoints = []
+
+
+class Handler(object):
+    '''
+    Gives the datagrams of an endpoint to a callback.
+    '''
+
+    def __init__(self, callback):
+        self.datagram_received = callback
+
+
+def device_mac(index):
+    '''
+    MAC of the index-th emulated device, in the LaCie range.
+    '''
+    return "00:d0:4b:%02x:%02x:%02x" % ((index + 1) >> 16 & 0xff,
+                                        (index + 1) >> 8 & 0xff,
+                                        (index + 1) & 0xff)
+
+
+def output_lines(size, width=64):
+    '''
+    Lines of text adding up to size bytes, one datagram each like printf().
+    '''
+    lines = []
+    while size > 0:
+        length = min(width, size)
+        lines.append('x' * (length - 1) + '\n')
+        size -= length
+    return lines
+
+
+def main():
+    ''' run the emulator '''
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--devices", dest="devices", action="store",
+                        type=int, default=1,
+                        help="Number of devices to emulate. Default is 1.")
+    parser.add_argument("-s", "--segment", dest="segment", action="store",
+                        default="127.0.0.2",
+                        help="Address standing for the broadcast address.\n"
+                        "Default is 127.0.0.2.")
+    parser.add_argument("-o", "--output", dest="output", action="store",
+                        type=int, default=256,
+                        help="Bytes output by each command. Default is 256.")
+    parser.add_argument("-w", "--width", dest="width", action="store",
+                        type=int, default=None,
+                        help="Bytes of output per datagram, 1 like putc().\n"
+                        "Default is one line per datagram.")
+    parser.add_argument("-l", "--latency", dest="latency", action="store",
+                        type=float, default=0.0,
+                        help="Seconds added before each datagram is sent.")
+    parser.add_argument("-L", "--loss", dest="loss", action="store",
+                        type=float, default=0.0,
+                        help="Probability for a datagram to be dropped.")
+    parser.add_argument("-M", "--multicast", dest="multicast", action="store",
+                        type=int, default=0, metavar="COUNT",
+                        help="The first COUNT devices ask for multicast TFTP.")
+    parser.add_argument("--seed", dest="seed", action="store", type=int,
+                        default=None, help="Seed of the losses.")
+    parser.add_argument("-D", "--debug", dest="loglevel", action="store_const",
+                        const=logging.DEBUG, default=logging.INFO,
+                        help="Output debugging information")
+    options = parser.parse_args()
+    logging.basicConfig(level=options.loglevel, format='%(message)s')
+
+    loop = EventLoop()
+    emulator = Emulator(loop, options.devices, options.segment,
+                        options.output, options.latency, options.loss,
+                        options.seed, options.width, options.multicast)
+    try:
+        emulator.start()
+    except socket.error, err:
+        logging.error("Can't emulate on %s : %s", options.segment, err)
+        return 1
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Tell whoever started us that we are listening
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    try:
+        loop.run_forever()
+    finally:
+        emulator.close()
+        loop.close()
+    return 0
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
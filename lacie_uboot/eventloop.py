@@ -0,0 +1,421 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+eventloop is a small single-threaded event loop running coroutines, it lets
+one process drive many netconsoles without a thread per device.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import deque
+import ctypes
+import errno
+import heapq
+import logging
+import select
+import socket
+import sys
+import time
+import types
+sys.dont_write_bytecode = True
+
+
+def _clock_gettime():
+    '''Return a monotonic clock from libc, or None if there is none.'''
+    clock_id = {'linux2': 1, 'darwin': 6}.get(sys.platform)
+    if clock_id is None:
+        return None
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        # The libc is already loaded, looking for it costs a process
+        clock_gettime = ctypes.CDLL(None, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        from ctypes.util import find_library
+        try:
+            libc = ctypes.CDLL(find_library('c'), use_errno=True)
+            clock_gettime = libc.clock_gettime
+        except (OSError, AttributeError):
+            return None
+
+    def monotonic():
+        spec = Timespec()
+        if clock_gettime(clock_id, ctypes.byref(spec)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = _clock_gettime() or time.time
+
+
+class Return(StopIteration):
+    '''
+    A generator can't return a value in Python 2,
+    a coroutine ends with raise Return(value) instead.
+    '''
+
+    def __init__(self, value=None):
+        StopIteration.__init__(self)
+        self.value = value
+
+
+class CancelledError(Exception):
+    pass
+
+
+class Future(object):
+    '''
+    The result of an operation which is not done yet.
+    A coroutine waits for it with yield.
+    '''
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError("Result is not ready.")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def set_result(self, result):
+        if self._done:
+            return
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc, exc_info=None):
+        if self._done:
+            return
+        self._exc_info = exc_info or (type(exc), exc, None)
+        self._finish()
+
+    def cancel(self):
+        self.set_exception(CancelledError())
+
+    def add_done_callback(self, callback):
+        if self._done:
+            self.loop.call_soon(callback, self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self):
+        self._done = True
+        for callback in self._callbacks:
+            self.loop.call_soon(callback, self)
+        self._callbacks = []
+
+
+class Task(Future):
+    '''
+    Runs a coroutine (a generator yielding futures or other coroutines)
+    on the loop, its result is the value given to Return.
+    Cancelling it cancels the coroutine it is waiting for, if any.
+    '''
+
+    def __init__(self, loop, coro):
+        Future.__init__(self, loop)
+        self.coro = coro
+        # The task of the coroutine we are waiting for
+        self._child = None
+        loop.call_soon(self._step, None, None)
+
+    def cancel(self):
+        if not self._done:
+            if self._child is not None:
+                self._child.cancel()
+                self._child = None
+            self.coro.close()
+        Future.cancel(self)
+
+    def _step(self, value, exc_info):
+        if self._done:
+            return
+        self._child = None
+        try:
+            if exc_info is not None:
+                yielded = self.coro.throw(*exc_info)
+            else:
+                yielded = self.coro.send(value)
+        except Return, ret:
+            self.set_result(ret.value)
+            return
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception, exc:
+            self.set_exception(exc, sys.exc_info())
+            return
+
+        if isinstance(yielded, types.GeneratorType):
+            yielded = self._child = Task(self.loop, yielded)
+        if yielded is None:
+            # A bare yield gives the other tasks a chance to run.
+            self.loop.call_soon(self._step, None, None)
+            return
+        yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        try:
+            value = future.result()
+        except Exception:
+            self._step(None, sys.exc_info())
+        else:
+            self._step(value, None)
+
+
+class Handle(object):
+    '''A callback scheduled on the loop, it can be cancelled.'''
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if not self.cancelled:
+            self.callback(*self.args)
+
+
+class EventLoop(object):
+    '''
+    Runs callbacks, timers and coroutines, and watches file descriptors with
+    epoll (or select where epoll is not available).
+    '''
+
+    def __init__(self):
+        self._ready = deque()
+        self._timers = []
+        self._sequence = 0
+        self._readers = {}
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+        self._stopping = False
+
+    def time(self):
+        return monotonic()
+
+    def call_soon(self, callback, *args):
+        handle = Handle(callback, args)
+        self._ready.append(handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        handle = Handle(callback, args)
+        self._sequence += 1
+        heapq.heappush(self._timers,
+                       (self.time() + delay, self._sequence, handle))
+        return handle
+
+    def add_reader(self, fd, callback, *args):
+        if fd in self._readers:
+            self.remove_reader(fd)
+        self._readers[fd] = Handle(callback, args)
+        if self._epoll is not None:
+            self._epoll.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is None:
+            return
+        if self._epoll is not None:
+            try:
+                self._epoll.unregister(fd)
+            except (IOError, ValueError):
+                pass
+
+    def create_task(self, coro):
+        return Task(self, coro)
+
+    def sleep(self, delay, result=None):
+        '''Return a future done after delay seconds.'''
+        future = Future(self)
+        self.call_later(delay, future.set_result, result)
+        return future
+
+    def wait(self, futures, timeout=None):
+        '''
+        Return a future done when every future is done, or after timeout
+        seconds. Its result tells if every future is done.
+        '''
+        waiter = Future(self)
+        pending = [future for future in futures if not future.done()]
+        if not pending:
+            waiter.set_result(True)
+            return waiter
+        counter = [len(pending)]
+
+        def one_done(_):
+            counter[0] -= 1
+            if counter[0] == 0:
+                waiter.set_result(True)
+        for future in pending:
+            future.add_done_callback(one_done)
+        if timeout is not None:
+            timer = self.call_later(timeout, waiter.set_result, False)
+            waiter.add_done_callback(lambda _: timer.cancel())
+        return waiter
+
+    def gather(self, coros):
+        '''Run every coroutine at once, the result is the list of results.'''
+        tasks = [self.create_task(coro) for coro in coros]
+        result = Future(self)
+
+        def collect(_):
+            try:
+                result.set_result([task.result() for task in tasks])
+            except Exception, exc:
+                result.set_exception(exc, sys.exc_info())
+        self.wait(tasks).add_done_callback(collect)
+        return result
+
+    def _poll(self, timeout):
+        if not self._readers:
+            if timeout:
+                time.sleep(timeout)
+            return []
+        try:
+            if self._epoll is not None:
+                if timeout is None:
+                    timeout = -1
+                return [fd for fd, _ in self._epoll.poll(timeout)]
+            return select.select(list(self._readers), [], [], timeout)[0]
+        except (IOError, OSError, select.error), err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def run_once(self):
+        '''
+        Wait for a file descriptor or the next timer, then run every callback
+        which is ready.
+        '''
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - self.time())
+
+        for fd in self._poll(timeout):
+            handle = self._readers.get(fd)
+            if handle is not None:
+                self._ready.append(handle)
+
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            self._ready.append(heapq.heappop(self._timers)[2])
+
+        for _ in range(len(self._ready)):
+            self._ready.popleft().run()
+
+    def run_until_complete(self, future):
+        '''Run the loop until future (or coroutine) is done.'''
+        if isinstance(future, types.GeneratorType):
+            future = self.create_task(future)
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+    def run_forever(self):
+        self._stopping = False
+        while not self._stopping:
+            self.run_once()
+
+    def stop(self):
+        self._stopping = True
+
+    def close(self):
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+
+
+class DatagramEndpoint(object):
+    '''
+    Feeds every datagram of a UDP socket to protocol.datagram_received(data,
+    addr) from the loop.
+    Every datagram sent and received is also given to capture, if set, see
+    capture.PcapWriter.
+    Longer datagrams than recv_size are truncated.
+    '''
+
+    def __init__(self, loop, sock, protocol, recv_size=2048):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.recv_size = recv_size
+        self.capture = None
+        sock.setblocking(0)
+        loop.add_reader(sock.fileno(), self.read_ready)
+
+    def read_ready(self):
+        '''Dispatch every datagram already waiting in the socket.'''
+        while self.sock is not None:
+            try:
+                data, addr = self.sock.recvfrom(self.recv_size)
+            except socket.error, err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # ICMP errors of a connected socket end up here.
+                    logging.debug("Receive error : %s", err)
+                break
+            if self.capture is not None:
+                self.capture.received(self.sock, data, addr)
+            self.protocol.datagram_received(data, addr)
+
+    def sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except socket.error, err:
+            logging.debug("Can't send to %s : %s", addr[0], err)
+            return
+        if self.capture is not None:
+            self.capture.sent(self.sock, data, addr)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
@@ -0,0 +1,813 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+fleet updates many devices at once from a manifest, with a pool of workers.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import csv
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+sys.dont_write_bytecode = True
+from collections import deque
+
+from asyncshell import AsyncUbootshell
+from broker import open_netconsole
+from capsule import Capsule
+from discovery import DiscoveryDaemon
+from eventloop import EventLoop, Future, Return
+from leases import LeaseRegistry, allocate_ips
+from metrics import Metrics
+from network import iface_info, is_valid_mac, is_valid_ipv4
+from pacing import CatchStrategy
+from pipeline import LINE_LIMIT
+from precheck import UpdateRegistry, device_state, image_crc32, \
+    image_digest, image_version, is_current
+from readiness import BootWatcher
+from tftp import MULTICAST_GROUP, TftpServer
+from tuning import TuningProfiles, settings_commands
+
+
+def image_kind(path):
+    '''
+    Return 'capsule' for a system image, 'uboot' for a .bin or .kwb U-Boot,
+    None for anything else.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.capsule':
+        return 'capsule'
+    if extension in ('.bin', '.kwb'):
+        return 'uboot'
+    return None
+
+
+def load_manifest(path):
+    '''
+    Read a manifest, either JSON (a list of {"mac": ..., "image": ...,
+    "ip": ...}) or CSV (mac,image[,ip] per line, # starts a comment and a
+    header line is allowed).
+    Image paths are relative to the manifest. Return a list of
+    (mac, image, ip) where ip may be None, raise ValueError if a line is
+    wrong.
+    '''
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, 'rb') as manifest:
+        content = manifest.read()
+
+    rows = []
+    if content.lstrip().startswith('['):
+        for number, entry in enumerate(json.loads(content), 1):
+            if not isinstance(entry, dict) or 'mac' not in entry or \
+                    'image' not in entry:
+                raise ValueError("Entry %d needs a mac and an image." % number)
+            rows.append((number, entry['mac'], entry['image'],
+                         entry.get('ip')))
+    else:
+        for number, row in enumerate(csv.reader(content.splitlines()), 1):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if number == 1 and row[0].lower() == 'mac':
+                continue
+            if len(row) < 2 or len(row) > 3:
+                raise ValueError("Line %d : mac,image[,ip] is awaited." %
+                                 number)
+            rows.append((number, row[0], row[1],
+                         row[2] if len(row) == 3 and row[2] else None))
+
+    devices = []
+    seen = set()
+    for number, mac, image, ip in rows:
+        mac = str(mac).lower()
+        if not is_valid_mac(mac):
+            raise ValueError("Entry %d : %s is not a MAC address." %
+                             (number, mac))
+        if mac in seen:
+            raise ValueError("Entry %d : %s is given twice." % (number, mac))
+        seen.add(mac)
+        if ip is not None and not is_valid_ipv4(str(ip)):
+            raise ValueError("Entry %d : %s is not an IPv4 address." %
+                             (number, ip))
+        devices.append((mac, os.path.join(base, str(image)),
+                        ip and str(ip)))
+    return devices
+
+
+class WorkerPool(object):
+    '''
+    Lets at most size coroutines through at once, in the order they came.
+    '''
+
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.free = size
+        self.waiting = deque()
+
+    def acquire(self):
+        '''Return a future done once a worker is ours.'''
+        future = Future(self.loop)
+        if self.free:
+            self.free -= 1
+            future.set_result(None)
+        else:
+            self.waiting.append(future)
+        return future
+
+    def release(self):
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+
+class Job(object):
+    '''
+    The update of one device, result is what is reported about it.
+    '''
+
+    def __init__(self, mac, image, ip):
+        self.mac = mac
+        self.image = image
+        self.ip = ip
+        self.session = None
+        self.result = {'mac': mac, 'ip': ip, 'image': image,
+                       'status': 'pending', 'exit': 1, 'timings': {}}
+
+    def fail(self, status, message):
+        logging.error("%s : %s", self.mac, message)
+        self.result['status'] = status
+        self.result['error'] = message
+
+
+class FleetUpdater(object):
+    '''
+    Updates every device of a manifest from one process. Every image is
+    staged once and served over TFTP by this process, every device is caught
+    at once when the shelf is rebooted, then at most jobs devices are
+    flashed and waited for at the same time.
+    A device already running its image is not flashed again, unless force
+    is set. To tell, its U-Boot version is read and, if crc_addr is set,
+    the CRC32 of its U-Boot (copied to crc_addr by flash_read first, if it
+    is not mapped there).
+    With tftp_root set, the images are put in the root of a running TFTP
+    server instead, and removed afterwards.
+    The scripts start with the TFTP settings found by tuning for the U-Boot
+    of each device, unless profiles is None.
+    With multicast, a (group, port), the devices asking for an image with
+    the multicast option of RFC 2090 get it at once, sent to the group. The
+    others get it one by one, all of them together within max_rate bytes per
+    second if it is set.
+    '''
+
+    def __init__(self, loop=None, jobs=8):
+        self.loop = loop or EventLoop()
+        self.pool = WorkerPool(self.loop, jobs)
+        self.iface = 'eth0'
+        self.host_ip = None
+        self.bcast_addr = None
+        self.bind_addr = ''
+        self.uboot_port = 6666
+        self.receive_port = 4445
+        self.tftp_port = 69
+        self.tftp_root = None
+        self.multicast = None
+        self.max_rate = None
+        self.lump_timeout = 120
+        self.script_timeout = 600
+        self.boot_timeout = 600
+        self.wait = True
+        self.force = False
+        self.pipeline = None
+        self.crc_addr = None
+        self.flash_read = None
+        self.debug = False
+        # Keyword arguments of the CatchStrategy of every device
+        self.catch = {}
+        self.leases = LeaseRegistry()
+        self.registry = UpdateRegistry()
+        self.profiles = TuningProfiles()
+        self.metrics = Metrics()
+        self.jobs = []
+        self.endpoint = None
+        self.server = None
+        self.discovery = None
+        self.capsules = []
+        # Files put in tftp_root, removed by close()
+        self.installed = []
+        self.staged = {}  # image -> names served, None if it failed
+        self.images = {}  # image -> kind, digest, size, version and crc32
+        self._served = {}  # name -> image
+
+    def setup_network(self, iface, devices):
+        '''
+        Read the network setup of iface, and find an IP for every device of
+        devices, a list of (mac, image, ip). Return 1 if we can't.
+        '''
+        try:
+            ip, mac, netmask, bcast = iface_info(iface)
+        except (IOError, TypeError):
+            logging.error("Your network interface is not reachable."
+                          " Is %s correct ?" % iface)
+            return 1
+        self.iface = iface
+        self.host_ip = ip
+        self.bcast_addr = bcast
+
+        used = [ip_target for _, _, ip_target in devices
+                if ip_target is not None]
+        missing = [mac_target for mac_target, _, ip_target in devices
+                   if ip_target is None]
+        given = {}
+        if missing:
+            if sys.platform == "darwin":
+                logging.error("You need to specify an IP to assign to "
+                              "each device.")
+                return 1
+            # Previous leases, then one ARP sweep for the other devices
+            start = self.metrics.now()
+            given = allocate_ips(self.leases, iface, ip, mac, netmask,
+                                 missing, exclude=used, metrics=self.metrics)
+            self.metrics.observe('free_ip', start)
+            if len(given) < len(missing):
+                logging.error("No free IP found on %s for every device.",
+                              iface)
+                return 1
+
+        for mac_target, image, ip_target in devices:
+            self.add_job(mac_target, image, ip_target or given[mac_target])
+
+    def add_job(self, mac, image, ip):
+        job = Job(mac, image, ip)
+        self.jobs.append(job)
+        return job
+
+    def _serve(self, name, content, image):
+        if self._served.get(name, image) != image:
+            raise ValueError("%s is also in %s" % (name, self._served[name]))
+        if self.server is not None:
+            self.server.add_file(name, content)
+        self._served[name] = image
+
+    def stage(self, image):
+        '''
+        Serve image over TFTP, once whatever the number of devices using it.
+        Return the names served, raise ValueError or IOError if we can't.
+        '''
+        if image in self.staged:
+            if self.staged[image] is None:
+                raise ValueError("%s could not be staged" % image)
+            return self.staged[image]
+
+        self.staged[image] = None
+        kind = image_kind(image)
+        if kind == 'uboot':
+            name = os.path.basename(image)
+            if name in self._served:
+                raise ValueError("%s is also in %s" % (name,
+                                                       self._served[name]))
+            if self.tftp_root is not None:
+                path = os.path.join(self.tftp_root, name)
+                shutil.copyfile(image, path)
+                self.installed.append(path)
+            else:
+                self.server.add_path(image, name)
+            self._served[name] = image
+            names = [name]
+        elif kind == 'capsule':
+            # The installer asks for its files by name, so they can't be
+            # renamed and two capsules can't serve the same names.
+            capsule = Capsule(image)
+            self.capsules.append(capsule)
+            names = []
+            for name, content in capsule.files():
+                name = os.path.basename(name)
+                self._serve(name, content, image)
+                names.append(name)
+            if self.tftp_root is not None:
+                self.installed.extend(capsule.extract(self.tftp_root))
+        else:
+            raise ValueError("%s is not a .capsule, .bin or .kwb" % image)
+
+        digest, size = image_digest(image)
+        self.images[image] = {'kind': kind, 'digest': digest, 'size': size,
+                              'version': None, 'crc32': None}
+        if kind == 'uboot':
+            self.images[image]['version'] = image_version(image)
+            if self.crc_addr is not None:
+                self.images[image]['crc32'] = image_crc32(image)
+        self.staged[image] = names
+        return names
+
+    def tftp_settings(self, job):
+        '''
+        The TFTP settings tuned for the U-Boot of the device of job, {} if
+        there are none.
+        '''
+        if self.profiles is None or 'device' not in job.result:
+            return {}
+        try:
+            return self.profiles.lookup(job.result['device']['version'])
+        except (IOError, OSError), err:
+            logging.debug("Can't use the TFTP profiles %s : %s",
+                          self.profiles.path, err)
+            return {}
+
+    def script(self, job):
+        '''
+        The commands to run on the device of job, like lacie-nas-updater.
+        '''
+        settings = self.tftp_settings(job)
+        if settings:
+            job.result['tftp_settings'] = settings
+        commands = settings_commands(settings)
+        if image_kind(job.image) == 'uboot':
+            return commands + ["setenv serverip %s\n" % self.host_ip,
+                               "setenv ipaddr %s\n" % job.ip,
+                               "bubt %s\n" % os.path.basename(job.image),
+                               "y\n",
+                               "reset\n"]
+        return commands + ["setenv serverip %s\n" % self.host_ip,
+                           "setenv ipaddr %s\n" % job.ip,
+                           "tftp 0x800000 uImage\n",
+                           "set bootargs console=ttyS0,115200 "
+                           "tftp_server='%s' static_addr='%s'\n" %
+                           (self.host_ip, job.ip),
+                           "bootm\n"]
+
+    def start(self):
+        '''
+        Open the shared sockets, return False if we can't.
+        '''
+        try:
+            self.endpoint = open_netconsole(self.loop, self.uboot_port,
+                                            self.bind_addr)
+        except socket.error, err:
+            logging.error("Couldn't be a udp server on port %d : %s",
+                          self.uboot_port, err)
+            return False
+        if self.tftp_root is None:
+            try:
+                self.server = TftpServer(self.loop, self.host_ip,
+                                         self.tftp_port, self.multicast)
+            except socket.error, err:
+                logging.error("Can't serve TFTP on %s:%d : %s", self.host_ip,
+                              self.tftp_port, err)
+                return False
+            self.server.max_rate = self.max_rate
+        if self.wait:
+            # One LOOK for every device, instead of one per BootWatcher
+            self.discovery = DiscoveryDaemon(self.loop, self.receive_port,
+                                             interval=1.0, path=None)
+            try:
+                self.discovery.start()
+            except socket.error, err:
+                logging.debug("Each device looks for itself : %s", err)
+                self.discovery = None
+        return True
+
+    def run(self):
+        '''
+        Update every device, return 0 if all of them are up to date.
+        '''
+        return self.loop.run_until_complete(self._run())
+
+    def _run(self):
+        if not self.start():
+            self.close()
+            raise Return(1)
+
+        for job in self.jobs:
+            start = self.loop.time()
+            try:
+                self.stage(job.image)
+            except (ValueError, IOError, OSError), err:
+                job.fail('stage_failed', "Can't stage %s : %s" % (job.image,
+                                                                  err))
+            job.result['timings']['stage'] = self.loop.time() - start
+
+        jobs = [job for job in self.jobs if job.result['status'] == 'pending']
+        if jobs:
+            logging.info("Please /!\HARD/!\ reboot the %d devices "
+                         "/!\NOW/!\ ", len(jobs))
+        yield self.loop.gather([self._update(job) for job in jobs])
+        self.report_tftp()
+
+        for job in self.jobs:
+            for phase, seconds in job.result['timings'].items():
+                self.metrics.add_span('update_phase', seconds, mac=job.mac,
+                                      phase=phase)
+            self.metrics.count('updates', mac=job.mac,
+                               status=job.result['status'])
+        self.close()
+        if all(job.result['exit'] == 0 for job in self.jobs):
+            raise Return(0)
+        raise Return(1)
+
+    def _update(self, job):
+        '''
+        Catch the device of job, then wait for a worker to flash it and wait
+        for it to boot.
+        '''
+        session = AsyncUbootshell(self.loop, self.endpoint)
+        session.mac_target = job.mac
+        session.ip_target = job.ip
+        session.iface = self.iface
+        session.host_ip = self.host_ip
+        session.bcast_addr = self.bcast_addr
+        session.bind_addr = self.bind_addr
+        session.uboot_port = self.uboot_port
+        session.receive_port = self.receive_port
+        session.lump_timeout = self.lump_timeout
+        session.catch = CatchStrategy(**self.catch)
+        # Don't interrupt the devices already being flashed
+        session.ctrl_c_addr = job.ip
+        session.stream = False
+        session.pipeline = self.pipeline
+        session.metrics = self.metrics
+        session.debug = self.debug
+        job.session = session
+        timings = job.result['timings']
+
+        start = self.loop.time()
+        caught = yield session._send_lump()
+        timings['catch'] = self.loop.time() - start
+        job.result['lumps'] = session.catch.lumps
+        job.result['ctrl_c'] = session.catch.ctrl_c
+        if not caught:
+            job.fail('not_caught', "No answer to the LUMP after %ds." %
+                     self.lump_timeout)
+            raise Return(None)
+        logging.info("%s caught at %s", job.mac, job.ip)
+
+        start = self.loop.time()
+        current = yield self._precheck(job)
+        timings['precheck'] = self.loop.time() - start
+        if current:
+            logging.info("%s already runs %s, leaving it.", job.mac,
+                         os.path.basename(job.image))
+            yield session._invoke('reset', False)
+            if (yield self._wait_boot(job)):
+                self._record(job)
+                job.result['status'] = 'current'
+                job.result['exit'] = 0
+            raise Return(None)
+
+        start = self.loop.time()
+        yield self.pool.acquire()
+        timings['queue'] = self.loop.time() - start
+        try:
+            yield self._flash(job)
+        finally:
+            self.pool.release()
+
+    def _flash(self, job):
+        session = job.session
+        timings = job.result['timings']
+
+        start = self.loop.time()
+        task = self.loop.create_task(session._run_commands(self.script(job)))
+        done = yield self.loop.wait([task], self.script_timeout)
+        timings['script'] = self.loop.time() - start
+        if not done:
+            task.cancel()
+            session.close()
+            job.fail('script_timeout', "The script did not end after %ds." %
+                     self.script_timeout)
+            raise Return(None)
+        job.result['commands'] = [result.cmd for result in session.results]
+
+        if not (yield self._wait_boot(job)):
+            raise Return(None)
+        self._record(job)
+        job.result['status'] = 'updated'
+        job.result['exit'] = 0
+
+    def _precheck(self, job):
+        '''
+        Read the state of the caught device of job, the result tells if it
+        already runs the image of job.
+        '''
+        image = self.images[job.image]
+        state = yield device_state(job.session, self.crc_addr,
+                                   image['size'] if image['kind'] == 'uboot'
+                                   else None, self.flash_read)
+        job.result['device'] = state
+        if self.force:
+            raise Return(False)
+        try:
+            record = self.registry.lookup(job.mac, image['kind'])
+        except (IOError, OSError), err:
+            logging.debug("Can't use the update registry %s : %s",
+                          self.registry.path, err)
+            record = None
+        raise Return(is_current(image['kind'], image, state, record))
+
+    def _record(self, job):
+        '''
+        Remember what the device of job runs now, for the next run.
+        '''
+        image = self.images[job.image]
+        version = job.result['device']['version']
+        if image['kind'] == 'uboot':
+            version = image['version']
+        try:
+            self.registry.record(job.mac, image['kind'], image['digest'],
+                                 os.path.basename(job.image), version)
+        except (IOError, OSError), err:
+            logging.debug("Can't use the update registry %s : %s",
+                          self.registry.path, err)
+
+    def _wait_boot(self, job):
+        '''
+        Wait for the device of job to boot if we have to, the result tells if
+        it is online.
+        '''
+        if not self.wait:
+            raise Return(True)
+        logging.info("Waiting for %s to reboot...", job.mac)
+        watcher = BootWatcher(self.loop, job.mac, job.ip, self.iface,
+                              self.uboot_port, self.receive_port,
+                              self.boot_timeout, console=self.endpoint,
+                              discovery=self.discovery)
+        start = self.loop.time()
+        ip = yield watcher.watch()
+        job.result['timings']['boot'] = self.loop.time() - start
+        job.result['boot_phases'] = dict(watcher.timings)
+        if ip is None:
+            job.fail('boot_timeout', "Not online after %ds." %
+                     self.boot_timeout)
+            raise Return(False)
+        logging.info("%s is available at %s", job.mac, ip)
+        raise Return(True)
+
+    def report_tftp(self):
+        '''
+        Log what our TFTP server sent to deliver the images.
+        '''
+        if self.server is None:
+            return
+        summary = self.server.summary()
+        if not summary['clients']:
+            return
+        logging.info("TFTP : %.1f MiB sent for %.1f MiB delivered to %d "
+                     "devices in %.1fs, %.1f MiB/s together.",
+                     summary['sent_bytes'] / 1048576.0,
+                     summary['delivered_bytes'] / 1048576.0,
+                     summary['clients'], summary['elapsed'],
+                     summary['throughput'] / 1048576.0)
+
+    def results(self):
+        '''
+        The result of every job, with the time spent by our TFTP server on
+        its device.
+        '''
+        tftp = {}
+        if self.server is not None:
+            for transfer, success in self.server.transfers:
+                if transfer.elapsed is not None:
+                    tftp[transfer.client[0]] = tftp.get(transfer.client[0],
+                                                        0.0) + transfer.elapsed
+        results = []
+        for job in self.jobs:
+            if job.ip in tftp:
+                job.result['timings']['tftp'] = tftp[job.ip]
+            results.append(job.result)
+        return results
+
+    def close(self):
+        '''
+        Release every socket and image, the transfers of the TFTP server are
+        kept for results().
+        '''
+        for job in self.jobs:
+            if job.session is not None:
+                job.session.close()
+                job.session = None
+        if self.discovery is not None:
+            self.discovery.close()
+            self.discovery = None
+        if self.server is not None and self.server.endpoint.sock is not None:
+            self.server.close()
+            self.server.collect_metrics(self.metrics)
+        for capsule in self.capsules:
+            capsule.close()
+        self.capsules = []
+        # Deepest first, directories are emptied before being removed
+        for path in reversed(self.installed):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.unlink(path)
+        self.installed = []
+        if self.endpoint is not None:
+            self.endpoint.close()
+            self.endpoint = None
+
+
+def report(results, output=None):
+    '''
+    Write one JSON line per device to output if given, then sum it up with
+    logging.
+    '''
+    if output is not None:
+        for result in results:
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+        output.flush()
+    updated = len([result for result in results
+                   if result['status'] == 'updated'])
+    current = len([result for result in results
+                   if result['status'] == 'current'])
+    logging.info("%d of %d devices updated, %d already up to date.",
+                 updated, len(results), current)
+    for result in results:
+        if result['exit'] != 0:
+            logging.info("%s (%s) : %s", result['mac'], result['ip'],
+                         result['status'])
+
+
+def main():
+    ''' update a fleet of devices '''
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('manifest', metavar='MANIFEST', type=str,
+                        help="CSV (mac,image[,ip]) or JSON list of the"
+                        " devices to update.")
+    parser.add_argument("-i", "--iface", dest="iface", action="store",
+                        default="eth0",
+                        help="Interface facing the devices. Default is eth0.")
+    parser.add_argument("-j", "--jobs", dest="jobs", action="store",
+                        type=int, default=8,
+                        help="Devices flashed at the same time. Default is 8.")
+    parser.add_argument("-r", "--report", dest="report", action="store",
+                        default=None, metavar="FILE",
+                        help="Write one JSON result per device to FILE,"
+                        " - for stdout.")
+    parser.add_argument("--no-wait", dest="wait", action="store_false",
+                        default=True,
+                        help="Don't wait for the devices to boot.")
+    parser.add_argument("-f", "--force", dest="force", action="store_true",
+                        default=False,
+                        help="Flash the devices already running their image.")
+    parser.add_argument("--multicast", dest="multicast", action="store",
+                        nargs='?', const="%s:%d" % MULTICAST_GROUP,
+                        default=None, metavar="GROUP:PORT",
+                        help="Send an image once to the devices asking for"
+                        " multicast TFTP, to GROUP:PORT (%s:%d by default)."
+                        % MULTICAST_GROUP)
+    parser.add_argument("--max-rate", dest="max_rate", action="store",
+                        type=float, default=None, metavar="KIB/S",
+                        help="Send at most KIB/S KiB per second over TFTP, to"
+                        " every device together.")
+    parser.add_argument("--no-tuning", dest="tuning", action="store_false",
+                        default=True,
+                        help="Don't apply the TFTP settings found by"
+                        " lacie-uboot-tuning.")
+    parser.add_argument("--crc", dest="crc_addr", action="store",
+                        default=None, metavar="ADDR",
+                        help="Compare the CRC32 of the U-Boot found at ADDR"
+                        " with the image, besides its version.")
+    parser.add_argument("--flash-read", dest="flash_read", action="store",
+                        default=None, metavar="CMD",
+                        help="U-Boot command copying the flash to the --crc"
+                        " ADDR, %%(size)x is the size of the image.")
+    parser.add_argument("--pipeline", dest="pipeline", action="store",
+                        type=int, nargs='?', const=LINE_LIMIT, default=None,
+                        metavar="LENGTH",
+                        help="Send consecutive setenv on one line, of at most"
+                        " LENGTH characters (%d by default)." % LINE_LIMIT)
+    parser.add_argument("--lump-timeout", dest="lump_timeout",
+                        action="store", type=float, default=120,
+                        metavar="SECONDS",
+                        help="Give up catching a device after SECONDS."
+                        " Default is 120.")
+    parser.add_argument("--script-timeout", dest="script_timeout",
+                        action="store", type=float, default=600,
+                        metavar="SECONDS",
+                        help="Give up flashing a device after SECONDS."
+                        " Default is 600.")
+    parser.add_argument("--boot-timeout", dest="boot_timeout",
+                        action="store", type=int, default=600,
+                        metavar="SECONDS",
+                        help="Give up waiting for a device after SECONDS."
+                        " Default is 600.")
+    parser.add_argument("--flood", dest="flood", action="store", type=float,
+                        default=None, metavar="SECONDS",
+                        help="Send a LUMP every SECONDS until the device"
+                        " sends anything.")
+    parser.add_argument("--metrics", dest="metrics", action="store",
+                        default=None, metavar="FILE",
+                        help="Append the timings and counters of every device"
+                        " to FILE, one JSON object per line.")
+    parser.add_argument("--prometheus", dest="prometheus", action="store",
+                        default=None, metavar="FILE",
+                        help="Write the timings and counters of the fleet to"
+                        " FILE, for the textfile collector of Prometheus.")
+    parser.add_argument("-D", "--debug", dest="loglevel", action="store_const",
+                        const=logging.DEBUG, default=logging.INFO,
+                        help="Output debugging information")
+    options = parser.parse_args()
+    logging.basicConfig(level=options.loglevel, format='%(message)s')
+
+    if options.jobs < 1:
+        logging.error("--jobs must be at least 1.")
+        return 1
+    multicast = None
+    if options.multicast is not None:
+        group, _, port = options.multicast.partition(':')
+        if not is_valid_ipv4(group) or not port.isdigit() or \
+                not 224 <= int(group.split('.')[0]) <= 239:
+            logging.error("--multicast must be a multicast GROUP:PORT, like"
+                          " %s:%d. You gave %s", MULTICAST_GROUP[0],
+                          MULTICAST_GROUP[1], options.multicast)
+            return 1
+        multicast = (group, int(port))
+    if options.max_rate is not None and options.max_rate <= 0:
+        logging.error("--max-rate must be over 0.")
+        return 1
+    try:
+        devices = load_manifest(options.manifest)
+    except (IOError, ValueError), err:
+        logging.error("Can't read %s : %s", options.manifest, err)
+        return 1
+    if not devices:
+        logging.error("%s lists no device.", options.manifest)
+        return 1
+
+    fleet = FleetUpdater(jobs=options.jobs)
+    fleet.debug = options.loglevel == logging.DEBUG
+    fleet.wait = options.wait
+    fleet.force = options.force
+    fleet.multicast = multicast
+    if options.max_rate is not None:
+        fleet.max_rate = options.max_rate * 1024
+    if not options.tuning:
+        fleet.profiles = None
+    fleet.pipeline = options.pipeline
+    fleet.crc_addr = options.crc_addr
+    fleet.flash_read = options.flash_read
+    fleet.lump_timeout = options.lump_timeout
+    fleet.script_timeout = options.script_timeout
+    fleet.boot_timeout = options.boot_timeout
+    fleet.catch = {'flood': options.flood}
+    if fleet.setup_network(options.iface, devices):
+        return 1
+
+    try:
+        code = fleet.run()
+    finally:
+        fleet.close()
+    fleet.metrics.save(options.metrics, options.prometheus)
+    if options.report == '-':
+        report(fleet.results(), sys.stdout)
+    elif options.report is not None:
+        with open(options.report, 'w') as output:
+            report(fleet.results(), output)
+    else:
+        report(fleet.results())
+    return code
+
+if __name__ == '__main__':
+    if sys.platform != "win32":
+        if os.geteuid() != 0:
+            print "You must be administrator/root to run this program."
+            sys.exit(1)
+
+    try:
+        sys.exit(main())
+    except (KeyboardInterrupt, EOFError, SystemExit, KeyError):
+        pass
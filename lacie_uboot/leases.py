@@ -0,0 +1,208 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+leases remembers the IP given to each device, so concurrent or repeated
+flashes neither probe the network again nor hand out the same IP twice.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import logging
+import os
+import sys
+from time import time
+sys.dont_write_bytecode = True
+
+from network import find_free_ips, int_to_ip, subnet_range
+
+LEASE_FILE = '/var/lib/lacie-uboot/leases.json'
+
+
+@contextmanager
+def locked_json(path):
+    '''
+    Lock the JSON file at path and give its content, a dict, it is written
+    back when the block ends. Every lacie-uboot process of the host uses the
+    same lock, path + '.lock'.
+    '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            with open(path, 'r') as registry:
+                content = json.load(registry)
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            content = {}
+        except ValueError:
+            logging.error("%s is corrupted, starting over." % path)
+            content = {}
+
+        yield content
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as registry:
+            json.dump(content, registry, indent=1, sort_keys=True)
+        os.rename(tmp_path, path)
+    finally:
+        lock.close()
+
+
+class LeaseRegistry(object):
+    '''
+    MAC -> IP leases of each interface and subnet, kept in a JSON file shared
+    by every lacie-uboot process of the host. The file is locked while it is
+    read and written, so parallel processes can't give the same IP twice.
+    Leases expire after ttl seconds, and the least recently used ones are
+    evicted when there are more than max_leases.
+    '''
+
+    def __init__(self, path=LEASE_FILE, ttl=7 * 24 * 3600, max_leases=4096):
+        self.path = path
+        self.ttl = ttl
+        self.max_leases = max_leases
+
+    @contextmanager
+    def _locked(self):
+        '''
+        Lock the registry and give its content, it is written back when
+        the block ends.
+        '''
+        with locked_json(self.path) as leases:
+            yield leases
+            self._evict(leases)
+
+    def _evict(self, leases):
+        '''
+        Drop the expired leases, then the least recently used ones.
+        '''
+        now = time()
+        entries = []
+        for key, subnet in leases.items():
+            for mac, lease in subnet.items():
+                if lease['expires'] < now:
+                    del subnet[mac]
+                else:
+                    entries.append((lease['last_used'], key, mac))
+            if not subnet:
+                del leases[key]
+
+        entries.sort()
+        for _, key, mac in entries[:max(len(entries) - self.max_leases, 0)]:
+            del leases[key][mac]
+            if not leases[key]:
+                del leases[key]
+
+    @staticmethod
+    def key(iface, ip, netmask):
+        '''The registry is split by interface and subnet'''
+        network, size = subnet_range(ip, netmask)
+        return "%s/%s/%d" % (iface, int_to_ip(network), size)
+
+    def lookup(self, iface, ip, netmask, mac_target):
+        '''
+        Return the IP leased to mac_target, or None.
+        '''
+        with self._locked() as leases:
+            lease = leases.get(self.key(iface, ip, netmask), {}).get(
+                mac_target.lower())
+            if lease is None:
+                return None
+            lease['last_used'] = time()
+            return str(lease['ip'])
+
+    def allocate(self, iface, ip, mac, netmask, macs, metrics=None,
+                 exclude=()):
+        '''
+        Give an IP to every MAC of macs, on the subnet of iface (ip, mac and
+        netmask are the ones of iface).
+        A MAC keeps its previous lease without any ARP traffic, the others
+        get free IPs found with one ARP sweep, never an IP leased to another
+        device or listed in exclude.
+        Return a dict MAC -> IP, without the MACs we could not serve.
+        '''
+        now = time()
+        with self._locked() as leases:
+            subnet = leases.setdefault(self.key(iface, ip, netmask), {})
+            given = {}
+            missing = []
+            for mac_target in macs:
+                lease = subnet.get(mac_target.lower())
+                if lease is not None and lease['expires'] >= now and \
+                        lease['ip'] not in exclude:
+                    given[mac_target] = str(lease['ip'])
+                else:
+                    missing.append(mac_target)
+
+            if missing:
+                taken = [entry['ip'] for entry in subnet.values()]
+                taken.extend(exclude)
+                free = find_free_ips(iface, ip, mac, netmask, len(missing),
+                                     exclude=taken, metrics=metrics)
+                given.update(zip(missing, free))
+
+            for mac_target, ip_target in given.items():
+                subnet[mac_target.lower()] = {'ip': ip_target,
+                                              'expires': now + self.ttl,
+                                              'last_used': now}
+            return given
+
+    def release(self, iface, ip, netmask, mac_target):
+        '''
+        Forget the lease of mac_target.
+        '''
+        with self._locked() as leases:
+            leases.get(self.key(iface, ip, netmask), {}).pop(
+                mac_target.lower(), None)
+
+
+def allocate_ips(registry, iface, ip, mac, netmask, macs, exclude=(),
+                 metrics=None):
+    '''
+    Give an IP to every MAC of macs through registry, or with a plain ARP
+    sweep if there is no registry or it can't be used.
+    Return a dict MAC -> IP, without the MACs we could not serve.
+    '''
+    if registry is not None:
+        try:
+            return registry.allocate(iface, ip, mac, netmask, macs, metrics,
+                                     exclude)
+        except (IOError, OSError), err:
+            logging.debug("Can't use the lease registry %s : %s",
+                          registry.path, err)
+    free = find_free_ips(iface, ip, mac, netmask, len(macs), exclude=exclude,
+                         metrics=metrics)
+    return dict(zip(macs, free))
@@ -0,0 +1,188 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+metrics keeps the timings and counters of sessions, for dashboards.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import json
+import logging
+import os
+import sys
+from time import time
+sys.dont_write_bytecode = True
+
+from eventloop import monotonic
+
+PREFIX = 'lacie_uboot_'
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def escape(value):
+    '''Escape a label value for the Prometheus text format.'''
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def labels_text(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in sorted(labels))
+
+
+class Metrics(object):
+    '''
+    Spans and counters of one or many sessions. A span is how long a phase
+    took, in seconds of the monotonic clock of the event loop, a counter
+    counts packets, bytes or retries. Both have labels, like the MAC of the
+    device.
+    The Prometheus textfile sums the devices up : the labels in
+    device_labels are left out, so a summary gives the tail latency of a
+    phase across the fleet. The JSON lines keep every record.
+    '''
+
+    device_labels = ('mac', 'ip')
+
+    def __init__(self):
+        self.spans = []  # (name, labels, seconds, end) in order
+        self.counters = {}  # (name, labels) -> value
+
+    @staticmethod
+    def now():
+        return monotonic()
+
+    def observe(self, name, start, **labels):
+        '''
+        Record the span of name, from start (a now()) until now.
+        Return its length.
+        '''
+        seconds = monotonic() - start
+        self.add_span(name, seconds, **labels)
+        return seconds
+
+    def add_span(self, name, seconds, **labels):
+        self.spans.append((name, tuple(sorted(labels.items())), seconds,
+                           time()))
+
+    def count(self, name, value=1, **labels):
+        '''Add value to the counter of name.'''
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_count(self, name, value, **labels):
+        '''Set the counter of name, for totals kept elsewhere.'''
+        self.counters[(name, tuple(sorted(labels.items())))] = value
+
+    def write_jsonl(self, output):
+        '''
+        Write one JSON object per span and per counter to output.
+        '''
+        for name, labels, seconds, end in self.spans:
+            output.write(json.dumps({'type': 'span', 'name': name,
+                                     'seconds': seconds, 'time': end,
+                                     'labels': dict(labels)},
+                                    sort_keys=True) + '\n')
+        for (name, labels), value in sorted(self.counters.items()):
+            output.write(json.dumps({'type': 'counter', 'name': name,
+                                     'value': value, 'labels': dict(labels)},
+                                    sort_keys=True) + '\n')
+        output.flush()
+
+    def _fleet(self, labels):
+        return tuple((name, value) for name, value in labels
+                     if name not in self.device_labels)
+
+    def prometheus(self):
+        '''
+        Return the metrics in the Prometheus text format, spans as summaries
+        and counters as counters.
+        '''
+        spans = {}
+        for name, labels, seconds, _ in self.spans:
+            spans.setdefault(name, {}).setdefault(self._fleet(labels),
+                                                  []).append(seconds)
+        counters = {}
+        for (name, labels), value in self.counters.items():
+            series = counters.setdefault(name, {})
+            labels = self._fleet(labels)
+            series[labels] = series.get(labels, 0) + value
+
+        lines = []
+        for name in sorted(spans):
+            metric = PREFIX + name + '_seconds'
+            lines.append('# TYPE %s summary' % metric)
+            for labels, values in sorted(spans[name].items()):
+                values.sort()
+                for quantile in QUANTILES:
+                    value = values[min(int(len(values) * quantile),
+                                       len(values) - 1)]
+                    lines.append('%s%s %.6f' % (
+                        metric, labels_text(labels +
+                                            (('quantile', quantile),)),
+                        value))
+                lines.append('%s_sum%s %.6f' % (metric, labels_text(labels),
+                                                sum(values)))
+                lines.append('%s_count%s %d' % (metric, labels_text(labels),
+                                                len(values)))
+        for name in sorted(counters):
+            metric = PREFIX + name + '_total'
+            lines.append('# TYPE %s counter' % metric)
+            for labels, value in sorted(counters[name].items()):
+                lines.append('%s%s %d' % (metric, labels_text(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        '''
+        Write the textfile at path for the node exporter, at once so it
+        never reads half of it.
+        '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as output:
+            output.write(self.prometheus())
+        os.rename(tmp_path, path)
+
+    def save(self, jsonl=None, prometheus=None):
+        '''
+        Append the JSON lines to the file jsonl and write the Prometheus
+        textfile prometheus, those given. Return False if one failed.
+        '''
+        try:
+            if jsonl is not None:
+                with open(jsonl, 'a') as output:
+                    self.write_jsonl(output)
+            if prometheus is not None:
+                self.write_prometheus(prometheus)
+        except (IOError, OSError), err:
+            logging.error("Can't write the metrics : %s", err)
+            return False
+        return True
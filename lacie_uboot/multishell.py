@@ -0,0 +1,320 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+multishell drives the netconsole of several devices at once, from one socket.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import os
+import socket
+import sys
+sys.dont_write_bytecode = True
+
+from asyncshell import AsyncUbootshell, PROMPT
+from broker import open_netconsole
+from eventloop import EventLoop, Return
+from leases import LeaseRegistry, allocate_ips
+from metrics import Metrics
+from network import iface_info, is_valid_mac, is_valid_ipv4
+from pacing import CatchStrategy
+from protocol import lump_packet
+
+
+class Target(AsyncUbootshell):
+    '''
+    A device of a MultiUbootshell session, it runs its own script.
+    '''
+
+    def __init__(self, loop, mac, ip):
+        AsyncUbootshell.__init__(self, loop)
+        self.mac_target = mac
+        self.ip_target = ip
+        self.lump = lump_packet(mac, ip)
+        self.caught = False
+        # Set once the device sent anything
+        self.heard = False
+        self.display = True
+        # Concurrent outputs would be mixed up on stdout
+        self.stream = False
+
+    def show(self, cmd, output):
+        if not self.display:
+            return
+        if output is None:
+            output = ''
+        sys.stdout.write("[%s] %s => %s\n" % (self.mac_target, cmd,
+                                               output.strip()))
+        sys.stdout.flush()
+
+    def _wait_prompt(self, deadline):
+        '''
+        Wait for the prompt until deadline, the result tells if it came.
+        '''
+        while self.loop.time() < deadline:
+            data = yield self._recv(deadline - self.loop.time())
+            if data is not None:
+                self.heard = True
+            if data == PROMPT:
+                self.caught = True
+                logging.info("%s caught at %s", self.mac_target,
+                             self.ip_target)
+                raise Return(True)
+        raise Return(False)
+
+
+class MultiUbootshell(object):
+    '''
+    An instance of MultiUbootshell is a session with the netconsole of many
+    devices at once. Every device is caught with the same LUMP window and then
+    runs its own command queue, so the whole session lasts about as long as
+    the slowest device.
+    '''
+
+    def __init__(self, loop=None):
+        '''Sets some defaults'''
+
+        self.loop = loop or EventLoop()
+        self.host_ip = None
+        self.bcast_addr = None
+        self.send_port = 4446
+        self.uboot_port = 6666
+        self.bind_addr = ''
+        self.pipeline = None
+        self.lump_timeout = 120
+        self.targets = {}  # ip -> Target
+        self.endpoint = None
+        # PcapWriter recording every datagram of the session
+        self.capture = None
+        self.leases = LeaseRegistry()
+        self.catch = CatchStrategy()
+        self.metrics = Metrics()
+        self.display = True
+        self.debug = False
+
+    def add_target(self, mac, ip):
+        '''
+        Add a device to catch, it will be given ip.
+        '''
+        target = Target(self.loop, mac, ip)
+        target.send_port = self.send_port
+        target.uboot_port = self.uboot_port
+        target.bind_addr = self.bind_addr
+        target.pipeline = self.pipeline
+        target.metrics = self.metrics
+        target.debug = self.debug
+        self.targets[ip] = target
+        return target
+
+    def load_script(self, path_file):
+        '''
+        Run the same script on every device.
+        '''
+        if not os.path.exists(path_file):
+            logging.error("%s does not exists." % path_file)
+            return
+        for target in self.targets.values():
+            target.load_script(path_file)
+
+    def setup_network(self, net_dict):
+        '''
+        Give a dict with the following values to setup your network :
+        {
+            'iface': 'ethX'  # default : eth0
+            'targets': [('00:00:00:00:00:01', None),  # Find a free IP
+                        ('00:00:00:00:00:02', '192.168.1.2')]
+        }
+        '''
+
+        try:
+            ip, mac, netmask, bcast = iface_info(net_dict['iface'])
+        except (IOError, TypeError):
+            logging.error("Your network interface is not reachable."
+                          " Is %s correct ?" % net_dict['iface'])
+            return 1
+
+        if not is_valid_ipv4(bcast):
+            logging.error("Your Broadcast IP is not in the proper format."
+                          "\'W.X.Y.Z\' format is awaited."
+                          "You gave %s" % bcast)
+            return 1
+        self.host_ip = ip
+        self.bcast_addr = bcast
+
+        for mac_target, _ in net_dict['targets']:
+            if not is_valid_mac(mac_target):
+                logging.error("Your MAC address is not in the proper format."
+                              "\'00:00:00:00:00:00\' format is awaited."
+                              "You gave %s" % mac_target)
+                return 1
+
+        used = [ip_target for _, ip_target in net_dict['targets']
+                if ip_target is not None]
+        missing = [mac_target for mac_target, ip_target in net_dict['targets']
+                   if ip_target is None]
+        given = {}
+        if missing:
+            if sys.platform == "darwin":
+                logging.error("You need to specify an IP to assign to "
+                              "each device.")
+                return 1
+            # Previous leases, then one ARP sweep for the other devices
+            start = self.metrics.now()
+            given = allocate_ips(self.leases, net_dict['iface'], ip, mac,
+                                 netmask, missing, exclude=used,
+                                 metrics=self.metrics)
+            self.metrics.observe('free_ip', start)
+            if len(given) < len(missing):
+                return 1
+
+        for mac_target, ip_target in net_dict['targets']:
+            if ip_target is None:
+                ip_target = given[mac_target]
+            if not is_valid_ipv4(ip_target):
+                logging.error("Your product IP is not in the proper format."
+                              "\'W.X.Y.Z\' format is awaited."
+                              "You gave %s" % ip_target)
+                return 1
+            self.add_target(mac_target, ip_target)
+
+    def send_lump(self):
+        '''
+        Broadcast one LUMP per target and some Ctrl-C until every target gave
+        its prompt, or the LUMP timeout expired.
+        Return the list of caught targets.
+        '''
+        return self.loop.run_until_complete(self._send_lump())
+
+    def run(self):
+        '''
+        Catch every target, then execute each script concurrently.
+        Return 0 if every target was caught and ran its whole script.
+        '''
+        return self.loop.run_until_complete(self._run())
+
+    def _send_lump(self):
+        '''
+        Coroutine of send_lump.
+        '''
+
+        logging.debug("Sending LUMP / Ctrl-C to %d devices, "
+                      "waiting for them to start up", len(self.targets))
+        logging.info("Please /!\HARD/!\ reboot the devices /!\NOW/!\ ")
+
+        try:
+            self.endpoint = open_netconsole(self.loop, self.uboot_port,
+                                            self.bind_addr)
+        except socket.error, err:
+            logging.error("Couldn't be a udp server on port %d : %s",
+                          self.uboot_port, err)
+            raise Return([])
+        self.endpoint.capture = self.capture
+
+        catch = self.catch
+        catch.start(self.loop.time())
+        deadline = catch.started + self.lump_timeout
+        watchers = {}
+        for target in self.targets.values():
+            target.endpoint = self.endpoint
+            if not target._open():
+                continue
+            watchers[target] = self.loop.create_task(
+                target._wait_prompt(deadline))
+
+        waiting = [target for target in self.targets.values()
+                   if target in watchers]
+        while waiting and self.loop.time() < deadline:
+            # Flood while one of the devices is still silent
+            length = catch.round_length(
+                not all(target.heard for target in waiting))
+            round_end = min(self.loop.time() + length, deadline)
+            for target in waiting:
+                self.endpoint.sendto(target.lump,
+                                     (self.bcast_addr, self.send_port))
+                catch.lumps += 1
+            # Wait for the devices to process the LUMP
+            yield self.loop.sleep(min(catch.ctrl_c_after(length),
+                                      round_end - self.loop.time()))
+            #Send Ctrl-C (Code ASCII 3 for EXT equivalent of SIGINT for Unix)
+            self.endpoint.sendto('\3', (self.bcast_addr, self.uboot_port))
+            catch.ctrl_c += 1
+            yield self.loop.wait([watchers[target] for target in waiting],
+                                 max(round_end - self.loop.time(), 0))
+            if any(target.heard for target in self.targets.values()):
+                catch.heard(self.loop.time())
+            waiting = [target for target in waiting
+                       if not watchers[target].done()]
+
+        catch.done(self.loop.time(),
+                   all(target.caught for target in self.targets.values()))
+        catch.report()
+        for target in self.targets.values():
+            self.metrics.add_span('lump', catch.duration,
+                                  mac=target.mac_target, caught=target.caught)
+        self.metrics.count('lump_sent', catch.lumps)
+        self.metrics.count('ctrl_c_sent', catch.ctrl_c)
+        for target in waiting:
+            watchers[target].cancel()
+            target.close()
+            logging.info("Sending LUMP for %ds, no response from %s !",
+                         self.lump_timeout, target.mac_target)
+
+        # Let the prompts of the extra Ctrl-C arrive, then forget them.
+        yield self.loop.sleep(0.2)
+        caught = [target for target in self.targets.values() if target.caught]
+        for target in caught:
+            target._drain()
+        raise Return(caught)
+
+    def _run(self):
+        '''
+        Coroutine of run.
+        '''
+
+        caught = yield self._send_lump()
+        if self.endpoint is None:
+            raise Return(1)
+
+        for target in caught:
+            target.display = self.display
+        yield self.loop.gather([target._run_script() for target in caught
+                                if target.script is not None])
+
+        self.close()
+        if len(caught) != len(self.targets):
+            raise Return(1)
+        raise Return(0)
+
+    def close(self):
+        '''
+        Release the netconsole socket.
+        '''
+        if self.endpoint is not None:
+            self.endpoint.close()
+            self.endpoint = None
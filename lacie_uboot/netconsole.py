@@ -0,0 +1,132 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+netconsole holds the UDP socket used to talk to the U-Boot netconsole.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import errno
+import logging
+import socket
+import sys
+sys.dont_write_bytecode = True
+
+from eventloop import DatagramEndpoint
+
+# U-Boot may send its output one byte per datagram, give the kernel room to
+# keep a whole printenv while we are busy.
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+
+class Netconsole(object):
+    '''
+    The UDP socket bound on the netconsole port. It is kept for a whole
+    session, from the first LUMP to the final reset, so no datagram is lost
+    between two commands.
+    '''
+
+    def __init__(self, port=6666, bind_addr=''):
+        '''Bind the netconsole port, raise socket.error if it is taken'''
+
+        self.port = port
+        self.peer = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                 RECEIVE_BUFFER)
+        except socket.error:
+            pass
+        try:
+            self.sock.bind((bind_addr, port))
+        except socket.error:
+            self.sock.close()
+            raise
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connect(self, ip):
+        '''
+        Only talk to ip from now on, the kernel drops datagrams coming from
+        any other sender.
+        '''
+        self.sock.connect((ip, self.port))
+        self.peer = ip
+
+    def close(self):
+        self.sock.close()
+
+
+class NetconsoleEndpoint(DatagramEndpoint):
+    '''
+    The netconsole socket seen from an event loop. One endpoint can be shared
+    by many sessions, each datagram goes to the session of its source IP.
+    '''
+
+    def __init__(self, loop, port=6666, bind_addr=''):
+        self.console = Netconsole(port, bind_addr)
+        self.sessions = {}  # ip -> session
+        # Every datagram is received in the same buffer
+        self._buffer = bytearray(2048)
+        self._view = memoryview(self._buffer)
+        DatagramEndpoint.__init__(self, loop, self.console.sock, self)
+
+    def read_ready(self):
+        '''
+        Give every datagram already waiting to the session of its sender.
+        '''
+        while self.sock is not None:
+            try:
+                size, addr = self.sock.recvfrom_into(self._buffer)
+            except socket.error, err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # ICMP errors of a connected socket end up here.
+                    logging.debug("Receive error : %s", err)
+                break
+            if self.capture is not None:
+                self.capture.received(self.sock, self._view[:size].tobytes(),
+                                      addr)
+            session = self.sessions.get(addr[0])
+            if session is not None:
+                session.datagram_received(self._view[:size].tobytes())
+
+    def register(self, ip, session):
+        self.sessions[ip] = session
+
+    def unregister(self, ip):
+        self.sessions.pop(ip, None)
+
+    def connect(self, ip):
+        '''Only talk to ip from now on, see Netconsole.connect'''
+        self.console.connect(ip)
+
+    def close(self):
+        DatagramEndpoint.close(self)
+        self.sessions = {}
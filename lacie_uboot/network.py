@@ -31,76 +31,95 @@ network is a small library with a few utils functions.
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from array import array
 import fcntl
 import logging
 import os
-from random import randint
+import random
 import re
 from select import select
 import socket
-from struct import pack, unpack
+from struct import calcsize, pack, unpack
 import sys
-from time import clock
+from time import time
 sys.dont_write_bytecode = True
 
-if sys.platform == "darwin":
-    from SystemConfiguration import *
-
-
-def is_valid_ipv4(ip_v4):
-    '''Validates IPv4 addresses.i'''
-    pattern = re.compile(r"""
-        ^
+from protocol import parse_info, LOOK_PACKET
+
+ARPOP_REQUEST = pack('!H', 0x0001)
+ARPOP_REPLY = pack('!H', 0x0002)
+
+SIOCGIFCONF = 0x8912
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+SIOCGIFHWADDR = 0x8927
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+# A struct ifreq : the name, then a union holding a struct ifmap of two longs
+IFREQ_SIZE = 40 if calcsize('P') == 8 else 32
+
+
+# Compiled once, every IP and MAC given is checked with them
+IPV4_PATTERN = re.compile(r"""
+    ^
+    (?:
+      # Dotted variants:
+      (?:
+        # Decimal 1-255 (no leading 0's)
+        [3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}
+      |
+        0x0*[0-9a-f]{1,2}  # Hexadecimal 0x0 - 0xFF (possible leading 0's)
+      |
+        0+[1-3]?[0-7]{0,2} # Octal 0 - 0377 (possible leading 0's)
+      )
+      (?:                  # Repeat 0-3 times, separated by a dot
+        \.
         (?:
-          # Dotted variants:
-          (?:
-            # Decimal 1-255 (no leading 0's)
-            [3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}
-          |
-            0x0*[0-9a-f]{1,2}  # Hexadecimal 0x0 - 0xFF (possible leading 0's)
-          |
-            0+[1-3]?[0-7]{0,2} # Octal 0 - 0377 (possible leading 0's)
-          )
-          (?:                  # Repeat 0-3 times, separated by a dot
-            \.
-            (?:
-              [3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}
-            |
-              0x0*[0-9a-f]{1,2}
-            |
-              0+[1-3]?[0-7]{0,2}
-            )
-          ){0,3}
-        |
-          0x0*[0-9a-f]{1,8}    # Hexadecimal notation, 0x0 - 0xffffffff
+          [3-9]\d?|2(?:5[0-5]|[0-4]?\d)?|1\d{0,2}
         |
-          0+[0-3]?[0-7]{0,10}  # Octal notation, 0 - 037777777777
+          0x0*[0-9a-f]{1,2}
         |
-          # Decimal notation, 1-4294967295:
-          429496729[0-5]|42949672[0-8]\d|4294967[01]\d\d|429496[0-6]\d{3}|
-          42949[0-5]\d{4}|4294[0-8]\d{5}|429[0-3]\d{6}|42[0-8]\d{7}|
-          4[01]\d{8}|[1-3]\d{0,9}|[4-9]\d{0,8}
+          0+[1-3]?[0-7]{0,2}
         )
-        $
-    """, re.VERBOSE | re.IGNORECASE)
-    return pattern.match(ip_v4) is not None
+      ){0,3}
+    |
+      0x0*[0-9a-f]{1,8}    # Hexadecimal notation, 0x0 - 0xffffffff
+    |
+      0+[0-3]?[0-7]{0,10}  # Octal notation, 0 - 037777777777
+    |
+      # Decimal notation, 1-4294967295:
+      429496729[0-5]|42949672[0-8]\d|4294967[01]\d\d|429496[0-6]\d{3}|
+      42949[0-5]\d{4}|4294[0-8]\d{5}|429[0-3]\d{6}|42[0-8]\d{7}|
+      4[01]\d{8}|[1-3]\d{0,9}|[4-9]\d{0,8}
+    )
+    $
+""", re.VERBOSE | re.IGNORECASE)
+MAC_PATTERN = re.compile('([a-fA-F0-9]{2}[:]?){6}')
+
+
+def is_valid_ipv4(ip_v4):
+    '''Validates IPv4 addresses.i'''
+    return IPV4_PATTERN.match(ip_v4) is not None
 
 
 def is_valid_mac(mac):
     ''' Validates MAC addresses separated with columns'''
-    validator = '([a-fA-F0-9]{2}[:]?){6}'  # this is the regex
-    return re.compile(validator).search(mac)
+    return MAC_PATTERN.search(mac)
 
 
 def iface_info_mac(iface):
-    ds = SCDynamicStoreCreate(None, 'GetIPv4Addresses', None, None)
+    # Only there on darwin, and slow to import
+    import SystemConfiguration as sc
+
+    ds = sc.SCDynamicStoreCreate(None, 'GetIPv4Addresses', None, None)
     # Get all keys matching pattern State:/Network/Service/[^/]+/IPv4
-    pattern = SCDynamicStoreKeyCreateNetworkServiceEntity(None,
-                                                          kSCDynamicStoreDomainState,
-                                                          kSCCompAnyRegex,
-                                                          kSCEntNetIPv4)
-    patterns = CFArrayCreate(None, (pattern, ), 1, kCFTypeArrayCallBacks)
-    valueDict = SCDynamicStoreCopyMultiple(ds, None, patterns)
+    pattern = sc.SCDynamicStoreKeyCreateNetworkServiceEntity(None,
+                                                          sc.kSCDynamicStoreDomainState,
+                                                          sc.kSCCompAnyRegex,
+                                                          sc.kSCEntNetIPv4)
+    patterns = sc.CFArrayCreate(None, (pattern, ), 1, sc.kCFTypeArrayCallBacks)
+    valueDict = sc.SCDynamicStoreCopyMultiple(ds, None, patterns)
 
     for serviceDict in valueDict.values():
         if serviceDict[u'InterfaceName'] == iface:
@@ -118,22 +137,23 @@ def iface_info_mac(iface):
             return ip_str, mac, netmask_str, bcast
 
 
-def iface_info(ifn):
+def ifreq(sck, request, ifn):
+    '''Return the struct ifreq filled by the ioctl request on ifn.'''
+    return fcntl.ioctl(sck.fileno(), request, pack('256s', ifn[:15]))
 
-    if sys.platform == "darwin":
-        return iface_info_mac(ifn)
 
-    sck = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    info = fcntl.ioctl(sck.fileno(), 0x8927,  pack('256s', ifn[:15]))
+def _iface_info(sck, ifn, ip_str=None):
+    '''
+    iface_info from an open socket, ip_str is read unless it is given.
+    '''
+    info = ifreq(sck, SIOCGIFHWADDR, ifn)
     mac = ''.join(['%02x:' % ord(char) for char in info[18:24]])[:-1]
 
-    ip_str = socket.inet_ntoa(fcntl.ioctl(sck.fileno(), 0x8915,
-        pack('256s', ifn[:15]))[20:24])
+    if ip_str is None:
+        ip_str = socket.inet_ntoa(ifreq(sck, SIOCGIFADDR, ifn)[20:24])
     ip = [int(x) for x in ip_str.split(".")]
 
-    netmask_str = socket.inet_ntoa(fcntl.ioctl(sck.fileno(), 0x891b,
-        pack('256s', ifn[:15]))[20:24])
+    netmask_str = socket.inet_ntoa(ifreq(sck, SIOCGIFNETMASK, ifn)[20:24])
     netmask = [int(x) for x in netmask_str.split(".")]
 
     bcast = [0, 0, 0, 0]
@@ -144,31 +164,95 @@ def iface_info(ifn):
     return ip_str, mac, netmask_str, bcast
 
 
-def random_ip_in_subnet(ip, netmask):
-    netmask_bin = ''.join([bin(int(x) + 256)[3:] for x in netmask.split('.')])
-    netmask_length = sum([int(x) for x in netmask_bin])
-
-    # We can change this number of bits
-    change_length = 32 - netmask_length
-
-    not_valid = True
-    while not_valid:
-        # Generate random bits word of change_length
-        change = "".join(str(randint(0, 1)) for i in range(change_length))
-        not_valid = False
-        # Check that each word is not 0 or 255, that would cause trouble
-        for x in range(change_length / 8):
-            word = int(change[x * 8:(x * 8) + 8], 2)
-            if (word == 0) or (word == 255):
-                not_valid = True
+def iface_info(ifn):
+
+    if sys.platform == "darwin":
+        return iface_info_mac(ifn)
+
+    sck = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        return _iface_info(sck, ifn)
+    finally:
+        sck.close()
+
+
+def list_ifaces():
+    '''
+    Return (iface, ip, mac, netmask, bcast) for every IPv4 address of the
+    interfaces which are up, but the loopback, all read from one socket.
+    VLAN interfaces come as any other, an alias like eth0:1 is given as
+    eth0 with the IP of the alias.
+    '''
+    sck = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Grow the buffer until every interface fits
+        count = 16
+        while True:
+            names = array('B', '\0' * (count * IFREQ_SIZE))
+            ifconf = pack('iL', len(names), names.buffer_info()[0])
+            size = unpack('iL', fcntl.ioctl(sck.fileno(), SIOCGIFCONF,
+                                             ifconf))[0]
+            if size < len(names):
                 break
+            count *= 2
+        names = names.tostring()
+
+        ifaces = []
+        for offset in range(0, size, IFREQ_SIZE):
+            label = names[offset:offset + 16].split('\0', 1)[0]
+            ip_str = socket.inet_ntoa(names[offset + 20:offset + 24])
+            flags = unpack('H', ifreq(sck, SIOCGIFFLAGS, label)[16:18])[0]
+            if not flags & IFF_UP or flags & IFF_LOOPBACK:
+                continue
+            try:
+                info = _iface_info(sck, label, ip_str)
+            except IOError, err:
+                logging.debug("Skipping %s : %s", label, err)
+                continue
+            ifaces.append((label.split(':', 1)[0],) + info)
+        return ifaces
+    finally:
+        sck.close()
 
-    ip_bin = ''.join([bin(int(x) + 256)[3:] for x in ip.split('.')])
-    ip_bin = ip_bin[:-change_length] + change
-    return '.'.join((str(int(ip_bin[x * 8:(x * 8) + 8], 2)) for x in range(4)))
 
+def ip_to_int(ip):
+    '''W.X.Y.Z -> int'''
+    return unpack('!I', socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    '''int -> W.X.Y.Z'''
+    return socket.inet_ntoa(pack('!I', value))
 
-def send_arp(iface, sender_ip, sender_mac, target_ip, arptype):
+
+def subnet_range(ip, netmask):
+    '''
+    Return the first address of the subnet of ip and its number of addresses.
+    '''
+    mask = ip_to_int(netmask)
+    return ip_to_int(ip) & mask, (~mask & 0xFFFFFFFF) + 1
+
+
+def usable_ip(value, network, size):
+    '''
+    Is value a good IP to give to a device : not the network or broadcast
+    address of its subnet, and not ending by 0 or 255, that would cause
+    trouble.
+    '''
+    if value in (network, network + size - 1):
+        return False
+    return (value & 0xFF) not in (0, 255)
+
+
+def random_ip_in_subnet(ip, netmask):
+    network, size = subnet_range(ip, netmask)
+    while True:
+        value = network + random.randrange(size)
+        if usable_ip(value, network, size):
+            return int_to_ip(value)
+
+
+def arp_packet(sender_ip, sender_mac, target_ip, arptype):
 
     """
     Sample ARP frame
@@ -189,14 +273,12 @@ def send_arp(iface, sender_ip, sender_mac, target_ip, arptype):
     +----------------+
     """
 
-    ARPOP_REQUEST = pack('!H', 0x0001)
-    ARPOP_REPLY = pack('!H', 0x0002)
     packet = b''
 
     sender_mac_b = pack('!6B', *[int(x, 16) for x in sender_mac.split(':')])
     zero_mac_b   = pack('!6B', *(0x00,) * 6)
-    sender_ip_b  = pack('!4B', *[int(x) for x in sender_ip.split('.')])
-    target_ip_b  = pack('!4B', *[int(x) for x in target_ip.split('.')])
+    sender_ip_b  = socket.inet_aton(sender_ip)
+    target_ip_b  = socket.inet_aton(target_ip)
 
     packet += pack('!6B', *(0xFF,) * 6)
     packet += sender_mac_b
@@ -217,6 +299,42 @@ def send_arp(iface, sender_ip, sender_mac, target_ip, arptype):
         packet += sender_mac_b
     packet += target_ip_b
     packet += b'\x00' * 18  # padding
+    return packet
+
+
+def arp_replies(sock, probed, window):
+    '''
+    Read the ARP replies coming on sock during window seconds.
+    Yield (ip, mac) for each reply sent by an address of probed (ints),
+    unrelated ARP frames are ignored.
+    '''
+    stop = time() + window
+    while True:
+        remaining = stop - time()
+        if remaining <= 0:
+            break
+        if not select([sock], [], [], remaining)[0]:
+            break
+        try:
+            data = sock.recv(42)  # ARP default packet size
+        except socket.error:
+            continue
+        # check opcode is reply
+        if len(data) < 42 or data[12:14] != b'\x08\x06' or \
+                data[20:22] != ARPOP_REPLY:
+            continue
+        sender = unpack('!I', data[28:32])[0]
+        if sender not in probed:
+            continue
+        yield sender, ':'.join('%02x' % ord(b) for b in data[22:28])
+
+
+def send_arp(iface, sender_ip, sender_mac, target_ip, arptype):
+    '''
+    Send one ARP packet, return True if target_ip answered in 0.5s.
+    '''
+
+    packet = arp_packet(sender_ip, sender_mac, target_ip, arptype)
 
     #defining the socket
     sock = socket.socket(socket.PF_PACKET, socket.SOCK_RAW)
@@ -224,53 +342,98 @@ def send_arp(iface, sender_ip, sender_mac, target_ip, arptype):
 
     # send the ARP
     sock.send(packet)
-    while 1:
-        srecv = select([sock], [], [], 0.5)
-        # data
-        if srecv[0]:
-            try:
-                data = sock.recv(42)  # ARP default packet size
-            except:
-                continue
-            # check opcode is reply
-            if data[12:14] == b'\x08\x06' and data[20:22] == ARPOP_REPLY:
-                tgt_mac = ':'.join('%02x' % ord(b) for b in data[6:12])
-                logging.debug("%s is at %s" % (target_ip, tgt_mac))
-                sock.close()
-                return True
-            else:
-                break
-        break
+    try:
+        for _, tgt_mac in arp_replies(sock, set([ip_to_int(target_ip)]), 0.5):
+            logging.debug("%s is at %s" % (target_ip, tgt_mac))
+            return True
+    finally:
+        sock.close()
 
     # Did not receive any answer to our request, means IP is free
     return False
 
 
-def find_free_ip(iface, ip, mac, netmask):
+def arp_sweep(iface, ip, mac, netmask, candidates, window=0.5):
+    '''
+    Send an ARP request to every address of candidates (ints) at once from
+    one raw socket, then collect the replies during window seconds.
+    Return a bitmap of the subnet of ip, with a bit set for every address
+    which answered.
+    '''
+    network, size = subnet_range(ip, netmask)
+    occupied = bytearray((size + 7) / 8)
+
+    sock = socket.socket(socket.PF_PACKET, socket.SOCK_RAW)
+    try:
+        sock.bind((iface, 0x0806))
+        for candidate in candidates:
+            sock.send(arp_packet(ip, mac, int_to_ip(candidate), 'REQUEST'))
+        for sender, tgt_mac in arp_replies(sock, set(candidates), window):
+            logging.debug("%s is at %s" % (int_to_ip(sender), tgt_mac))
+            offset = sender - network
+            occupied[offset / 8] |= 1 << (offset % 8)
+    finally:
+        sock.close()
+    return occupied
+
+
+def find_free_ips(iface, ip, mac, netmask, count=1, exclude=(), batch=64,
+                  metrics=None):
+    '''
+    Find count free IPs on the subnet of iface, probing a batch of addresses
+    at each ARP sweep.
+    IPs listed in exclude are never returned, even if nobody answers for them.
+    Each sweep and the addresses it probed are counted in metrics, if given.
+    '''
+    network, size = subnet_range(ip, netmask)
+    skip = set(ip_to_int(x) for x in exclude)
+    skip.add(ip_to_int(ip))
+
+    # Walk the whole subnet once, in a scattered order : an odd stride is
+    # coprime with the size of the subnet so every offset comes exactly once.
+    start = random.randrange(size)
+    stride = random.randrange(1, max(size, 2), 2)
+    walk = ((start + i * stride) % size for i in xrange(size))
+
+    free = []
+    while len(free) < count:
+        candidates = []
+        for offset in walk:
+            value = network + offset
+            if value in skip or not usable_ip(value, network, size):
+                continue
+            candidates.append(value)
+            if len(candidates) >= max(batch, count - len(free)):
+                break
+        if not candidates:
+            logging.error("No free IP left on %s." % iface)
+            break
+
+        if metrics is not None:
+            sweep_start = metrics.now()
+        occupied = arp_sweep(iface, ip, mac, netmask, candidates)
+        if metrics is not None:
+            metrics.observe('arp_sweep', sweep_start)
+            metrics.count('arp_probes', len(candidates))
+        for value in candidates:
+            offset = value - network
+            if not occupied[offset / 8] & (1 << (offset % 8)):
+                free.append(int_to_ip(value))
+
+    free = free[:count]
+    logging.debug("Using %s IP." % ", ".join(free))
+    return free
+
+
+def find_free_ip(iface, ip, mac, netmask, exclude=(), metrics=None):
     '''
     Try to find a free ip on the subnet of iface
+    IPs listed in exclude are never returned, even if nobody answers for them.
     '''
-    exist = True
-    test_ip = None
-    while exist:
-        test_ip = random_ip_in_subnet(ip, netmask)
-        exist = send_arp(iface, ip, mac, test_ip, 'REQUEST')
-    logging.debug("Using %s IP." % test_ip)
-    return test_ip
-
-
-def tlvs(data):
-    '''TLVs parser generator'''
-    dict_data = {}
-    while data:
-        typ, length = unpack('!4sL', data[:8])
-        value = unpack('!%is' % length, data[8:8 + length])[0]
-        if typ == "INTF" or typ == "IPV4":
-            data = data[8:]  # Skip INTF header
-            continue
-        dict_data[typ.rstrip(' \t\r\n\0')] = value.rstrip(' \t\r\n\0')
-        data = data[8 + length:]
-    return dict_data
+    free = find_free_ips(iface, ip, mac, netmask, 1, exclude, metrics=metrics)
+    if not free:
+        return None
+    return free[0]
 
 
 def ipcomm_info(receive_port, mac_target, ip_target):
@@ -279,7 +442,7 @@ def ipcomm_info(receive_port, mac_target, ip_target):
     Then will parse the INFO packet and return the first found ip.
     '''
     ip = None
-    pkt = pack('!4s14x', "\x4c\x4f\x4f\x4b")  # LOOK (at the ring !)
+    pkt = LOOK_PACKET
 
     socket.setdefaulttimeout(60)
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -299,19 +462,19 @@ def ipcomm_info(receive_port, mac_target, ip_target):
     tryout = 0  # Number of tries, don't want to stay here forever
     while ip is None and tryout < 10:
         sock.sendto(pkt, ('255.255.255.255', receive_port))
-        stop = clock() + 0.05
-        while stop > clock() and ip is None:
+        stop = time() + 0.05
+        while ip is None:
+            remaining = stop - time()
+            if remaining <= 0 or not select([sock], [], [], remaining)[0]:
+                break
             try:
                 serv_data = sock.recv(1024)
-            except:
-                continue
-            if len(serv_data) <= 8:
+            except socket.error:
                 continue
-            info = unpack('!4s', serv_data[:4])
-            if info[0] != "INFO":
+            data = parse_info(serv_data)
+            if data is None:
                 continue
-            data = tlvs(serv_data[8:])  # strip info header
-            if data["MAC"].lower() == mac_target.lower():
+            if data.get("MAC", "").lower() == mac_target.lower():
                 if data["ADDR"].lower() != ip_target.lower():
                     continue
                 ip = data["ADDR"]
@@ -0,0 +1,151 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+pacing decides when the next command can be sent to U-Boot.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import random
+import sys
+sys.dont_write_bytecode = True
+
+
+class Pacer(object):
+    '''
+    U-Boot is ready for the next command as soon as its prompt is out and
+    the line went quiet. The Pacer picks the quiet period to wait for after
+    each prompt and only backs off when U-Boot dropped characters of a
+    command.
+    '''
+
+    def __init__(self, quiet=0.05, max_delay=1.0, backoff=2.0):
+        self.min_quiet = quiet
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.delays = []  # (cmd, delay) for every paced command
+
+    def record(self, cmd, delay):
+        '''Remember the delay chosen before cmd'''
+        self.delays.append((cmd, delay))
+        logging.debug("%.3fs before %s", delay, cmd)
+
+    def feedback(self, cmd, echo):
+        '''
+        Adapt the quiet period from the echo U-Boot gave for cmd.
+        Return True if the echo was complete.
+        '''
+        if echo.startswith(cmd):
+            # Come back to the fastest pace, one step at a time.
+            self.quiet = max(self.min_quiet, self.quiet / self.backoff)
+            return True
+        self.quiet = min(self.max_delay, self.quiet * self.backoff)
+        logging.debug("Bad echo for %s (%r), slowing down to %.3fs",
+                      cmd, echo, self.quiet)
+        return False
+
+    def report(self):
+        '''
+        Log a summary of the chosen delays.
+        '''
+        if not self.delays:
+            return
+        delays = [delay for _, delay in self.delays]
+        logging.debug("Paced %d commands : %.3fs total, %.3fs mean, "
+                      "%.3fs max", len(delays), sum(delays),
+                      sum(delays) / len(delays), max(delays))
+
+
+class CatchStrategy(object):
+    '''
+    How LUMP and Ctrl-C are sent while waiting for a device to reboot.
+    Every round sends a LUMP, a Ctrl-C ctrl_c_delay seconds later, and
+    listens until the next round, interval seconds (+/- jitter) after the
+    first. With flood set, rounds only last flood seconds until the device
+    sent its first byte, to hit a short autoboot window.
+    The counters of the last catch are kept for report().
+    '''
+
+    def __init__(self, interval=1.2, ctrl_c_delay=0.2, jitter=0.0,
+                 flood=None):
+        self.interval = interval
+        self.ctrl_c_delay = ctrl_c_delay
+        self.jitter = jitter
+        self.flood = flood
+        self.random = random.Random()
+        self.start(0)
+
+    def start(self, now):
+        '''Reset the counters, a catch starts now'''
+        self.started = now
+        self.lumps = 0
+        self.ctrl_c = 0
+        self.first_byte = None
+        self.duration = None
+        self.caught = False
+
+    def round_length(self, quiet=True):
+        '''
+        Seconds until the next round, quiet tells if nothing was heard yet.
+        '''
+        length = self.interval
+        if self.flood is not None and quiet:
+            length = self.flood
+        if self.jitter:
+            length += self.random.uniform(-self.jitter, self.jitter)
+        return max(length, 0.001)
+
+    def ctrl_c_after(self, length):
+        '''
+        Seconds between the LUMP and the Ctrl-C of a round of length seconds.
+        '''
+        return min(self.ctrl_c_delay, length / 2)
+
+    def heard(self, now):
+        '''The device sent something'''
+        if self.first_byte is None:
+            self.first_byte = now - self.started
+            logging.debug("First netconsole byte after %.3fs",
+                          self.first_byte)
+
+    def done(self, now, caught):
+        self.duration = now - self.started
+        self.caught = caught
+
+    def report(self):
+        '''
+        Log how long the catch took and what it sent.
+        '''
+        if self.caught:
+            logging.info("Caught after %.3fs, %d LUMP and %d Ctrl-C sent",
+                         self.duration, self.lumps, self.ctrl_c)
+        else:
+            logging.info("Not caught after %.3fs, %d LUMP and %d Ctrl-C "
+                         "sent", self.duration, self.lumps, self.ctrl_c)
@@ -0,0 +1,118 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+pipeline packs several script lines into one netconsole line.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import re
+import sys
+sys.dont_write_bytecode = True
+
+# CONFIG_SYS_CBSIZE of the LaCie U-Boot, the longest line it reads
+LINE_LIMIT = 256
+
+# Commands giving the prompt back right away, without asking anything.
+# Everything else (bubt and its y, tftp, bootm, reset...) is a barrier and
+# is sent on its own line.
+MERGEABLE = ('setenv', 'set', 'printenv', 'print', 'echo')
+
+# Echoed after every command but the last of a line, to find the output of
+# each one.
+MARKER = '@lu%d@'
+MARKER_LINE = re.compile(r'@lu(\d+)@\r?\n')
+
+
+def mergeable(cmd):
+    '''
+    Tell if cmd may share a line with others : a known command which
+    can't change how the line is split.
+    '''
+    words = cmd.split(None, 1)
+    if not words or words[0] not in MERGEABLE:
+        return False
+    return not any(char in cmd for char in ';\'"\\#')
+
+
+def plan(commands, limit=LINE_LIMIT):
+    '''
+    Group commands, in order, in as few lines as possible, shorter than limit
+    characters so the newline fits too. Return a list of groups, a group of
+    one command is sent as it is.
+    '''
+    groups = []
+    group = []
+    for cmd in commands:
+        if not mergeable(cmd):
+            if group:
+                groups.append(group)
+                group = []
+            groups.append([cmd])
+            continue
+        if group and len(join(group + [cmd])) >= limit:
+            groups.append(group)
+            group = []
+        group.append(cmd)
+    if group:
+        groups.append(group)
+    return groups
+
+
+def join(group):
+    '''
+    The line running every command of group, with a marker after each one
+    but the last.
+    '''
+    parts = []
+    for index, cmd in enumerate(group):
+        parts.append(cmd)
+        if index < len(group) - 1:
+            parts.append('echo ' + MARKER % index)
+    return '; '.join(parts)
+
+
+def split(output, count):
+    '''
+    Cut the output of a line made by join() into the output of each of its
+    count commands. What can't be attributed, when a marker is missing,
+    goes with the command before it.
+    '''
+    outputs = [''] * count
+    start = 0
+    current = 0
+    for match in MARKER_LINE.finditer(output):
+        index = int(match.group(1))
+        if index < current or index >= count - 1:
+            continue
+        outputs[current] += output[start:match.start()]
+        start = match.end()
+        current = index + 1
+    outputs[current] += output[start:]
+    return outputs
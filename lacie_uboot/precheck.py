@@ -0,0 +1,170 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+precheck tells if a device already runs an image, to skip its update.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import hashlib
+import mmap
+import os
+import re
+import sys
+from time import time
+from zlib import crc32
+sys.dont_write_bytecode = True
+
+from eventloop import Return
+from leases import locked_json
+
+UPDATE_FILE = '/var/lib/lacie-uboot/updates.json'
+
+# U-Boot 2009.11 (Nov 12 2010 - 17:31:23), as printed by version and as
+# built into every U-Boot image.
+UBOOT_VERSION = re.compile(r'U-Boot [\x20-\x27\x2a-\x7e]+'
+                           r'\([\x20-\x28\x2a-\x7e]+\)')
+# CRC32 for 00800000 ... 0087ffff ==> 1a2b3c4d
+CRC32_OUTPUT = re.compile(r'==> ([0-9a-fA-F]{8})')
+
+
+def image_digest(path):
+    '''
+    Return the SHA-1 of the file at path, and its size.
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as image:
+        size = os.fstat(image.fileno()).st_size
+        if size:
+            data = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest.update(data)
+            finally:
+                data.close()
+    return digest.hexdigest(), size
+
+
+def image_crc32(path):
+    '''
+    Return the CRC32 of the file at path, as printed by the crc32 command.
+    '''
+    value = 0
+    with open(path, 'rb') as image:
+        for chunk in iter(lambda: image.read(1024 * 1024), ''):
+            value = crc32(chunk, value)
+    return "%08x" % (value & 0xffffffff)
+
+
+def image_version(path):
+    '''
+    Return the version string built into the U-Boot image at path, or None.
+    '''
+    with open(path, 'rb') as image:
+        if os.fstat(image.fileno()).st_size == 0:
+            return None
+        data = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            match = UBOOT_VERSION.search(data)
+            return match and match.group(0)
+        finally:
+            data.close()
+
+
+class UpdateRegistry(object):
+    '''
+    What was last written on each device, kept in a JSON file shared by
+    every lacie-uboot process of the host : MAC -> kind ('capsule' or
+    'uboot') -> digest and name of the image, the U-Boot version the device
+    had then and when.
+    '''
+
+    def __init__(self, path=UPDATE_FILE):
+        self.path = path
+
+    def lookup(self, mac_target, kind):
+        '''
+        Return the record of the last kind image written on mac_target, or
+        None.
+        '''
+        with locked_json(self.path) as updates:
+            return updates.get(mac_target.lower(), {}).get(kind)
+
+    def record(self, mac_target, kind, digest, name, version):
+        with locked_json(self.path) as updates:
+            updates.setdefault(mac_target.lower(), {})[kind] = {
+                'digest': digest,
+                'name': name,
+                'version': version,
+                'time': time()}
+
+
+def device_state(session, crc_addr=None, size=None, flash_read=None):
+    '''
+    Coroutine reading the state of a caught device with session : its U-Boot
+    version and, if crc_addr is given, the CRC32 of size bytes at crc_addr,
+    after flash_read (a command formatted with size) copied the flash there.
+    The result is a dict, a value is None when the device did not tell.
+    '''
+    state = {'version': None, 'crc32': None}
+    result = yield session._invoke('version', False)
+    match = UBOOT_VERSION.search(result.output)
+    if match:
+        state['version'] = match.group(0)
+
+    if crc_addr is not None and size:
+        if flash_read is not None:
+            yield session._invoke(flash_read % {'size': size}, False)
+        result = yield session._invoke('crc32 %s %x' % (crc_addr, size),
+                                       False)
+        match = CRC32_OUTPUT.search(result.output)
+        if match:
+            state['crc32'] = match.group(1).lower()
+    raise Return(state)
+
+
+def is_current(kind, image, state, record):
+    '''
+    Tell if a device whose state is given by device_state already runs
+    image, a dict with the kind, digest, version and crc32 of the image.
+    record is what the UpdateRegistry knows about the device, or None.
+    '''
+    if state['version'] is None:
+        return False
+    if kind == 'uboot':
+        if image['version'] is None or state['version'] != image['version']:
+            return False
+        # Same version, the flash may still differ : trust the CRC32 when
+        # it was read.
+        if state['crc32'] is not None:
+            return state['crc32'] == image['crc32']
+        return True
+    # Nothing of the system shows from U-Boot, only what we wrote last
+    # time, if U-Boot was not replaced since.
+    return record is not None and record['digest'] == image['digest'] and \
+        record['version'] == state['version']
@@ -0,0 +1,152 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+protocol holds the codecs of the LaCie packets : LUMP, LOOK and INFO.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+from binascii import unhexlify
+import socket
+from struct import Struct
+import sys
+sys.dont_write_bytecode = True
+
+# Note : The empty MAC are 8 bytes in length according to the reverse
+# engineering done with WireShark. Don't know why exactly...
+LUMP = Struct('!I'   # LUMP
+              'L'    # Length of LUMP
+              'I'    # MACD
+              'L'    # Length of MACD
+              'I'    # MAC@
+              'L'    # Length of MAC@ field
+              '2x'   # fill space because MAC take only 6 bytes
+              '6s'   # MAC address of target
+              'I'    # IPS
+              'L'    # Length of IPS
+              'I'    # IP@
+              'L'    # Length of IP@
+              '4s'   # IP of the target
+              'I'    # MACS
+              'L'    # Length of MACS
+              'I'    # MAC address of source
+              'L'    # Length of MAC@
+              '8x')  # Empty MAC
+LOOK = Struct('!4s14x')
+INFO_HEADER = Struct('!4s4x')
+TLV_HEADER = Struct('!4sL')
+
+LOOK_PACKET = LOOK.pack("\x4c\x4f\x4f\x4b")  # LOOK (at the ring !)
+# These TLVs hold other TLVs, only their header is skipped
+CONTAINERS = ("INTF", "IPV4")
+
+_lumps = {}
+MAX_LUMPS = 4096
+
+
+def lump_packet(mac_target, ip_target):
+    '''
+    Build the LUMP (LaCie U-Boot Magic Packet) asking the device with
+    mac_target to take ip_target and to open its netconsole.
+    Each packet is built once, then taken from a cache.
+    '''
+    key = (mac_target.lower(), ip_target)
+    packet = _lumps.get(key)
+    if packet is None:
+        if len(_lumps) >= MAX_LUMPS:
+            _lumps.clear()
+        packet = LUMP.pack(0x4C554D50,  # LUMP
+                           0x44,
+                           0x4D414344,  # MACD
+                           0x10,
+                           0x4D414340,  # MAC
+                           0x8,
+                           unhexlify(mac_target.replace(':', '')),
+                           0x49505300,  # IPS
+                           0x0C,
+                           0x49504000,  # IP
+                           0x4,
+                           socket.inet_aton(ip_target),
+                           0x4D414353,  # MACS
+                           0x10,
+                           0x4D414340,  # MAC
+                           0x8)
+        _lumps[key] = packet
+    return packet
+
+
+def tlvs(data):
+    '''
+    Parse the TLVs of data, a string or a buffer on one, into a dict, types
+    and values are stripped of their padding. Only the values are copied,
+    once.
+    '''
+    unpack_from = TLV_HEADER.unpack_from
+    end = len(data)
+    offset = 0
+    fields = {}
+    while offset + 8 <= end:
+        typ, length = unpack_from(data, offset)
+        offset += 8
+        if typ in CONTAINERS:
+            continue
+        if offset + length > end:
+            break
+        fields[typ.rstrip(' \t\r\n\0')] = \
+            data[offset:offset + length].rstrip(' \t\r\n\0')
+        offset += length
+    return fields
+
+
+def parse_info(data):
+    '''
+    Return the TLVs of an INFO packet as a dict, or None if data is not one.
+    '''
+    if len(data) <= INFO_HEADER.size or data[:4] != "INFO":
+        return None
+    return tlvs(buffer(data, INFO_HEADER.size))
+
+
+def parse_lump(data):
+    '''
+    Return the (mac, ip) asked by a LUMP packet, or None if data is not one.
+    '''
+    if len(data) != LUMP.size or data[:4] != "LUMP":
+        return None
+    fields = LUMP.unpack(data)
+    mac = ':'.join('%02x' % ord(byte) for byte in fields[6])
+    return mac, socket.inet_ntoa(fields[11])
+
+
+def info_packet(fields):
+    '''
+    Build the INFO answer of a device, fields is a list of (type, value).
+    '''
+    return INFO_HEADER.pack("INFO") + ''.join(
+        TLV_HEADER.pack(typ, len(value)) + value for typ, value in fields)
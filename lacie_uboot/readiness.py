@@ -0,0 +1,295 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+readiness follows a device booting after a reset, to know as soon as it is
+reachable instead of sleeping for the worst case.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import socket
+from struct import unpack
+import sys
+from time import time
+sys.dont_write_bytecode = True
+
+from broker import open_netconsole
+from discovery import find_device, query
+from eventloop import DatagramEndpoint, Future, Return
+from protocol import parse_info, LOOK_PACKET
+
+ETH_P_ALL = 0x0003
+# Phases of a boot, in the order they should happen.
+PHASES = ('console_quiet', 'link', 'ipcomm')
+
+
+class IpcommProtocol(object):
+    '''
+    Waits for the INFO answer of a device to our LOOK packets.
+    '''
+
+    def __init__(self, future, mac_target, ip_target):
+        self.future = future
+        self.mac_target = mac_target.lower()
+        self.ip_target = ip_target.lower()
+
+    def datagram_received(self, data, addr):
+        info = parse_info(data)
+        if info is None:
+            return
+        if info.get("MAC", "").lower() != self.mac_target:
+            return
+        if info.get("ADDR", "").lower() != self.ip_target:
+            return
+        self.future.set_result(info["ADDR"])
+
+
+class LinkProtocol(object):
+    '''
+    Spots the first gratuitous ARP or DHCP request sent by a MAC address,
+    from the frames of a packet socket.
+    '''
+
+    def __init__(self, callback, mac_target):
+        self.callback = callback
+        self.mac = ''.join(chr(int(byte, 16))
+                           for byte in mac_target.split(':'))
+
+    def datagram_received(self, data, addr):
+        if len(data) < 42 or data[6:12] != self.mac:
+            return
+        ethertype = data[12:14]
+        if ethertype == '\x08\x06':
+            # A gratuitous ARP has the same sender and target IP
+            if data[28:32] == data[38:42]:
+                self.callback('arp')
+        elif ethertype == '\x08\x00' and data[23] == '\x11':
+            header = (ord(data[14]) & 0x0f) * 4
+            dport = data[14 + header + 2:14 + header + 4]
+            if len(dport) == 2 and unpack('!H', dport)[0] == 67:
+                self.callback('dhcp')
+
+
+class BootWatcher(object):
+    '''
+    Follows a device from its reset until it answers IPCOMM.
+    It listens to its netconsole until it goes quiet, watches the network
+    for its first gratuitous ARP or DHCP request, and looks for it with
+    IPCOMM, slowly until the link is up and then every second.
+    If a discovery daemon is running, it is asked instead.
+    Several watchers of one process share the netconsole endpoint given as
+    console, and the DiscoveryDaemon given as discovery.
+    timings holds the time each phase was reached, from the start.
+    '''
+
+    def __init__(self, loop, mac_target, ip_target, iface=None,
+                 uboot_port=6666, receive_port=4445, timeout=600,
+                 console=None, discovery=None):
+        self.loop = loop
+        self.mac_target = mac_target
+        self.ip_target = ip_target
+        self.iface = iface
+        self.uboot_port = uboot_port
+        self.receive_port = receive_port
+        self.timeout = timeout
+        # Seconds without netconsole output before it is considered quiet
+        self.quiet = 3
+        # Seconds between two LOOK, before and after the link is up
+        self.slow_look = 10
+        self.fast_look = 1
+        self.timings = {}
+        self._start = None
+        self._last_output = None
+        self._last_look = None
+        self._wake = None
+        self._console = console
+        self._own_console = console is None
+        self._discovery = discovery
+        self._link = None
+        self._ipcomm = None
+        self._daemon = False
+        self._since = None
+
+    def datagram_received(self, data):
+        '''
+        Called by the netconsole endpoint for every datagram of the device.
+        '''
+        self._last_output = self.loop.time()
+
+    def _reached(self, phase, when=None):
+        if phase in self.timings:
+            return
+        if when is None:
+            when = self.loop.time()
+        self.timings[phase] = when - self._start
+        logging.debug("%s reached after %.1fs", phase, self.timings[phase])
+        self._poke()
+
+    def _link_up(self, kind):
+        if 'link' not in self.timings:
+            logging.debug("First %s from %s", kind.upper(), self.mac_target)
+            self._reached('link')
+
+    def _poke(self, *args):
+        if self._wake is not None:
+            self._wake.set_result(None)
+
+    def _open(self, found):
+        '''
+        Open the sockets of every phase, IPCOMM is mandatory, through the
+        discovery daemon or our own socket.
+        '''
+        try:
+            if self._discovery is not None:
+                self._discovery.look()
+            else:
+                query('LOOK')
+            self._daemon = True
+            logging.debug("Asking the discovery daemon for %s",
+                          self.mac_target)
+        except socket.error:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            try:
+                sock.bind(('', self.receive_port))
+            except socket.error, err:
+                logging.error("Couldn't be a udp server on port %d : %s",
+                              self.receive_port, err)
+                sock.close()
+                return False
+            self._ipcomm = DatagramEndpoint(self.loop, sock, IpcommProtocol(
+                found, self.mac_target, self.ip_target))
+
+        try:
+            if self._console is None:
+                self._console = open_netconsole(self.loop, self.uboot_port)
+            self._console.register(self.ip_target, self)
+        except socket.error, err:
+            logging.debug("Not watching the netconsole : %s", err)
+
+        if self.iface is not None and hasattr(socket, 'AF_PACKET'):
+            try:
+                sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+                sock.bind((self.iface, ETH_P_ALL))
+                self._link = DatagramEndpoint(self.loop, sock, LinkProtocol(
+                    self._link_up, self.mac_target))
+            except socket.error, err:
+                logging.debug("Not watching the link : %s", err)
+        return True
+
+    def _look(self, found):
+        '''
+        Send a LOOK, or ask the daemon if it saw the device since we started.
+        '''
+        if not self._daemon:
+            self._ipcomm.sendto(LOOK_PACKET, ('255.255.255.255',
+                                              self.receive_port))
+            return
+        if self._discovery is not None:
+            record = self._discovery.index.lookup(self.mac_target)
+            if record is not None and record['last_seen'] >= self._since \
+                    and record['ip'].lower() == self.ip_target.lower():
+                found.set_result(str(record['ip']))
+            else:
+                self._discovery.look()
+            return
+        try:
+            ip = find_device(self.mac_target, self.ip_target, self._since)
+            if ip is not None:
+                found.set_result(ip)
+            else:
+                query('LOOK')
+        except socket.error, err:
+            logging.debug("Discovery daemon error : %s", err)
+
+    def close(self):
+        if self._console is not None and not self._own_console:
+            self._console.unregister(self.ip_target)
+            self._console = None
+        for endpoint in (self._ipcomm, self._console, self._link):
+            if endpoint is not None:
+                endpoint.close()
+        self._ipcomm = self._console = self._link = None
+
+    def watch(self):
+        '''
+        Coroutine, the result is the IP of the device once it answered
+        IPCOMM, or None if it did not before the timeout.
+        '''
+        self._start = self._last_output = self.loop.time()
+        self._since = time()
+        deadline = self._start + self.timeout
+        found = Future(self.loop)
+        if not self._open(found):
+            raise Return(None)
+        found.add_done_callback(self._poke)
+
+        next_look = self._start
+        try:
+            while not found.done():
+                now = self.loop.time()
+                if now >= deadline:
+                    break
+                if self._console is not None and \
+                        now - self._last_output >= self.quiet:
+                    self._reached('console_quiet', self._last_output)
+                if 'link' in self.timings and self._last_look is not None:
+                    next_look = min(next_look, self._last_look + self.fast_look)
+                if now >= next_look:
+                    self._look(found)
+                    self._last_look = now
+                    next_look = now + (self.fast_look if 'link' in self.timings
+                                       else self.slow_look)
+                wake_at = min(next_look, deadline)
+                if 'console_quiet' not in self.timings and \
+                        self._console is not None:
+                    wake_at = min(wake_at, self._last_output + self.quiet)
+                self._wake = Future(self.loop)
+                timer = self.loop.call_later(max(wake_at - now, 0), self._poke)
+                yield self._wake
+                timer.cancel()
+                self._wake = None
+        finally:
+            self.close()
+
+        if not found.done():
+            raise Return(None)
+        self._reached('ipcomm')
+        raise Return(found.result())
+
+    def report(self):
+        '''
+        Log the time each phase was reached.
+        '''
+        for phase in PHASES:
+            if phase in self.timings:
+                logging.info("%-14s %6.1fs", phase, self.timings[phase])
+            else:
+                logging.info("%-14s %7s", phase, "-")
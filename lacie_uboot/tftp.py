@@ -0,0 +1,629 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+tftp is a read-only TFTP server (RFC 1350, with the blksize, tsize, timeout
+and windowsize options of RFC 2347, 2348, 2349 and 7440, and the multicast
+option of RFC 2090) running on the event loop of a session, so U-Boot can
+fetch its images from our process.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import mmap
+import os
+import socket
+from struct import pack, unpack, error as struct_error
+import sys
+sys.dont_write_bytecode = True
+
+from eventloop import DatagramEndpoint
+
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+ERR_NOT_FOUND = 1
+ERR_ACCESS = 2
+ERR_ILLEGAL = 4
+ERR_UNKNOWN_TID = 5
+
+DEFAULT_BLKSIZE = 512
+MAX_BLKSIZE = 65464
+MAX_WINDOWSIZE = 64
+
+# The tftp-mcast port of IANA, and a group of the local scope
+MULTICAST_GROUP = ('239.255.69.1', 1758)
+
+
+def error_packet(code, message):
+    return pack('!HH', OP_ERROR, code) + message + '\0'
+
+
+def parse_request(data):
+    '''
+    Split a RRQ/WRQ packet into (opcode, filename, mode, options).
+    Option names are lowercased, as they are case insensitive.
+    '''
+    opcode = unpack('!H', data[:2])[0]
+    fields = data[2:].split('\0')
+    if len(fields) < 3:
+        raise ValueError("Truncated request")
+    filename, mode = fields[0], fields[1].lower()
+    options = {}
+    for i in range(2, len(fields) - 2, 2):
+        options[fields[i].lower()] = fields[i + 1]
+    return opcode, filename, mode, options
+
+
+class Transfer(object):
+    '''
+    Sends one file to one client, from its own socket (the TID of the
+    transfer). With windowsize, several blocks are sent before waiting for
+    the ACK of the last one.
+    '''
+
+    def __init__(self, server, client, filename, data, options):
+        self.server = server
+        self.loop = server.loop
+        self.client = client
+        self.destination = client  # Where the blocks are sent
+        self.filename = filename
+        self.data = data
+        self.size = len(data)
+        self.blksize = DEFAULT_BLKSIZE
+        self.windowsize = 1
+        self.timeout = server.timeout
+        self.retries = 0
+        self.retransmits = 0
+        self.sent_bytes = 0
+        self.acked = 0  # Last block acknowledged by the client
+        self.sent = 0  # Last block sent
+        self.timer = None
+        self.paced = None  # Sends the rest of the window, under max_rate
+        self.done = False
+        self.start = self.loop.time()
+        self.elapsed = None
+
+        accepted = self.negotiate(options)
+        self.blocks = self.size / self.blksize + 1
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((server.ip, 0))
+        self.endpoint = DatagramEndpoint(self.loop, sock, self)
+        self.begin(accepted)
+
+    def begin(self, accepted):
+        '''
+        Acknowledge the options accepted, or send the first block.
+        '''
+        if accepted:
+            self.oack = pack('!H', OP_OACK) + ''.join(
+                '%s\0%s\0' % item for item in accepted.items())
+            self.endpoint.sendto(self.oack, self.client)
+            self.arm()
+        else:
+            self.oack = None
+            self.send_window()
+
+    def negotiate(self, options):
+        '''
+        Take the options asked by the client which we support,
+        return the ones to acknowledge.
+        '''
+        accepted = {}
+        try:
+            if 'blksize' in options:
+                self.blksize = min(max(int(options['blksize']), 8),
+                                   self.server.max_blksize)
+                accepted['blksize'] = str(self.blksize)
+            if 'windowsize' in options:
+                self.windowsize = min(max(int(options['windowsize']), 1),
+                                      self.server.max_windowsize)
+                accepted['windowsize'] = str(self.windowsize)
+            if 'timeout' in options:
+                self.timeout = min(max(int(options['timeout']), 1), 255)
+                accepted['timeout'] = str(self.timeout)
+            if 'tsize' in options:
+                accepted['tsize'] = str(self.size)
+        except ValueError:
+            logging.debug("Bad TFTP options from %s : %s", self.client[0],
+                          options)
+        return accepted
+
+    def arm(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(self.timeout, self.expired)
+
+    def send_window(self):
+        '''
+        Send the blocks after the last one sent, up to a window after the
+        last acknowledged one. Under the max_rate of the server, the rest of
+        the window waits for its turn, and the timeout starts once it is
+        sent.
+        '''
+        if self.paced is not None:
+            self.paced.cancel()
+            self.paced = None
+        last = min(self.acked + self.windowsize, self.blocks)
+        while self.sent < last:
+            block = self.sent + 1
+            offset = (block - 1) * self.blksize
+            chunk = self.data[offset:offset + self.blksize]
+            delay = self.server.spend(len(chunk))
+            if delay:
+                self.paced = self.loop.call_later(delay, self.send_window)
+                return
+            self.endpoint.sendto(pack('!HH', OP_DATA, block & 0xFFFF) + chunk,
+                                 self.destination)
+            self.sent_bytes += len(chunk)
+            self.sent = block
+        self.arm()
+
+    def expired(self):
+        '''
+        Nothing came back in time, send the whole window again.
+        '''
+        self.retries += 1
+        if self.retries > self.server.retries:
+            logging.error("TFTP transfer of %s to %s timed out.",
+                          self.filename, self.client[0])
+            self.finish(False)
+            return
+        self.retransmits += 1
+        if self.oack is not None:
+            self.endpoint.sendto(self.oack, self.client)
+            self.arm()
+            return
+        self.sent = self.acked
+        self.send_window()
+
+    def datagram_received(self, data, addr):
+        if addr != self.client:
+            self.endpoint.sendto(error_packet(ERR_UNKNOWN_TID, "Unknown TID"),
+                                 addr)
+            return
+        if len(data) < 4:
+            return
+        opcode, block = unpack('!HH', data[:4])
+        if opcode == OP_ERROR:
+            logging.error("TFTP client %s aborted %s : %s", addr[0],
+                          self.filename, data[4:].rstrip('\0'))
+            self.finish(False)
+            return
+        if opcode != OP_ACK:
+            return
+
+        if self.oack is not None:
+            if block == 0:
+                self.oack = None
+                self.retries = 0
+                self.send_window()
+            return
+
+        # Block numbers roll over at 65536, find the one of our window.
+        block += self.acked - (self.acked & 0xFFFF)
+        if block < self.acked:
+            block += 0x10000
+        if block <= self.acked or block > self.sent:
+            return  # Duplicate or stray ACK
+        self.acked = block
+        self.retries = 0
+        if self.acked == self.blocks:
+            self.finish(True)
+            return
+        if self.acked < self.sent:
+            # The client lost a block of the window, resume after its ACK.
+            self.retransmits += 1
+            self.sent = self.acked
+        self.send_window()
+
+    def finish(self, success):
+        if self.done:
+            return
+        self.done = True
+        self.elapsed = self.loop.time() - self.start
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.paced is not None:
+            self.paced.cancel()
+        self.endpoint.close()
+        if success:
+            logging.info("TFTP sent %s to %s : %d bytes in %.2fs "
+                         "(%.1f KiB/s, blksize %d, windowsize %d, "
+                         "%d retransmits)", self.filename, self.client[0],
+                         self.size, self.elapsed, self.throughput() / 1024,
+                         self.blksize, self.windowsize, self.retransmits)
+        self.server.transfer_done(self, success)
+
+    def throughput(self):
+        '''Bytes per second of the file, once the transfer is done.'''
+        if not self.elapsed:
+            return 0.0
+        return self.size / self.elapsed
+
+
+class MulticastClient(object):
+    '''
+    What a client of a MulticastTransfer got, like a Transfer : it sent
+    nothing itself, the blocks went to the group.
+    '''
+
+    def __init__(self, transfer, client):
+        self.client = client
+        self.filename = transfer.filename
+        self.size = transfer.size
+        self.blksize = transfer.blksize
+        self.windowsize = transfer.windowsize
+        self.blocks = transfer.blocks
+        self.retransmits = 0
+        self.sent_bytes = 0
+        self.start = transfer.loop.time()
+        self.elapsed = None
+
+    def throughput(self):
+        '''Bytes per second of the file, once the client has it.'''
+        if not self.elapsed:
+            return 0.0
+        return self.size / self.elapsed
+
+
+class MulticastTransfer(Transfer):
+    '''
+    Sends one file once to every client asking for it with the multicast
+    option (RFC 2090) : the blocks go to the multicast group of the server,
+    and only the master client acknowledges them. Clients asking while it
+    runs join the group and keep what they hear. Once the master has the
+    whole file, the next client becomes the master and acknowledges the
+    last block it has in sequence, so it only gets sent what it missed.
+    '''
+
+    def begin(self, accepted):
+        sock = self.endpoint.sock
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if self.server.ip:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                            socket.inet_aton(self.server.ip))
+        self.destination = self.server.multicast
+        self.accepted = accepted
+        self.clients = []  # Clients without the whole file, master first
+        self.records = {}  # client -> MulticastClient
+        self.join(self.client)
+
+    def joins(self, options):
+        '''
+        Tell if a client asking with options can join the transfer : the
+        group has one block size.
+        '''
+        try:
+            return not self.done and \
+                int(options.get('blksize', DEFAULT_BLKSIZE)) >= self.blksize
+        except ValueError:
+            return False
+
+    def oack_for(self, master):
+        group = '%s,%d,%d' % (self.server.multicast + (int(master),))
+        return pack('!H', OP_OACK) + ''.join(
+            '%s\0%s\0' % item for item in self.accepted.items()) + \
+            'multicast\0%s\0' % group
+
+    def join(self, client):
+        '''
+        Add client, it becomes the master if there is none.
+        '''
+        if client in self.records:
+            # It asked again, our OACK was lost
+            self.endpoint.sendto(self.oack_for(client == self.client),
+                                 client)
+            return
+        self.clients.append(client)
+        self.records[client] = MulticastClient(self, client)
+        if len(self.clients) == 1:
+            self.promote()
+        else:
+            self.endpoint.sendto(self.oack_for(False), client)
+
+    def promote(self):
+        '''
+        Make the first waiting client the master.
+        '''
+        if self.paced is not None:
+            self.paced.cancel()
+            self.paced = None
+        self.client = self.clients[0]
+        self.retries = 0
+        self.oack = self.oack_for(True)
+        self.endpoint.sendto(self.oack, self.client)
+        self.arm()
+
+    def leave(self, client, success):
+        '''
+        Client got the whole file, or gave up, the next one takes over.
+        '''
+        self.clients.remove(client)
+        record = self.records.pop(client)
+        record.elapsed = self.loop.time() - record.start
+        self.server.transfer_done(record, success)
+        if client != self.client:
+            return
+        if self.clients:
+            self.promote()
+        else:
+            self.finish(True)
+
+    def expired(self):
+        '''
+        The master did not answer in time, send the OACK or the window
+        again, or give it up for the next client.
+        '''
+        self.retries += 1
+        if self.retries > self.server.retries:
+            logging.error("TFTP multicast of %s to %s timed out.",
+                          self.filename, self.client[0])
+            self.leave(self.client, False)
+            return
+        self.retransmits += 1
+        if self.oack is not None:
+            self.endpoint.sendto(self.oack, self.client)
+            self.arm()
+            return
+        self.sent = self.acked
+        self.send_window()
+
+    def datagram_received(self, data, addr):
+        if addr not in self.records:
+            self.endpoint.sendto(error_packet(ERR_UNKNOWN_TID, "Unknown TID"),
+                                 addr)
+            return
+        if len(data) < 4:
+            return
+        opcode, block = unpack('!HH', data[:4])
+        if opcode == OP_ERROR:
+            logging.error("TFTP client %s aborted %s : %s", addr[0],
+                          self.filename, data[4:].rstrip('\0'))
+            self.leave(addr, False)
+            return
+        if opcode != OP_ACK or addr != self.client:
+            return  # Only the master acknowledges
+
+        if self.oack is not None:
+            # The new master tells where it stands, even behind us
+            self.oack = None
+        elif block <= self.acked:
+            return  # Duplicate or stray ACK
+        self.acked = min(block, self.blocks)
+        self.retries = 0
+        if self.acked == self.blocks:
+            self.leave(addr, True)
+            return
+        if self.acked < self.sent:
+            self.retransmits += 1
+        # Or skip the blocks the master heard before it was one
+        self.sent = self.acked
+        self.send_window()
+
+    def finish(self, success):
+        if self.done:
+            return
+        for client in list(self.clients):
+            record = self.records.pop(client)
+            record.elapsed = self.loop.time() - record.start
+            self.server.transfer_done(record, False)
+        self.clients = []
+        self.done = True
+        self.elapsed = self.loop.time() - self.start
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.paced is not None:
+            self.paced.cancel()
+        self.endpoint.close()
+        logging.info("TFTP multicast of %s done : %d bytes sent in %.2fs, "
+                     "%d retransmits", self.filename, self.sent_bytes,
+                     self.elapsed, self.retransmits)
+        self.server.multicast_done(self)
+
+
+class TftpServer(object):
+    '''
+    A read-only TFTP server serving files from memory or mmap.
+    Bind it to the IP of the interface facing the devices.
+    With multicast, a (group, port), a file asked with the multicast option
+    is sent once to every client asking for it at the same time.
+    max_rate caps the bytes per second sent by every transfer together.
+    '''
+
+    def __init__(self, loop, ip='', port=69, multicast=None):
+        self.loop = loop
+        self.ip = ip
+        self.multicast = multicast
+        self.files = {}
+        self.maps = []
+        self.timeout = 1
+        self.retries = 5
+        self.max_blksize = MAX_BLKSIZE
+        self.max_windowsize = MAX_WINDOWSIZE
+        self.max_rate = None
+        self.allowance = 0.0
+        self.stamp = loop.time()
+        self.sent_bytes = 0
+        self.active = set()
+        self.multicasts = {}  # filename -> MulticastTransfer running
+        # (Transfer or MulticastClient, success) of every finished transfer
+        self.transfers = []
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((ip, port))
+        except socket.error:
+            sock.close()
+            raise
+        self.endpoint = DatagramEndpoint(loop, sock, self)
+
+    def add_file(self, name, data):
+        '''Serve data (a string, buffer or mmap) as name.'''
+        self.files[name.lstrip('/')] = data
+
+    def add_path(self, path, name=None):
+        '''Serve the file at path, as its basename unless name is given.'''
+        if name is None:
+            name = os.path.basename(path)
+        with open(path, 'rb') as image:
+            if os.fstat(image.fileno()).st_size == 0:
+                data = ''
+            else:
+                data = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps.append(data)
+        self.add_file(name, data)
+
+    def datagram_received(self, data, addr):
+        try:
+            opcode, filename, mode, options = parse_request(data)
+        except (ValueError, struct_error):
+            self.endpoint.sendto(error_packet(ERR_ILLEGAL, "Illegal request"),
+                                 addr)
+            return
+
+        if opcode == OP_WRQ:
+            self.endpoint.sendto(error_packet(ERR_ACCESS, "Read only"), addr)
+            return
+        if opcode != OP_RRQ:
+            self.endpoint.sendto(error_packet(ERR_ILLEGAL, "Illegal request"),
+                                 addr)
+            return
+
+        content = self.files.get(filename.lstrip('/'))
+        if content is None:
+            logging.debug("TFTP %s asked for unknown %s", addr[0], filename)
+            self.endpoint.sendto(error_packet(ERR_NOT_FOUND, "File not found"),
+                                 addr)
+            return
+
+        logging.debug("TFTP %s asked for %s (%s) %s", addr[0], filename, mode,
+                      options)
+        if self.multicast is not None and 'multicast' in options:
+            transfer = self.multicasts.get(filename)
+            if transfer is not None and transfer.joins(options):
+                transfer.join(addr)
+                return
+            # Block numbers can't roll over, a listener can't tell when
+            if transfer is None and \
+                    self.blocks(content, options) <= 0xFFFF:
+                transfer = MulticastTransfer(self, addr, filename, content,
+                                             options)
+                self.multicasts[filename] = transfer
+                self.active.add(transfer)
+                return
+            # Each on its own then
+            del options['multicast']
+        self.active.add(Transfer(self, addr, filename, content, options))
+
+    def blocks(self, content, options):
+        '''
+        The number of blocks of content, with the blksize asked in options.
+        '''
+        try:
+            blksize = min(max(int(options.get('blksize', DEFAULT_BLKSIZE)),
+                              8), self.max_blksize)
+        except ValueError:
+            blksize = DEFAULT_BLKSIZE
+        return len(content) / blksize + 1
+
+    def spend(self, size):
+        '''
+        Take size bytes from the bandwidth of max_rate, return the seconds
+        to wait before sending them. Up to 50ms of unused bandwidth can be
+        spent at once.
+        '''
+        if self.max_rate is None:
+            self.sent_bytes += size
+            return 0
+        now = self.loop.time()
+        self.allowance = min(self.allowance + (now - self.stamp) *
+                             self.max_rate, max(self.max_rate * 0.05, size))
+        self.stamp = now
+        if self.allowance < size:
+            return (size - self.allowance) / self.max_rate
+        self.allowance -= size
+        self.sent_bytes += size
+        return 0
+
+    def transfer_done(self, transfer, success):
+        self.active.discard(transfer)
+        self.transfers.append((transfer, success))
+
+    def multicast_done(self, transfer):
+        self.active.discard(transfer)
+        if self.multicasts.get(transfer.filename) is transfer:
+            del self.multicasts[transfer.filename]
+
+    def summary(self):
+        '''
+        The bytes sent, the bytes of the files the clients got whole, the
+        number of such clients, the time from the first transfer to the last
+        and the throughput delivered to the clients together.
+        '''
+        done = [transfer for transfer, success in self.transfers
+                if success and transfer.elapsed is not None]
+        delivered = sum(transfer.size for transfer in done)
+        elapsed = 0.0
+        if done:
+            elapsed = max(transfer.start + transfer.elapsed
+                          for transfer in done) - \
+                min(transfer.start for transfer in done)
+        return {'sent_bytes': self.sent_bytes, 'delivered_bytes': delivered,
+                'clients': len(done), 'elapsed': elapsed,
+                'throughput': delivered / elapsed if elapsed else 0.0}
+
+    def collect_metrics(self, metrics):
+        '''
+        Add a span and the bytes sent of every finished transfer to metrics.
+        '''
+        for transfer, success in self.transfers:
+            if transfer.elapsed is not None:
+                metrics.add_span('tftp', transfer.elapsed,
+                                 ip=transfer.client[0], success=success)
+            metrics.count('tftp_bytes', transfer.sent_bytes,
+                          ip=transfer.client[0])
+            metrics.count('tftp_retransmits', transfer.retransmits,
+                          ip=transfer.client[0])
+        summary = self.summary()
+        metrics.count('tftp_sent_bytes', summary['sent_bytes'])
+        metrics.count('tftp_delivered_bytes', summary['delivered_bytes'])
+
+    def close(self):
+        for transfer in list(self.active):
+            transfer.finish(False)
+        self.endpoint.close()
+        for data in self.maps:
+            data.close()
+        self.maps = []
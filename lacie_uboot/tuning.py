@@ -0,0 +1,351 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+tuning finds the tftpblocksize, tftpwindowsize, tftptimeout and
+tftptimeoutcountmax settings giving the fastest TFTP transfers to a device,
+by loading a test file with each of them, and remembers the best one for
+each U-Boot version so the update scripts can start with it.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import os
+import re
+import socket
+import sys
+from time import time
+sys.dont_write_bytecode = True
+
+from eventloop import Return
+from leases import locked_json
+from network import is_valid_mac, is_valid_ipv4
+from precheck import device_state
+from tftp import TftpServer
+
+PROFILE_FILE = '/var/lib/lacie-uboot/tftp-profiles.json'
+TEST_FILE = 'lacie-uboot-tuning.bin'
+
+# The variables of the TFTP client of U-Boot we tune, cleared before each
+# trial so the previous one does not leak into it.
+VARIABLES = ('tftpblocksize', 'tftpwindowsize', 'tftptimeout',
+             'tftptimeoutcountmax')
+# Tried first, from the defaults of U-Boot. Blocks over 1468 bytes are
+# fragmented and need CONFIG_IP_DEFRAG on the device.
+SIZES = [{},
+         {'tftpblocksize': '1468'},
+         {'tftpblocksize': '1468', 'tftpwindowsize': '4'},
+         {'tftpblocksize': '1468', 'tftpwindowsize': '8'},
+         {'tftpblocksize': '1468', 'tftpwindowsize': '16'},
+         {'tftpblocksize': '4096', 'tftpwindowsize': '8'}]
+# Then tried with the best sizes, the timeout is in ms and U-Boot takes
+# nothing under 1000.
+TIMEOUTS = [{'tftptimeout': '1000'},
+            {'tftptimeout': '1000', 'tftptimeoutcountmax': '20'},
+            {'tftptimeout': '2000'}]
+# A setting must be that much faster than the ones tried before to win,
+# so noise does not pick an odd one.
+MARGIN = 1.05
+
+# Bytes transferred = 4194304 (400000 hex)
+BYTES_TRANSFERRED = re.compile(r'Bytes transferred = (\d+)')
+
+
+def settings_commands(settings):
+    '''
+    The setenv lines applying settings, to put before a script.
+    '''
+    return ["setenv %s %s\n" % (name, settings[name])
+            for name in sorted(settings)]
+
+
+class TuningProfiles(object):
+    '''
+    The best TFTP settings found for each U-Boot version, kept in a JSON file
+    shared by every lacie-uboot process of the host : version -> settings,
+    throughput and loss measured with them, and when.
+    '''
+
+    def __init__(self, path=PROFILE_FILE):
+        self.path = path
+
+    def lookup(self, version):
+        '''
+        Return the settings found for version, {} if there are none.
+        '''
+        if version is None:
+            return {}
+        with locked_json(self.path) as profiles:
+            settings = profiles.get(version, {}).get('settings', {})
+        # JSON gives unicode, the netconsole sends str
+        return dict((str(name), str(value))
+                    for name, value in settings.items())
+
+    def record(self, version, trial):
+        with locked_json(self.path) as profiles:
+            profiles[version] = {'settings': trial['settings'],
+                                 'throughput': trial['throughput'],
+                                 'loss': trial['loss'],
+                                 'time': time()}
+
+
+class TftpTuner(object):
+    '''
+    Load a test file of size bytes to load_addr on a caught device, through
+    session (an AsyncUbootshell), with every setting of SIZES then, on top of
+    the best one, of TIMEOUTS. server is the TftpServer the device loads
+    from, tftp_port its port if it is not 69 (for U-Boot with
+    CONFIG_TFTP_PORT).
+    '''
+
+    def __init__(self, session, server, size=4 * 1024 * 1024,
+                 load_addr='0x800000', tftp_port=69):
+        self.session = session
+        self.server = server
+        self.size = size
+        self.load_addr = load_addr
+        self.tftp_port = tftp_port
+        # A transfer giving up takes tftptimeout * tftptimeoutcountmax
+        self.timeout = 120
+        self.command_timeout = 10
+        self.trials = []
+        server.add_file(TEST_FILE, os.urandom(size))
+
+    def command(self, cmd, timeout):
+        '''
+        Coroutine running cmd, the result is its CommandResult or None if
+        the prompt did not come back within timeout seconds.
+        '''
+        loop = self.session.loop
+        task = loop.create_task(self.session._invoke(cmd, False))
+        finished = yield loop.wait([task], timeout)
+        if not finished:
+            task.cancel()
+            logging.error("No prompt after %s.", cmd)
+            raise Return(None)
+        raise Return(task.result())
+
+    def trial(self, settings):
+        '''
+        Coroutine loading the test file with settings, the result is a dict
+        with the settings, whether the file came whole, the time it took,
+        its throughput in bytes per second, the retransmissions per block
+        and the blksize and windowsize the server agreed to. It is None if
+        the device did not come back.
+        '''
+        session = self.session
+        commands = ["setenv %s" % name for name in VARIABLES]
+        commands += ["setenv serverip %s" % session.host_ip,
+                     "setenv ipaddr %s" % session.ip_target]
+        if self.tftp_port != 69:
+            commands.append("setenv tftpdstp %d" % self.tftp_port)
+        commands += [line.strip() for line in settings_commands(settings)]
+        for cmd in commands:
+            if (yield self.command(cmd, self.command_timeout)) is None:
+                raise Return(None)
+
+        done = len(self.server.transfers)
+        result = yield self.command('tftp %s %s' % (self.load_addr,
+                                                   TEST_FILE), self.timeout)
+        if result is None:
+            raise Return(None)
+
+        trial = {'settings': settings, 'ok': False, 'elapsed': None,
+                 'throughput': 0.0, 'loss': None, 'blksize': None,
+                 'windowsize': None}
+        match = BYTES_TRANSFERRED.search(result.output)
+        transfers = [(transfer, success) for transfer, success
+                     in self.server.transfers[done:]
+                     if transfer.client[0] == session.ip_target]
+        if transfers:
+            transfer, success = transfers[-1]
+            # The output may be lost on a bad link, the server knows the
+            # last block was acknowledged
+            trial['ok'] = success and (match is None or
+                                       int(match.group(1)) == self.size)
+            trial['elapsed'] = transfer.elapsed
+            trial['loss'] = float(transfer.retransmits) / transfer.blocks
+            trial['blksize'] = transfer.blksize
+            trial['windowsize'] = transfer.windowsize
+            if trial['ok']:
+                trial['throughput'] = transfer.throughput()
+        logging.info("%s : %s", settings_label(settings), trial_label(trial))
+        self.trials.append(trial)
+        raise Return(trial)
+
+    def tune(self):
+        '''
+        Coroutine trying every setting, the result is the best trial or None
+        if no transfer went through. The variables are cleared afterwards.
+        '''
+        best = None
+        for phase in (SIZES, TIMEOUTS):
+            base = best['settings'] if best is not None else {}
+            for settings in phase:
+                trial = yield self.trial(dict(base, **settings))
+                if trial is None:
+                    raise Return(best)
+                if trial['ok'] and (best is None or trial['throughput'] >
+                                    best['throughput'] * MARGIN):
+                    best = trial
+        for name in VARIABLES:
+            yield self.command("setenv %s" % name, self.command_timeout)
+        raise Return(best)
+
+
+def settings_label(settings):
+    if not settings:
+        return "defaults"
+    return " ".join("%s=%s" % (name, settings[name])
+                    for name in sorted(settings))
+
+
+def trial_label(trial):
+    if not trial['ok']:
+        return "failed"
+    return "%7.1f KiB/s, %4.1f%% lost" % (trial['throughput'] / 1024,
+                                          trial['loss'] * 100)
+
+
+def tune(session, profiles, size, load_addr='0x800000', tftp_port=69):
+    '''
+    Coroutine tuning the device caught by session and recording its best
+    settings in profiles, the result is the best trial or None.
+    '''
+    # Its output may be lost on a bad link, ask again
+    for _ in range(3):
+        state = yield device_state(session)
+        if state['version'] is not None:
+            break
+    if state['version'] is None:
+        logging.error("The device did not tell its U-Boot version.")
+        raise Return(None)
+    logging.info("Tuning TFTP for %s", state['version'])
+    server = TftpServer(session.loop, session.host_ip, tftp_port)
+    try:
+        tuner = TftpTuner(session, server, size, load_addr, tftp_port)
+        best = yield tuner.tune()
+    finally:
+        server.close()
+        server.collect_metrics(session.metrics)
+    if best is None:
+        logging.error("No transfer went through.")
+        raise Return(None)
+    logging.info("Best : %s, %s", settings_label(best['settings']),
+                 trial_label(best))
+    profiles.record(state['version'], best)
+    raise Return(best)
+
+
+def main():
+    ''' tune the TFTP transfers of one product '''
+
+    import argparse
+    from ubootshell import Ubootshell
+
+    parser = argparse.ArgumentParser(
+        description="Find the TFTP settings giving the fastest transfers to a"
+        " LaCie NAS, and keep them for the updates of every product with the"
+        " same U-Boot.")
+    parser.add_argument("-m", "--mac", dest="mac", action="store",
+                        required=True,
+                        help="MAC address of the product (00:00:00:00:00:00).")
+    parser.add_argument("-i", "--iface", dest="iface", action="store",
+                        default="eth0",
+                        help="Interface facing the product, eth0 by default.")
+    parser.add_argument("--ip", dest="ip", action="store", default=None,
+                        help="Specify the IP address to assign to the"
+                        " device.")
+    parser.add_argument("-s", "--size", dest="size", action="store", type=int,
+                        default=4 * 1024 * 1024, metavar="BYTES",
+                        help="Size of the test file, 4MiB by default.")
+    parser.add_argument("--load-addr", dest="load_addr", action="store",
+                        default='0x800000', metavar="ADDR",
+                        help="Where the device loads the test file,"
+                        " 0x800000 by default.")
+    parser.add_argument("--tftp-port", dest="tftp_port", action="store",
+                        type=int, default=69, metavar="PORT",
+                        help="Serve TFTP on PORT, the device needs"
+                        " CONFIG_TFTP_PORT if it is not 69.")
+    parser.add_argument("--profiles", dest="profiles", action="store",
+                        default=PROFILE_FILE, metavar="FILE",
+                        help="Where the best settings are kept, %s by"
+                        " default." % PROFILE_FILE)
+    parser.add_argument("-D", "--debug", dest="loglevel", action="store_const",
+                        const=logging.DEBUG, default=logging.INFO,
+                        help="Output debugging information")
+    options = parser.parse_args()
+    logging.basicConfig(level=options.loglevel, format='%(message)s')
+
+    if not is_valid_mac(options.mac):
+        logging.error("Your MAC address is not in the proper format."
+                      "\'00:00:00:00:00:00\' format is awaited."
+                      "You gave %s" % options.mac)
+        return 1
+    if options.ip is not None and not is_valid_ipv4(options.ip):
+        logging.error("Your product IP is not in the proper format."
+                      "\'W.X.Y.Z\' format is awaited."
+                      "You gave %s" % options.ip)
+        return 1
+
+    session = Ubootshell()
+    session.debug = options.loglevel == logging.DEBUG
+    setup = {'mac_target': options.mac.lower(), 'iface': options.iface}
+    if options.ip is not None:
+        setup['ip_target'] = options.ip
+    if session.setup_network(setup):
+        return 1
+
+    if not session.send_lump():
+        logging.error("No answer to the LUMP.")
+        session.close()
+        return 1
+    try:
+        best = session.loop.run_until_complete(
+            tune(session, TuningProfiles(options.profiles), options.size,
+                 options.load_addr, options.tftp_port))
+        session.invoke('reset', display=False)
+    except socket.error, err:
+        logging.error("Can't serve TFTP on %s:%d : %s", session.host_ip,
+                      options.tftp_port, err)
+        best = None
+    finally:
+        session.close()
+    return 0 if best is not None else 1
+
+if __name__ == '__main__':
+    if sys.platform != "win32":
+        if os.geteuid() != 0:
+            print "You must be administrator/root to run this program."
+            sys.exit(1)
+
+    try:
+        sys.exit(main())
+    except (KeyboardInterrupt, EOFError, SystemExit, KeyError):
+        pass
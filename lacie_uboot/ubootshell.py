@@ -32,358 +32,125 @@ ubootshell allow you to discuss with the netconsol of u-boot.
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-from math import floor
 import logging
 import os
-import readline
-# for history and elaborate line editing when using raw_input
-# see http://docs.python.org/library/functions.html#raw_input
-from select import select
 import socket
-from struct import pack
 import sys
-from time import sleep
 sys.dont_write_bytecode = True
 
-from network import iface_info, find_free_ip, is_valid_mac, is_valid_ipv4, ipcomm_info
+from asyncshell import AsyncUbootshell, AUTO_IFACE
+from capture import PcapWriter, Replay
+from eventloop import EventLoop
+from multishell import MultiUbootshell
+from pacing import CatchStrategy
+from pipeline import LINE_LIMIT
+from tftp import TftpServer
 
 
-class Ubootshell(object):
+class Ubootshell(AsyncUbootshell):
     '''
     An instance of UBootshell is a session with the netconsole shell.
-     '''
+    It is a blocking wrapper of AsyncUbootshell, each call runs its own
+    event loop until the coroutine is done.
+    '''
 
-    def __init__(self):
+    def __init__(self, loop=None):
         '''Sets some defaults'''
 
-        self.ip_target = None
-        self.bcast_addr = None
-        self.mac_target = None
-        self.send_port = 4446
-        self.receive_port = 4445
-        self.uboot_port = 6666
-        self.lump_timeout = 120
-        self.script = None
-        self.do_wait = False
-        self.progress = False
-        self.debug = False
-
-    def load_script(self, path_file):
+        AsyncUbootshell.__init__(self, loop or EventLoop())
+
+    def send_lump(self):
         '''
-        If we don't want an interactive shell, but a script to be executed.
+        It will ask the users to reboot the target manually and then
+        it will send LUMP packet to a target during 60s.
         '''
-        if not os.path.exists(path_file):
-            logging.error("%s does not exists." % path_file)
-        self.script = path_file
+        return self.loop.run_until_complete(self._send_lump())
 
-    def do_progress(self, new_progress):
+    def invoke(self, cmd, display=True, callback=None):
         '''
-        If set to true, we will print a progress bar instead of the output.
+        send a cmd, return the CommandResult of what the device answered
         '''
-        self.progress = new_progress
-
-    # Output example: [=======   ] 75%
-    # width defines bar width
-    # percent defines current percentage
-    def print_progress(self, width, percent):
-        marks = floor(width * (percent / 100.0))
-        spaces = floor(width - marks)
-
-        loader = '[' + ('=' * int(marks)) + (' ' * int(spaces)) + ']'
-
-        sys.stdout.write("%s %d%%\r" % (loader, percent))
-        if percent >= 100:
-            sys.stdout.write("\n")
-        sys.stdout.flush()
+        return self.loop.run_until_complete(self._invoke(cmd, display,
+                                                         callback))
 
-    def wait_at_reboot(self, wait):
+    def ipcomm_info(self):
         '''
-        Set to true, we will wait for the device to reboot completely
+        Return the IP of the device, found with the IPCOMM protocol.
         '''
-        self.do_wait = wait
+        return self.loop.run_until_complete(self._ipcomm_info())
 
-    def setup_network(self, net_dict):
+    def run(self):
         '''
-        Give a dict with the following values to setup your network :
-        {
-            'iface': 'ethX'  # default : eth0
-            'bcast_addr' : '255.255.255.0'  # The broadcast address if you need to set it
-            'mac_target' : '00:00:00:00:00:00'  # The mac of your product
-            'ip_target' : '192.168.1.1'  # The ip to assign to the product
-        }
+        Either we execute the script or we create an interactive shell
+        to the netconsole.
         '''
 
-        if ('mac_target' not in net_dict) or (net_dict['mac_target'] is None):
-            logging.info("WARNING : The first product to reboot will be catched !")
-            logging.info("It may not be yours if multiple product reboot at the "
-                         "same time on your network.")
-            net_dict['mac_target'] = "00:00:00:00:00:00"
-
-        try:
-            ip, mac, netmask, bcast = iface_info(net_dict['iface'])
-        except (IOError, TypeError):
-            logging.error("Your network interface is not reachable."
-                          " Is %s correct ?" % net_dict['iface'])
-            return 1
-
-        # This IP is used afterwards when TFTP'ing files
-        if ('ip_target' not in net_dict) or (net_dict['ip_target'] is None):
-            if sys.platform == "darwin":
-                logging.error("You need to specify an IP to assign to the device.")
-                return 1
-            net_dict['ip_target'] = find_free_ip(net_dict['iface'], ip, mac, netmask)
-
-        # Check MAC and IP value.
-        if not is_valid_mac(net_dict['mac_target']):
-            logging.error("Your MAC address is not in the proper format."
-                          "\'00:00:00:00:00:00\' format is awaited."
-                          "You gave %s" % net_dict['mac_target'])
-            return 1
-        self.mac_target = net_dict['mac_target']
+        if self.script is not None:
+            return self.loop.run_until_complete(self._run())
 
-        if not is_valid_ipv4(bcast):
-            logging.error("Your Broadcast IP is not in the proper format."
-                          "\'W.X.Y.Z\' format is awaited."
-                          "You gave %s" % bcast)
+        if not self.send_lump():
+            logging.debug("LUMP was not sent/receveid by the target")
             return 1
-        self.bcast_addr = bcast
 
-        if not is_valid_ipv4(net_dict['ip_target']):
-            logging.error("Your product IP is not in the proper format."
-                          "\'W.X.Y.Z\' format is awaited."
-                          "You gave %s" % net_dict['ip_target'])
-            return 1
-        self.ip_target = net_dict['ip_target']
+        # for history and elaborate line editing when using raw_input
+        # see http://docs.python.org/library/functions.html#raw_input
+        # Only the interactive shell needs it, it is slow to import.
+        import readline
 
-    def send_lump(self):
-        '''
-        It will ask the users to reboot the target manually and then
-        it will send LUMP packet to a target during 60s.
-        '''
+        cmd = None
+        while cmd not in ['exit', 'reset']:
+            cmd = raw_input("Marvell>> ")
+            self.invoke(cmd, display=True)
+        self.close()
+        return 0
 
-        # Create an array with 6 cases, each one is a member (int) of the MAC
-        fields_macdest = [int(x, 16) for x in self.mac_target.split(':')]
-
-        # Create an array with 4 cases, each one is a member (int) of the IP
-        fields_ip = [int(x) for x in self.ip_target.split('.')]
-
-        # Note : The empty MAC are 8 bytes in length according to the reverse
-        # engineering done with WireShark. Don't know why exactly...
-        pkt = pack('!I'   # LUMP
-                          'L'    # Length of LUMP
-                          'I'    # MACD
-                          'L'    # Length of MACD
-                          'I'    # MAC@
-                          'L'    # Length of MAC@ field
-                          '2x'   # fill space because MAC take only 6 bytes
-                          '6s'   # MAC address of target
-                          'I'    # IPS
-                          'L'    # Length of IPS
-                          'I'    # IP@
-                          'L'    # Length of IP@
-                          '4s'   # IP of the target
-                          'I'    # MACS
-                          'L'    # Length of MACS
-                          'I'    # MAC address of source
-                          'L'    # Length of MAC@
-                          '8x',  # Empty MAC
-                          0x4C554D50,  # LUMP
-                          0x44,
-                          0x4D414344,  # MACD
-                          0x10,
-                          0x4D414340,  # MAC
-                          0x8,
-                          pack('!6B', *fields_macdest),  # int[] -> byte[]
-                          0x49505300,  # IPS
-                          0x0C,
-                          0x49504000,  # IP
-                          0x4,
-                          pack('!4B', *fields_ip),  # int[] -> byte[]
-                          0x4D414353,  # MACS
-                          0x10,
-                          0x4D414340,  # MAC
-                          0x8)
-
-        logging.debug("Sending some LUMP / Ctrl-C, "
-                      "waiting for the NAS to start up")
-        logging.info("Please /!\HARD/!\ reboot the device /!\NOW/!\ ")
-
-        timeout = 0
-        socket.setdefaulttimeout(60)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
-        try:
-            sock.bind(('', self.uboot_port))
-        except socket.error, err:
-            logging.error("Couldn't be a udp server on port %d : %s",
-                          self.uboot_port, err)
-            sock.close()
-            return None
-
-        lump_ok = False
-        while lump_ok is False and timeout < self.lump_timeout:
-            sock.sendto(pkt, (self.bcast_addr, self.send_port))
-            sleep(0.2)  # Wait for the device to process the LUMP
-            #Send Ctrl-C (Code ASCII 3 for EXT equivalent of SIGINT for Unix)
-            sock.sendto('\3', (self.bcast_addr, self.uboot_port))
-            srecv = select([sock], [], [], 1)
-            # data
-            if not srecv[0]:
-                continue
-            try:
-                serv_data = sock.recvfrom(1024)
-                if serv_data[1][0] != self.ip_target:
-                    continue
-                serv_data = serv_data[0]
-                # check when prompt (Marvell>>) is available,
-                # then out to the next while to input command and send them !
-                if "Marvell>> " == serv_data:
-                    lump_ok = True
-                    break
-            except (socket.error, KeyboardInterrupt, SystemExit):
-                return None
-            timeout += 1
-
-        if timeout >= self.lump_timeout:
-            logging.debug("Sending LUMP for %ds, no response !",
-                           self.lump_timeout)
-            lump_ok = False
-
-        sock.close()
-        return lump_ok
-
-    def invoke(self, cmd, display=True):
-        '''
-        send a cmd
-        '''
+def setup_catch(session, options):
+    ''' apply the LUMP options to a session '''
 
-        # Empty command, nothing to do here
-        if cmd == "":
-            return 42
+    session.lump_timeout = options.lump_timeout
+    session.catch = CatchStrategy(interval=options.lump_interval,
+                                  jitter=options.lump_jitter,
+                                  flood=options.flood)
 
-        exit_list = ['exit', 'reset']
-        override = 'Override Env parameters? (y/n)'
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-        if cmd in exit_list:
-            cmd = 'reset'
-            cmd = pack('!' + str(len(cmd)) + 's1s', cmd, '\x0A')
-            sock.sendto(cmd, (self.ip_target, self.uboot_port))
-            sock.close()
-            return 0
+def main_multi(options):
+    ''' launch a script on every given MAC at once '''
 
-        sock.settimeout(10.0)
-        try:
-            sock.bind(('', self.uboot_port))
-        except socket.error, err:
-            logging.error("Can't open %d port. (Error : %s)",
-                self.receive_port, err)
-            sock.close()
-            return 0
-
-        #we want to send a cmd to the nas and get the reply in ans
-        #every command is completed by \n !
-        command = pack('!' + str(len(cmd)) + 's1s', cmd, '\x0A')
-        sock.sendto(command, (self.ip_target, self.uboot_port))
-        prompt = False
-        len_command = 0
-        # Don't try to wait for a prompt with bootm
-        if cmd == 'bootm':
-            sock.close()
-            return 42
-
-        while prompt is False:
-            srecv = select([sock], [], [], 0.5)
-            # data
-            if not srecv[0]:
-                continue
-            try:
-                data = sock.recvfrom(1024)
-                if data[1][0] != self.ip_target:
-                    continue
-                recv_data = data[0]
-                # check when prompt (Marvell>>) is available,
-                if ("Marvell>> " == recv_data or override == recv_data):
-                    if override == recv_data:
-                        print recv_data
-                    prompt = True
-                # When sending a command U-Boot return the commands
-                # char by char, we do this so we don't display it.
-                elif len_command < len(command):
-                    len_command += 1
-                else:
-                    # to handle the printenv and other case
-                    # when answer is given one letter at a time...
-                    if display:
-                        write = sys.stdout.write
-                        write(str(recv_data))
-                        sys.stdout.flush()
-            except (socket.error, KeyboardInterrupt, SystemExit) as err:
-                if self.debug:
-                    logging.error("Sending command %s on %d : %s",
-                        cmd, self.receive_port, err)
-        sock.close()
-        return 42
+    if options.script is None or not os.path.isfile(options.script):
+        logging.error("Several MAC addresses can only be used with a script.")
+        return 1
+    if options.force_ip is not None:
+        logging.error("--ip can't be used with several MAC addresses.")
+        return 1
+    if options.wait:
+        logging.info("--wait is ignored with several MAC addresses.")
+    if options.replay is not None:
+        logging.error("--replay can only be used with one device.")
+        return 1
+    if options.iface == AUTO_IFACE:
+        logging.error("-i %s can only be used with one device." % AUTO_IFACE)
+        return 1
 
-    def run(self):
-        '''
-        Either we execute the script or we create an interactive shell
-        to the netconsole.
-        '''
+    session = MultiUbootshell()
+    session.debug = options.loglevel == logging.DEBUG
+    session.display = not options.progress
+    session.pipeline = options.pipeline
+    setup_catch(session, options)
 
-        if not self.send_lump():
-            logging.debug("LUMP was not sent/receveid by the target")
-            return 1
+    setup = {'iface': options.iface,
+             'targets': [(mac, None) for mac in options.mac]}
+    if session.setup_network(setup):
+        return 1
+    if options.capture is not None:
+        session.capture = PcapWriter(options.capture, session.host_ip)
 
-        if self.script is not None:
-            with open(self.script, 'r+') as script:
-                script_cmd = script.readlines()
-
-            if self.progress:
-                # setup progress_bar
-                p_width = 60
-                p_pas = p_width / len(script_cmd)
-                p_percent = 0
-
-            for cmd in script_cmd:
-
-                if self.progress:
-                    # update the bar
-                    self.print_progress(p_width, p_percent)
-                    p_percent += p_pas
-
-                if cmd == '\n' or cmd.startswith('#'):
-                    continue
-
-                if not self.progress:
-                    print cmd.strip() + " => ",
-
-                self.invoke(cmd.strip(), display=not self.progress)
-                sleep(1)  # it seems uboot doesn't like being shaked a bit
-
-            if self.progress:
-                self.print_progress(p_width, 100)
-
-            # You can't wait if there is no MAC.
-            if self.do_wait and (self.mac_target != "00:00:00:00:00:00"):
-                # Some command output may be stuck in the pipe
-                sys.stdout.flush()
-                # WAIT FOR THE DEVICE TO BOOT
-                logging.info("Waiting for your product to reboot...")
-                sleep(60 * 7)  # Wait 7mn, it should give the device time to boot.
-                # This is done to avoid spamming the network with packet while we are sure it is not necessary.
-                ip = ipcomm_info(self.receive_port, self.mac_target, self.ip_target)
-                if ip is None:
-                    logging.info("Timeout : Unable to get your product IP.")
-                    return 1
-                logging.info("Your product is available at %s" % ip)
-            return 0
-
-        exit_code = 42
-        while(exit_code):
-            exit_code = self.invoke(raw_input("Marvell>> "), display=True)
-        return 0
+    session.load_script(options.script)
+    code = session.run()
+    if session.capture is not None:
+        session.capture.close()
+    session.metrics.save(options.metrics, options.prometheus)
+    return code
 
 
 def main():
@@ -395,16 +162,18 @@ def main():
     parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
     parser.add_argument('script', metavar='file', type=str, nargs='?',
                        help=argparse.SUPPRESS)
-    parser.add_argument("-m", "--mac", dest="mac", action="store",
+    parser.add_argument("-m", "--mac", dest="mac", action="append",
                       default=None,
                       help="Address MAC of the targeted device "
-                      "(00:00:00:00:00:00)"
+                      "(00:00:00:00:00:00)\n"
+                      "Repeat it to run a script on several devices at once."
                       )
     parser.add_argument("-i", "--iface", dest="iface", action="store",
                       default="eth0",
                       help="Interface to use to send LUMP packet to.\n"
-                      "Default is eth0.\n"
-                      )
+                      "Default is eth0, %s sends it on every interface\n"
+                      "and keeps the one the device answers on.\n"
+                      % AUTO_IFACE)
     parser.add_argument("--ip", dest="force_ip", action="store",
                       default=None,
                       help="Specify the IP address to assign to the device."
@@ -417,6 +186,56 @@ def main():
                       default=False, const=True,
                       help="Wait for the product to boot.\n"
                       "Note : Require the -m/--mac option to be set.\n")
+    parser.add_argument("--boot-timeout", dest="boot_timeout", action="store",
+                      type=int, default=600, metavar="SECONDS",
+                      help="Give up waiting for the product after SECONDS.\n"
+                      "Default is 600.\n")
+    parser.add_argument("--lump-timeout", dest="lump_timeout", action="store",
+                      type=float, default=120, metavar="SECONDS",
+                      help="Give up catching the device after SECONDS.\n"
+                      "Default is 120.")
+    parser.add_argument("--lump-interval", dest="lump_interval",
+                      action="store", type=float, default=1.2,
+                      metavar="SECONDS",
+                      help="Send a LUMP and a Ctrl-C every SECONDS.\n"
+                      "Default is 1.2.")
+    parser.add_argument("--lump-jitter", dest="lump_jitter", action="store",
+                      type=float, default=0.0, metavar="SECONDS",
+                      help="Move each LUMP by up to SECONDS.")
+    parser.add_argument("--flood", dest="flood", action="store", type=float,
+                      default=None, metavar="SECONDS",
+                      help="Send a LUMP every SECONDS until the device sends"
+                      " anything,\nfor devices with a short autoboot delay.")
+    parser.add_argument("--pipeline", dest="pipeline", action="store",
+                      type=int, nargs='?', const=LINE_LIMIT, default=None,
+                      metavar="LENGTH",
+                      help="Send consecutive setenv-like commands of the script"
+                      "\non one line, of at most LENGTH characters (%d by"
+                      " default)." % LINE_LIMIT)
+    parser.add_argument("-t", "--tftp", dest="tftp", action="append",
+                      default=[], metavar="FILE",
+                      help="Serve FILE over TFTP from this process, on the IP of"
+                      " the interface.\nCan be given several times.")
+    parser.add_argument("--metrics", dest="metrics", action="store",
+                      default=None, metavar="FILE",
+                      help="Append the timings and counters of the session to"
+                      " FILE,\none JSON object per line.")
+    parser.add_argument("--prometheus", dest="prometheus", action="store",
+                      default=None, metavar="FILE",
+                      help="Write the timings and counters of the session to"
+                      " FILE,\nfor the textfile collector of Prometheus.")
+    parser.add_argument("--capture", dest="capture", action="store",
+                      default=None, metavar="FILE",
+                      help="Record every datagram of the session to FILE,"
+                      " a pcap file.")
+    parser.add_argument("--replay", dest="replay", action="store",
+                      default=None, metavar="FILE",
+                      help="Play the device of the capture FILE back, instead"
+                      " of the network.")
+    parser.add_argument("--replay-speed", dest="replay_speed", action="store",
+                      type=float, default=1.0, metavar="FACTOR",
+                      help="Replay FACTOR times faster than recorded,"
+                      " 0 for no delay.\nDefault is 1.")
     parser.add_argument("-D", "--debug", dest="loglevel", action="store_const",
                       const=logging.DEBUG, help="Output debugging information")
 
@@ -430,21 +249,73 @@ def main():
 
     options = parser.parse_args()
 
-    setup = {'mac_target': options.mac, 'iface': options.iface}
+    if options.mac is not None and len(options.mac) > 1:
+        return main_multi(options)
+
+    setup = {'mac_target': options.mac and options.mac[0],
+             'iface': options.iface}
     if options.force_ip is not None:
         setup['ip_target'] = options.force_ip
 
-    if session.setup_network(setup):
+    if options.replay is not None:
+        try:
+            session.replay = Replay(session.loop, options.replay,
+                                    options.replay_speed)
+        except (IOError, ValueError), err:
+            logging.error("Can't replay %s : %s", options.replay, err)
+            return 1
+        lump = session.replay.lump()
+        if lump is None:
+            logging.error("No LUMP in %s, nothing to replay.", options.replay)
+            return 1
+        # Catch the device of the capture, as it was caught
+        session.mac_target, session.ip_target, session.bcast_addr = lump
+        session.host_ip = session.replay.host
+        if options.wait or options.tftp:
+            logging.info("--wait and --tftp are ignored with --replay.")
+            options.wait = False
+            options.tftp = []
+    elif session.setup_network(setup):
         return 1
+    if options.capture is not None:
+        session.capture = PcapWriter(options.capture, session.host_ip)
 
     session.wait_at_reboot(options.wait)
+    session.boot_timeout = options.boot_timeout
+    session.pipeline = options.pipeline
+    setup_catch(session, options)
     session.do_progress(options.progress)
 
     if options.script is not None and os.path.isfile(options.script):
         session.load_script(options.script)
 
+    server = None
+    if options.tftp:
+        try:
+            # Which interface will be used is not known yet
+            server = TftpServer(session.loop, '' if session.candidates
+                                else session.host_ip)
+            for path in options.tftp:
+                server.add_path(path)
+        except (socket.error, IOError), err:
+            logging.error("Can't serve %s over TFTP : %s",
+                          ", ".join(options.tftp), err)
+            if server is not None:
+                server.close()
+            return 1
+
     session.run()
 
+    if session.capture is not None:
+        session.capture.close()
+    if session.replay is not None:
+        session.replay.report()
+    if server is not None:
+        server.close()
+        server.collect_metrics(session.metrics)
+    session.collect_metrics()
+    session.metrics.save(options.metrics, options.prometheus)
+
     return 0
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+#! /usr/bin/python -B
+# -*- coding: utf-8 -*-
+
+'''
+updater updates the U-Boot or the firmware of one product, from one process.
+'''
+
+# Author:     Maxime Hadjinlian (C) 2013
+#             maxime.hadjinlian@gmail.com
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. The name of the author may not be used to endorse or promote products
+#    derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import os
+import sys
+sys.dont_write_bytecode = True
+
+from fleet import FleetUpdater, image_kind, report
+from network import is_valid_mac, is_valid_ipv4
+
+
+def update(image, mac, iface='eth0', ip=None, tftp_root=None, wait=True,
+           debug=False):
+    '''
+    Flash image, a .capsule or a U-Boot .bin or .kwb, on the product mac
+    and wait for it to boot, like lacie-nas-updater : the interface, the IP
+    of the product, the script and the session are all handled in this
+    process. The image is served over TFTP by this process, or put in
+    tftp_root for a TFTP server already running.
+    Return the result of the update, see FleetUpdater.results().
+    '''
+    updater = FleetUpdater(jobs=1)
+    updater.debug = debug
+    updater.wait = wait
+    # Flash whatever the product runs, like lacie-nas-updater always did
+    updater.force = True
+    updater.tftp_root = tftp_root
+    if updater.setup_network(iface, [(mac, image, ip)]):
+        return {'mac': mac, 'ip': ip, 'image': image, 'status': 'no_network',
+                'exit': 1, 'timings': {}}
+    try:
+        updater.run()
+    finally:
+        updater.close()
+    return updater.results()[0]
+
+
+def main():
+    ''' update one product '''
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Update a LaCie NAS system with the given file. If your"
+        " file ends with .capsule, we will update the system. If your file"
+        " ends with .bin or .kwb, we will update U-Boot.")
+    parser.add_argument('image', metavar='FILE_PATH', type=str,
+                        help="The .capsule, .bin or .kwb to flash.")
+    parser.add_argument("-t", dest="tftp_root", action="store", default=None,
+                        help="Path to the root of your TFTP server (must be"
+                        " started !), else the file is served by this"
+                        " process.")
+    parser.add_argument("-m", dest="mac", action="store", required=True,
+                        help="MAC address of the product to flash.")
+    parser.add_argument("-I", dest="iface", action="store", default="eth0",
+                        help="IFACE, specify your network interface if not"
+                        " default (eth0).")
+    parser.add_argument("-i", dest="ip", action="store", default=None,
+                        help="To specify the IP address to assign to the"
+                        " device.")
+    parser.add_argument("-d", dest="loglevel", action="store_const",
+                        const=logging.DEBUG, default=logging.INFO,
+                        help="Show debug message.")
+    options = parser.parse_args()
+    logging.basicConfig(level=options.loglevel, format='%(message)s')
+
+    if not os.path.isfile(options.image):
+        logging.error("%s does not exists.", options.image)
+        return 1
+    if image_kind(options.image) is None:
+        logging.error("File extension not available. Only .capsule, .bin or"
+                      " .kwb")
+        return 1
+    if not is_valid_mac(options.mac):
+        logging.error("Your MAC address is not in the proper format."
+                      "\'00:00:00:00:00:00\' format is awaited."
+                      "You gave %s" % options.mac)
+        return 1
+    if options.ip is not None and not is_valid_ipv4(options.ip):
+        logging.error("Your product IP is not in the proper format."
+                      "\'W.X.Y.Z\' format is awaited."
+                      "You gave %s" % options.ip)
+        return 1
+    tftp_root = options.tftp_root
+    if tftp_root is not None:
+        tftp_root = os.path.realpath(tftp_root)
+        if not os.path.isdir(tftp_root):
+            logging.error("%s does not exists.", tftp_root)
+            return 1
+
+    result = update(os.path.abspath(options.image), options.mac.lower(),
+                    options.iface, options.ip, tftp_root,
+                    debug=options.loglevel == logging.DEBUG)
+    report([result])
+    return result['exit']
+
+if __name__ == '__main__':
+    if sys.platform != "win32":
+        if os.geteuid() != 0:
+            print "You must be administrator/root to run this program."
+            sys.exit(1)
+
+    try:
+        sys.exit(main())
+    except (KeyboardInterrupt, EOFError, SystemExit, KeyError):
+        pass
@@ -37,10 +37,16 @@ setup(
     name='lacie_uboot',
     version=VERSION,
     packages=['lacie_uboot'],
-    scripts=['bin/lacie-uboot-shell', 'bin/lacie-nas-updater'],
+    scripts=['bin/lacie-uboot-shell', 'bin/lacie-nas-updater',
+             'bin/lacie-uboot-discovery', 'bin/lacie-fleet-updater',
+             'bin/lacie-uboot-tuning', 'bin/lacie-uboot-broker'],
     data_files=[
                   ('share/man/man1', ['doc/lacie-uboot-shell.1']),
                   ('share/man/man1', ['doc/lacie-nas-updater.1']),
+                  ('share/man/man1', ['doc/lacie-uboot-discovery.1']),
+                  ('share/man/man1', ['doc/lacie-fleet-updater.1']),
+                  ('share/man/man1', ['doc/lacie-uboot-tuning.1']),
+                  ('share/man/man1', ['doc/lacie-uboot-broker.1']),
                  ],
     author='Maxime Hadjinlian',
     author_email='maxime.hadjinlian@gmail.com',
@@ -54,8 +60,8 @@ setup(
  which can be accessed using the tools provided in this package:
   * lacie-uboot-shell - a simple interactive client which can connect
     to the U-Boot netconsole using only a network cable;
-  * lacie-nas-updater - a script to update the device's bootloader or
-    firmware using lacie-uboot-shell (requires a TFTP server).
+  * lacie-nas-updater - update the device's bootloader or firmware, from
+    one process serving the image over TFTP.
 ''',
     url='http://f00.fr',
 
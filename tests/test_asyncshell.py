@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the command output parsing of AsyncUbootshell, with a fake device.
+'''
+
+import os
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import unittest
+
+from asyncshell import AsyncUbootshell, OVERRIDE, PROMPT
+from eventloop import EventLoop
+
+
+class FakeEndpoint(object):
+    '''
+    Stands for the netconsole socket, the device answers every command with
+    the datagrams given by answer(command).
+    '''
+
+    def __init__(self, loop, session, answer):
+        self.loop = loop
+        self.session = session
+        self.answer = answer
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+        for index, datagram in enumerate(self.answer(data)):
+            self.loop.call_later(0.001 * (index + 1),
+                                 self.session.datagram_received, datagram)
+
+    def read_ready(self):
+        pass
+
+    def register(self, ip, session):
+        pass
+
+    def unregister(self, ip):
+        pass
+
+
+class InvokeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.session = AsyncUbootshell(self.loop)
+        self.session.ip_target = '127.0.1.1'
+        self.session.command_timeout = 0.5
+
+    def tearDown(self):
+        self.loop.close()
+
+    def invoke(self, cmd, answer):
+        self.session.endpoint = FakeEndpoint(self.loop, self.session, answer)
+        return self.loop.run_until_complete(
+            self.session._invoke(cmd, display=False))
+
+    def test_output(self):
+        result = self.invoke('echo hi', lambda data: list(data) +
+                             ['hi\n', PROMPT])
+        self.assertEqual(result.output, 'hi\n')
+        self.assertTrue(result.echo_ok)
+        self.assertEqual(result.prompt, PROMPT)
+        self.assertFalse(result.timed_out)
+
+    def test_prompt_split(self):
+        result = self.invoke('version', lambda data: [
+            data, 'U-Boot 2009.11\nMarv', 'ell>> '])
+        self.assertEqual(result.output, 'U-Boot 2009.11\n')
+        self.assertEqual(result.prompt, PROMPT)
+
+    def test_override(self):
+        result = self.invoke('saveenv', lambda data: [data, OVERRIDE])
+        self.assertEqual(result.output, OVERRIDE)
+        self.assertEqual(result.prompt, OVERRIDE)
+
+    def test_lost_echo_newline(self):
+        # The newline of the echo is lost and the command prints nothing
+        result = self.invoke('setenv a 1', lambda data: list(data[:-1]) +
+                             [PROMPT])
+        self.assertEqual(result.prompt, PROMPT)
+        self.assertEqual(result.output, '')
+        self.assertTrue(result.echo_ok)
+        self.assertFalse(result.timed_out)
+
+    def test_timeout(self):
+        start = self.loop.time()
+        result = self.invoke('tftp', lambda data: [data, 'Loading: #', 'Mar'])
+        self.assertTrue(result.timed_out)
+        self.assertIsNone(result.prompt)
+        self.assertEqual(result.output, 'Loading: #Mar')
+        self.assertLess(self.loop.time() - start, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
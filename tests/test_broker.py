@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the netconsole broker, run in a thread with its own loop.
+'''
+
+import os
+import shutil
+import socket
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import tempfile
+import threading
+import unittest
+
+from broker import BrokerEndpoint, NetconsoleBroker, open_netconsole
+from eventloop import EventLoop
+from netconsole import NetconsoleEndpoint
+
+
+class Session(object):
+
+    def __init__(self):
+        self.received = []
+
+    def datagram_received(self, data):
+        self.received.append(data)
+
+
+def device(ip):
+    ''' a UDP socket standing for the device at ip, on the loopback '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((ip, 0))
+    sock.settimeout(2)
+    return sock
+
+
+class BrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'netconsole.sock')
+        self.broker_loop = EventLoop()
+        self.broker = NetconsoleBroker(self.broker_loop, 0, '127.0.0.1',
+                                       self.path)
+        self.broker.start()
+        self.addr = self.broker.endpoint.sock.getsockname()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run_broker)
+        self.thread.start()
+        self.loop = EventLoop()
+        self.devices = []
+
+    def run_broker(self):
+        while not self.stopping:
+            self.broker_loop.call_later(0.01, lambda: None)
+            self.broker_loop.run_once()
+
+    def tearDown(self):
+        self.stopping = True
+        self.thread.join()
+        self.broker.close()
+        self.broker_loop.close()
+        self.loop.close()
+        for sock in self.devices:
+            sock.close()
+        shutil.rmtree(self.directory)
+
+    def client(self):
+        return BrokerEndpoint(self.loop, self.addr[1], self.path)
+
+    def device(self, ip):
+        sock = device(ip)
+        self.devices.append(sock)
+        return sock
+
+    def run_loop(self):
+        self.loop.run_until_complete(self.loop.sleep(0.1))
+
+    def test_open_netconsole(self):
+        endpoint = open_netconsole(self.loop, self.addr[1], '127.0.0.1',
+                                   self.path)
+        self.assertIsInstance(endpoint, BrokerEndpoint)
+        endpoint.close()
+        endpoint = open_netconsole(self.loop, 0, '127.0.0.1',
+                                   os.path.join(self.directory, 'none'))
+        self.assertIsInstance(endpoint, NetconsoleEndpoint)
+        endpoint.close()
+
+    def test_route_by_source_ip(self):
+        first, second = self.client(), self.client()
+        sessions = Session(), Session()
+        first.register('127.0.1.1', sessions[0])
+        second.register('127.0.1.2', sessions[1])
+        self.device('127.0.1.1').sendto('one', self.addr)
+        self.device('127.0.1.2').sendto('two', self.addr)
+        self.run_loop()
+        self.assertEqual(sessions[0].received, ['one'])
+        self.assertEqual(sessions[1].received, ['two'])
+        first.close()
+        second.close()
+
+    def test_ip_taken(self):
+        first, second = self.client(), self.client()
+        first.register('127.0.1.1', Session())
+        start = self.loop.time()
+        self.assertRaises(socket.error, second.register, '127.0.1.1',
+                          Session())
+        self.assertLess(self.loop.time() - start, 1)
+        # Free once the first client is gone
+        first.close()
+        self.run_loop()
+        second.register('127.0.1.1', Session())
+        second.close()
+
+    def test_ctrl_c_to_own_devices(self):
+        target = self.device('127.0.1.1')
+        port = target.getsockname()[1]
+        # The device of another session, on the same port
+        other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        other.bind(('127.0.1.2', port))
+        other.settimeout(0.2)
+        self.devices.append(other)
+        client = self.client()
+        client.register('127.0.1.1', Session())
+        client.sendto('\3', ('127.255.255.255', port))
+        self.assertEqual(target.recvfrom(16), ('\3', self.addr))
+        self.assertRaises(socket.timeout, other.recvfrom, 16)
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the discovery daemon index and of its Unix socket.
+'''
+
+import os
+import shutil
+import socket
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import tempfile
+import unittest
+
+from discovery import DeviceIndex, QueryServer, query
+from eventloop import EventLoop
+from protocol import info_packet, parse_info
+
+
+class FakeDaemon(object):
+
+    def __init__(self):
+        self.index = DeviceIndex()
+
+    def look(self):
+        pass
+
+
+class DiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'discovery.sock')
+        self.daemon = FakeDaemon()
+        self.server = QueryServer(self.loop, self.daemon, self.path)
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def add(self, mac, name):
+        info = parse_info(info_packet([('MAC ', mac), ('NAME', name),
+                                       ('ADDR', '127.0.1.1')]))
+        return self.daemon.index.update(info, ('127.0.1.1', 4445))
+
+    def step(self):
+        ''' run the loop once, for 10ms at most '''
+        self.loop.call_later(0.01, lambda: None)
+        self.loop.run_once()
+
+    def ask(self, request):
+        ''' query the server from a client while the loop runs '''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(request + '\n')
+        sock.setblocking(0)
+        chunks = []
+        stop = self.loop.time() + 2
+        while self.loop.time() < stop:
+            self.step()
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                continue
+            if not data:
+                break
+            chunks.append(data)
+        sock.close()
+        return ''.join(chunks)
+
+    def test_binary_fields(self):
+        self.add('00:d0:4b:00:00:01', 'nas\xff\xfe')
+        answer = self.ask('GET 00:d0:4b:00:00:01')
+        self.assertIn('"name": "nas\\u00ff\\u00fe"', answer)
+        self.assertIn('"ip": "127.0.1.1"', answer)
+
+    def test_unknown_request(self):
+        self.assertIn('error', self.ask('HELLO'))
+
+    def test_slow_client_does_not_block(self):
+        for index in range(2000):
+            self.add('00:d0:4b:00:%02x:%02x' % (index / 256, index % 256),
+                     'x' * 200)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall('LIST\n')
+        # The client never reads, the loop must not wait for it
+        start = self.loop.time()
+        for _ in range(20):
+            self.step()
+        self.assertLess(self.loop.time() - start, 0.5)
+        self.assertEqual(len(self.server.pending), 1)
+        sock.close()
+
+    def test_query(self):
+        self.add('00:d0:4b:00:00:02', 'nas')
+        self.assertEqual(self.ask('LIST').count('"mac"'), 1)
+        self.assertRaises(socket.error, query, 'LIST',
+                          os.path.join(self.directory, 'none.sock'))
+
+
+if __name__ == '__main__':
+    unittest.main()
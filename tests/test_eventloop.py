@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the event loop : tasks, cancellation and wait().
+'''
+
+import os
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import unittest
+
+from eventloop import CancelledError, EventLoop, Return
+
+
+class TaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_result(self):
+        def child():
+            yield self.loop.sleep(0)
+            raise Return(21)
+
+        def parent():
+            value = yield child()
+            raise Return(value * 2)
+        self.assertEqual(self.loop.run_until_complete(parent()), 42)
+
+    def test_cancel_stops_the_awaited_coroutine(self):
+        ticks = [0]
+
+        def child():
+            while True:
+                yield self.loop.sleep(0.01)
+                ticks[0] += 1
+
+        def parent():
+            yield child()
+        task = self.loop.create_task(parent())
+        self.loop.run_until_complete(self.loop.sleep(0.05))
+        task.cancel()
+        before = ticks[0]
+        self.loop.run_until_complete(self.loop.sleep(0.1))
+        self.assertEqual(ticks[0], before)
+        self.assertRaises(CancelledError, task.result)
+
+    def test_wait_timeout(self):
+        def forever():
+            while True:
+                yield self.loop.sleep(1)
+        never = self.loop.create_task(forever())
+        done = self.loop.run_until_complete(self.loop.wait([never], 0.02))
+        self.assertFalse(done)
+        never.cancel()
+
+    def test_wait_cancels_its_timer(self):
+        future = self.loop.sleep(0)
+        self.assertTrue(self.loop.run_until_complete(
+            self.loop.wait([future], 60)))
+        self.loop.run_once()
+        self.assertTrue(all(handle.cancelled
+                            for _, _, handle in self.loop._timers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the lease registry, with a fake ARP sweep.
+'''
+
+import os
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import shutil
+import tempfile
+from time import time
+import unittest
+
+import leases
+from leases import allocate_ips, LeaseRegistry
+
+HOST = ('eth0', '10.0.0.5', '00:11:22:33:44:55', '255.255.255.0')
+MACS = ['00:d0:4b:00:00:%02x' % index for index in range(1, 5)]
+
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry = LeaseRegistry(os.path.join(self.directory,
+                                                   'leases.json'))
+        self.find_free_ips = leases.find_free_ips
+        self.sweeps = []
+
+        def find_free_ips(iface, ip, mac, netmask, count=1, exclude=(),
+                          metrics=None):
+            self.sweeps.append(list(exclude))
+            free = ['10.0.0.%d' % index for index in range(10, 250)
+                    if '10.0.0.%d' % index not in exclude]
+            return free[:count]
+        leases.find_free_ips = find_free_ips
+
+    def tearDown(self):
+        leases.find_free_ips = self.find_free_ips
+        shutil.rmtree(self.directory)
+
+    def test_reuse(self):
+        given = allocate_ips(self.registry, *HOST, macs=MACS[:2])
+        self.assertEqual(len(set(given.values())), 2)
+        again = allocate_ips(self.registry, *HOST, macs=MACS[:2])
+        self.assertEqual(again, given)
+        self.assertEqual(len(self.sweeps), 1)
+        self.assertEqual(self.registry.lookup(HOST[0], HOST[1], HOST[3],
+                                              MACS[0].upper()),
+                         given[MACS[0]])
+
+    def test_never_give_a_leased_ip(self):
+        first = allocate_ips(self.registry, *HOST, macs=MACS[:2])
+        second = allocate_ips(self.registry, *HOST, macs=MACS[2:])
+        self.assertFalse(set(first.values()) & set(second.values()))
+
+    def test_exclude(self):
+        given = allocate_ips(self.registry, *HOST, macs=MACS[:1])
+        forced = given[MACS[0]]
+        # Another device of the run was forced to the IP of the lease
+        again = allocate_ips(self.registry, *HOST, macs=MACS[:2],
+                             exclude=[forced])
+        self.assertNotIn(forced, again.values())
+        self.assertIn(forced, self.sweeps[-1])
+
+    def test_release(self):
+        given = allocate_ips(self.registry, *HOST, macs=MACS[:1])
+        self.registry.release(HOST[0], HOST[1], HOST[3], MACS[0])
+        self.assertIsNone(self.registry.lookup(HOST[0], HOST[1], HOST[3],
+                                               MACS[0]))
+        self.assertTrue(given)
+
+    def test_evict(self):
+        self.registry.max_leases = 2
+        now = time()
+        content = {'eth0/10.0.0.0/256': {
+            'old': {'ip': '10.0.0.10', 'expires': now - 1, 'last_used': 0},
+            'a': {'ip': '10.0.0.11', 'expires': now + 60, 'last_used': 1},
+            'b': {'ip': '10.0.0.12', 'expires': now + 60, 'last_used': 3},
+            'c': {'ip': '10.0.0.13', 'expires': now + 60, 'last_used': 2}},
+            'eth1/10.1.0.0/256': {
+            'gone': {'ip': '10.1.0.10', 'expires': now - 1, 'last_used': 5}}}
+        self.registry._evict(content)
+        self.assertEqual(content, {'eth0/10.0.0.0/256': {
+            'b': {'ip': '10.0.0.12', 'expires': now + 60, 'last_used': 3},
+            'c': {'ip': '10.0.0.13', 'expires': now + 60, 'last_used': 2}}})
+
+    def test_no_registry(self):
+        given = allocate_ips(None, *HOST, macs=MACS[:2], exclude=['10.0.0.10'])
+        self.assertEqual(sorted(given.values()), ['10.0.0.11', '10.0.0.12'])
+
+
+if __name__ == '__main__':
+    unittest.main()
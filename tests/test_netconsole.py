@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the netconsole endpoint shared by several sessions.
+'''
+
+import os
+import socket
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import unittest
+
+from eventloop import EventLoop
+from netconsole import NetconsoleEndpoint
+
+
+class Session(object):
+
+    def __init__(self):
+        self.received = []
+
+    def datagram_received(self, data):
+        self.received.append(data)
+
+
+def device(ip):
+    ''' a UDP socket standing for the device at ip, on the loopback '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((ip, 0))
+    return sock
+
+
+class EndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.endpoint = NetconsoleEndpoint(self.loop, 0, '127.0.0.1')
+        self.addr = self.endpoint.sock.getsockname()
+
+    def tearDown(self):
+        self.endpoint.close()
+        self.loop.close()
+
+    def run_loop(self):
+        self.loop.run_until_complete(self.loop.sleep(0.05))
+
+    def test_route_by_source_ip(self):
+        first, second = Session(), Session()
+        self.endpoint.register('127.0.1.1', first)
+        self.endpoint.register('127.0.1.2', second)
+        devices = [device('127.0.1.1'), device('127.0.1.2'),
+                   device('127.0.1.3')]
+        for index, sock in enumerate(devices):
+            sock.sendto('from %d' % index, self.addr)
+        self.run_loop()
+        self.assertEqual(first.received, ['from 0'])
+        self.assertEqual(second.received, ['from 1'])
+
+        self.endpoint.unregister('127.0.1.1')
+        devices[0].sendto('again', self.addr)
+        self.run_loop()
+        self.assertEqual(first.received, ['from 0'])
+        for sock in devices:
+            sock.close()
+
+    def test_port_taken(self):
+        self.assertRaises(socket.error, NetconsoleEndpoint, self.loop,
+                          self.addr[1], '127.0.0.1')
+
+
+if __name__ == '__main__':
+    unittest.main()
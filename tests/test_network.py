@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the free IP search, with a fake ARP sweep.
+'''
+
+import os
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import unittest
+
+import network
+from metrics import Metrics
+from network import find_free_ips, int_to_ip, ip_to_int, subnet_range, \
+    usable_ip
+
+
+class FakeSweep(object):
+    '''
+    Stands for arp_sweep : the IPs in taken answer, every candidate probed
+    is kept.
+    '''
+
+    def __init__(self, taken=()):
+        self.taken = set(ip_to_int(ip) for ip in taken)
+        self.sweeps = []
+
+    def __call__(self, iface, ip, mac, netmask, candidates, window=0.5):
+        self.sweeps.append(list(candidates))
+        network, size = subnet_range(ip, netmask)
+        occupied = bytearray((size + 7) / 8)
+        for candidate in candidates:
+            if candidate in self.taken:
+                offset = candidate - network
+                occupied[offset / 8] |= 1 << (offset % 8)
+        return occupied
+
+
+class FreeIpTest(unittest.TestCase):
+
+    host = ('eth0', '10.0.0.5', '00:11:22:33:44:55', '255.255.255.0')
+
+    def setUp(self):
+        self.arp_sweep = network.arp_sweep
+
+    def tearDown(self):
+        network.arp_sweep = self.arp_sweep
+
+    def sweep(self, taken=()):
+        network.arp_sweep = FakeSweep(taken)
+        return network.arp_sweep
+
+    def test_subnet(self):
+        self.assertEqual(subnet_range('10.0.0.5', '255.255.255.0'),
+                         (ip_to_int('10.0.0.0'), 256))
+        network_, size = subnet_range('10.0.0.5', '255.255.0.0')
+        self.assertFalse(usable_ip(network_, network_, size))
+        self.assertFalse(usable_ip(ip_to_int('10.0.1.255'), network_, size))
+        self.assertFalse(usable_ip(ip_to_int('10.0.2.0'), network_, size))
+        self.assertTrue(usable_ip(ip_to_int('10.0.2.1'), network_, size))
+
+    def test_walk_covers_the_subnet_once(self):
+        sweep = self.sweep()
+        free = find_free_ips(*self.host, count=300, batch=16)
+        probed = sum(sweep.sweeps, [])
+        # 256 addresses, without the network, broadcast and host ones
+        self.assertEqual(len(probed), 253)
+        self.assertEqual(len(set(probed)), len(probed))
+        self.assertNotIn(ip_to_int('10.0.0.5'), probed)
+        self.assertEqual(sorted(free), sorted(int_to_ip(value)
+                                              for value in probed))
+
+    def test_taken_and_excluded(self):
+        taken = ['10.0.0.%d' % index for index in range(1, 200)]
+        self.sweep(taken)
+        free = find_free_ips(*self.host, count=10, batch=8,
+                             exclude=['10.0.0.200', '10.0.0.201'])
+        self.assertEqual(len(free), 10)
+        for ip in free:
+            self.assertNotIn(ip, taken)
+            self.assertNotIn(ip, ['10.0.0.200', '10.0.0.201'])
+
+    def test_several_sweeps_with_metrics(self):
+        # The first sweep finds nothing free, the next ones must go on
+        sweep = self.sweep()
+        first = []
+
+        def fake(*args):
+            if not first:
+                first.extend(args[4])
+                sweep.taken.update(args[4])
+            return FakeSweep.__call__(sweep, *args)
+        network.arp_sweep = fake
+        metrics = Metrics()
+        free = find_free_ips(*self.host, count=2, batch=4, metrics=metrics)
+        self.assertEqual(len(free), 2)
+        self.assertFalse(set(ip_to_int(ip) for ip in free) & set(first))
+
+    def test_subnet_full(self):
+        self.sweep(['10.0.0.%d' % index for index in range(256)])
+        self.assertEqual(find_free_ips(*self.host, count=1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the pipelining of script commands.
+'''
+
+import os
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import unittest
+
+from pipeline import MARKER, join, mergeable, plan, split
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_mergeable(self):
+        self.assertTrue(mergeable('setenv ipaddr 192.168.1.2'))
+        self.assertTrue(mergeable('printenv'))
+        self.assertFalse(mergeable('tftp 0x800000 uImage'))
+        self.assertFalse(mergeable('setenv bootcmd "run a; run b"'))
+        self.assertFalse(mergeable('echo a; reset'))
+        self.assertFalse(mergeable(''))
+
+    def test_plan_keeps_barriers_alone(self):
+        commands = ['setenv a 1', 'setenv b 2', 'tftp 0x800000 uImage',
+                    'printenv', 'bootm']
+        self.assertEqual(plan(commands), [['setenv a 1', 'setenv b 2'],
+                                          ['tftp 0x800000 uImage'],
+                                          ['printenv'], ['bootm']])
+
+    def test_plan_limit(self):
+        commands = ['setenv var%02d %s' % (index, 'x' * 20)
+                    for index in range(20)]
+        groups = plan(commands, 100)
+        self.assertEqual(sum(groups, []), commands)
+        for group in groups:
+            self.assertLess(len(join(group)), 100)
+        self.assertGreater(len(groups), 1)
+
+    def test_join(self):
+        self.assertEqual(join(['setenv a 1']), 'setenv a 1')
+        self.assertEqual(join(['setenv a 1', 'printenv a', 'echo b']),
+                         'setenv a 1; echo %s; printenv a; echo %s; echo b'
+                         % (MARKER % 0, MARKER % 1))
+
+    def test_split(self):
+        output = 'a=1\n%s\nb\n' % (MARKER % 1)
+        self.assertEqual(split('%s\n' % (MARKER % 0) + output, 3),
+                         ['', 'a=1\n', 'b\n'])
+
+    def test_split_missing_marker(self):
+        # Whatever can't be told apart goes with the command before
+        self.assertEqual(split('a=1\nb\n', 2), ['a=1\nb\n', ''])
+        self.assertEqual(split('x\r\n%s\r\ny\n' % (MARKER % 0), 2),
+                         ['x\r\n', 'y\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
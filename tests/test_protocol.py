@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the LUMP, LOOK and INFO codecs.
+'''
+
+import os
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import unittest
+
+from protocol import info_packet, lump_packet, parse_info, parse_lump, \
+    tlvs, LOOK_PACKET, LUMP, TLV_HEADER
+
+
+class ProtocolTest(unittest.TestCase):
+
+    def test_lump(self):
+        packet = lump_packet('00:D0:4B:00:00:01', '192.168.1.10')
+        self.assertEqual(len(packet), LUMP.size)
+        self.assertTrue(packet.startswith('LUMP'))
+        self.assertEqual(parse_lump(packet),
+                         ('00:d0:4b:00:00:01', '192.168.1.10'))
+        # Built once, whatever the case of the MAC
+        self.assertIs(lump_packet('00:d0:4b:00:00:01', '192.168.1.10'),
+                      packet)
+
+    def test_parse_lump_rejects(self):
+        self.assertIsNone(parse_lump(LOOK_PACKET))
+        self.assertIsNone(parse_lump('LUMP' + '\0' * 10))
+
+    def test_look(self):
+        self.assertEqual(LOOK_PACKET, 'LOOK' + '\0' * 14)
+
+    def test_tlvs(self):
+        data = ''.join(TLV_HEADER.pack(typ, len(value)) + value
+                       for typ, value in [('NAME', 'nas\0\0'),
+                                          ('INTF', ''),
+                                          ('MAC ', '00:d0:4b:00:00:01')])
+        self.assertEqual(tlvs(data), {'NAME': 'nas',
+                                      'MAC': '00:d0:4b:00:00:01'})
+
+    def test_tlvs_containers_and_truncation(self):
+        inner = TLV_HEADER.pack('ADDR', 8) + '10.0.0.2'
+        data = TLV_HEADER.pack('IPV4', len(inner)) + inner + \
+            TLV_HEADER.pack('NAME', 40) + 'short'
+        self.assertEqual(tlvs(data), {'ADDR': '10.0.0.2'})
+        self.assertEqual(tlvs(buffer('xx' + data, 2)), {'ADDR': '10.0.0.2'})
+
+    def test_info(self):
+        packet = info_packet([('MAC ', '00:d0:4b:00:00:01'),
+                              ('NAME', 'nas')])
+        self.assertEqual(parse_info(packet), {'MAC': '00:d0:4b:00:00:01',
+                                              'NAME': 'nas'})
+        self.assertIsNone(parse_info('INFO'))
+        self.assertIsNone(parse_info(LOOK_PACKET))
+
+
+if __name__ == '__main__':
+    unittest.main()
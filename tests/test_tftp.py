@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the TFTP server, with a client on the loopback.
+'''
+
+import os
+import sys
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lacie_uboot'))
+import socket
+from struct import pack, unpack
+import unittest
+
+from eventloop import DatagramEndpoint, EventLoop
+from tftp import parse_request, TftpServer, ERR_ACCESS, ERR_ILLEGAL, \
+    ERR_NOT_FOUND, OP_ACK, OP_DATA, OP_ERROR, OP_OACK, OP_RRQ, OP_WRQ
+
+
+def request(opcode, filename, **options):
+    return pack('!H', opcode) + '\0'.join(
+        [filename, 'octet'] + sum([[key, str(value)] for key, value
+                                   in sorted(options.items())], [])) + '\0'
+
+
+class Client(object):
+    ''' keeps every datagram the server sends '''
+
+    def __init__(self, loop):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        self.endpoint = DatagramEndpoint(loop, sock, self)
+        self.received = []
+
+    def datagram_received(self, data, addr):
+        self.received.append((data, addr))
+
+
+class ParseRequestTest(unittest.TestCase):
+
+    def test_options(self):
+        self.assertEqual(parse_request(request(OP_RRQ, 'uImage', BLKSIZE=1468,
+                                               windowsize=8)),
+                         (OP_RRQ, 'uImage', 'octet',
+                          {'blksize': '1468', 'windowsize': '8'}))
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, parse_request, pack('!H', OP_RRQ) + 'a')
+
+
+class TftpServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.server = TftpServer(self.loop, '127.0.0.1', 0)
+        self.server.timeout = 0.2
+        self.addr = self.server.endpoint.sock.getsockname()
+        self.data = ''.join(chr(index % 251) for index in range(5000))
+        self.server.add_file('image', self.data)
+        self.client = Client(self.loop)
+
+    def tearDown(self):
+        self.client.endpoint.close()
+        self.server.close()
+        self.loop.close()
+
+    def receive(self):
+        ''' run the loop until the server answers, return the answer '''
+        stop = self.loop.time() + 2
+        while not self.client.received and self.loop.time() < stop:
+            self.loop.call_later(0.01, lambda: None)
+            self.loop.run_once()
+        self.assertTrue(self.client.received, "The server did not answer")
+        return self.client.received.pop(0)
+
+    def receive_done(self):
+        ''' run the loop until the server is done with every transfer '''
+        stop = self.loop.time() + 2
+        while self.server.active and self.loop.time() < stop:
+            self.loop.call_later(0.01, lambda: None)
+            self.loop.run_once()
+
+    def error_code(self, data):
+        opcode, code = unpack('!HH', data[:4])
+        self.assertEqual(opcode, OP_ERROR)
+        return code
+
+    def download(self, **options):
+        self.client.endpoint.sendto(request(OP_RRQ, 'image', **options),
+                                    self.addr)
+        data, tid = self.receive()
+        accepted = {}
+        if unpack('!H', data[:2])[0] == OP_OACK:
+            fields = data[2:].split('\0')
+            accepted = dict(zip(fields[0::2], fields[1::2]))
+            self.client.endpoint.sendto(pack('!HH', OP_ACK, 0), tid)
+            data, tid = self.receive()
+        blksize = int(accepted.get('blksize', 512))
+        window = int(accepted.get('windowsize', 1))
+        content = []
+        while True:
+            opcode, block = unpack('!HH', data[:4])
+            self.assertEqual(opcode, OP_DATA)
+            self.assertEqual(block, len(content) + 1)
+            content.append(data[4:])
+            last = len(data) - 4 < blksize
+            if last or block % window == 0:
+                self.client.endpoint.sendto(pack('!HH', OP_ACK, block), tid)
+            if last:
+                break
+            data, tid = self.receive()
+        return accepted, ''.join(content)
+
+    def test_plain(self):
+        accepted, content = self.download()
+        self.assertEqual(accepted, {})
+        self.assertEqual(content, self.data)
+        self.receive_done()
+        summary = self.server.summary()
+        self.assertEqual(summary['clients'], 1)
+        self.assertEqual(summary['delivered_bytes'], len(self.data))
+
+    def test_options(self):
+        accepted, content = self.download(blksize=1468, windowsize=4,
+                                          tsize=0)
+        self.assertEqual(accepted, {'blksize': '1468', 'windowsize': '4',
+                                    'tsize': str(len(self.data))})
+        self.assertEqual(content, self.data)
+
+    def test_options_clamped(self):
+        self.server.max_windowsize = 2
+        accepted, content = self.download(blksize=1, windowsize=100)
+        self.assertEqual(accepted, {'blksize': '8', 'windowsize': '2'})
+        self.assertEqual(content, self.data)
+
+    def test_bad_option_value(self):
+        accepted, content = self.download(blksize='big')
+        self.assertEqual(content, self.data)
+
+    def test_errors(self):
+        self.client.endpoint.sendto(request(OP_RRQ, 'none'), self.addr)
+        self.assertEqual(self.error_code(self.receive()[0]), ERR_NOT_FOUND)
+        self.client.endpoint.sendto(request(OP_WRQ, 'image'), self.addr)
+        self.assertEqual(self.error_code(self.receive()[0]), ERR_ACCESS)
+        self.client.endpoint.sendto('\0\1', self.addr)
+        self.assertEqual(self.error_code(self.receive()[0]), ERR_ILLEGAL)
+
+    def test_retransmit(self):
+        self.client.endpoint.sendto(request(OP_RRQ, 'image'), self.addr)
+        first = self.receive()
+        # Not acknowledged, the block comes again
+        self.assertEqual(self.receive(), first)
+
+
+if __name__ == '__main__':
+    unittest.main()